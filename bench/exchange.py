@@ -0,0 +1,310 @@
+"""
+A stand-in of the TWSE and TPEX endpoints the crawlers use, to load-test them offline.
+
+    python -m bench.exchange -port 8800 -latency 0.2 -rate-limit 5 -html-rate 0.01
+    export TWSE_URL=http://127.0.0.1:8800 TPEX_URL=http://127.0.0.1:8800
+    python bin/update_daily_price.py -sdate 2024-05-02
+
+The payloads of the fixture date come from bench/fixtures, those of other weekdays are
+rendered from `bench.synthetic`, and weekends are answered empty like holidays. Faults
+are injected per request: a delay of `-latency` seconds plus up to `-jitter`, 429 with
+Retry-After beyond `-rate-limit` requests per second, and `-empty-rate`/`-html-rate` of
+empty bodies and HTML error pages. `GET /_stats` returns the counts of the answers.
+
+The MOPS statement page is served too, with `export MOPS_URL=http://127.0.0.1:8800`, a
+`-unfiled-rate` of the companies answering that they have not filed yet:
+
+    python bin/update_fin_stmt.py -quarter 20241 -interval 0
+
+So are the MOPS monthly revenue pages, where the companies not reported yet report at
+the same rate on every request, as they do until the 10th:
+
+    python bin/update_monthly_revenue.py -smonth 2024-04
+"""
+
+import argparse
+import collections
+import dataclasses
+import datetime
+import functools
+import http.server
+import json
+import logging
+import random
+import re
+import threading
+import time
+import urllib.parse
+import zlib
+
+from dateutil.relativedelta import relativedelta
+
+from bench import record, synthetic
+from stock_tw import util
+from stock_tw.變易.fin_stmt import mops
+
+STATEMENT_NOT_FOUND_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="UTF-8"></head><body><h4>查詢無資料</h4></body></html>
+"""
+
+HTML_ERROR_PAGE = """<!DOCTYPE html>
+<html><head><title>Error</title></head>
+<body><h1>頁面無法執行</h1><p>因為安全因素，您的查詢已被阻擋，請稍後再試。</p></body></html>
+"""
+
+ROUTEs = {path: name for name, (_, _, path, _) in record.FIXTUREs.items()}
+REVENUE_PATH_PATTERN = re.compile(r"/nas/t21/(sii|otc)/t21sc03_(\d+)_(\d+)_0\.html")
+
+
+@dataclasses.dataclass
+class Options:
+    n_securities: int = 1000
+    latency: float = 0.0
+    jitter: float = 0.0
+    rate_limit: float = 0.0
+    empty_rate: float = 0.0
+    html_rate: float = 0.0
+    unfiled_rate: float = 0.0
+    seed: int = 0
+
+
+class ExchangeServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], options: Options):
+        super().__init__(address, ExchangeHandler)
+        self.options = options
+        self.stats = collections.Counter()
+        self._random = random.Random(options.seed)
+        self._request_times = collections.deque()
+        self._reported = collections.defaultdict(set)
+        self._lock = threading.Lock()
+
+    def decide(self) -> str:
+        """The answer of a request: "ok", "rate_limited", "empty" or "html" """
+        options = self.options
+        with self._lock:
+            now = time.monotonic()
+            while self._request_times and self._request_times[0] <= now - 1:
+                self._request_times.popleft()
+            self._request_times.append(now)
+            if options.rate_limit and len(self._request_times) > options.rate_limit:
+                return "rate_limited"
+
+            draw = self._random.random()
+            delay = options.latency + self._random.uniform(0, options.jitter)
+
+        time.sleep(delay)
+        if draw < options.empty_rate:
+            return "empty"
+        if draw < options.empty_rate + options.html_rate:
+            return "html"
+        return "ok"
+
+    def report(self, market_path: str, ts: datetime.datetime) -> list[str]:
+        """The companies which reported the month so far, more on every request"""
+        securities = synthetic.securities(self.options.n_securities)
+        market = "上市" if market_path == "sii" else "上櫃"
+        with self._lock:
+            reported = self._reported[(market_path, ts)]
+            for code in securities.index[securities["market"] == market]:
+                if self._random.random() >= self.options.unfiled_rate:
+                    reported.add(code)
+            return sorted(reported)
+
+    def draw(self) -> float:
+        with self._lock:
+            return self._random.random()
+
+    def count(self, name: str, answer: str):
+        with self._lock:
+            self.stats[f"{name}.{answer}"] += 1
+
+
+class ExchangeHandler(http.server.BaseHTTPRequestHandler):
+    server: ExchangeServer
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == "/_stats":
+            self._send(200, json.dumps(self.server.stats), "application/json")
+            return
+        if url.path == mops.STATEMENT_PATH:
+            self._send_statement(urllib.parse.parse_qs(url.query))
+            return
+        if match := REVENUE_PATH_PATTERN.fullmatch(url.path):
+            self._send_revenue(*match.groups())
+            return
+
+        name = ROUTEs.get(url.path)
+        if name is None:
+            self._send(404, HTML_ERROR_PAGE, "text/html")
+            return
+
+        answer = self.server.decide()
+        try:
+            ts = _parse_date(name, urllib.parse.parse_qs(url.query))
+        except (KeyError, ValueError):
+            answer = "html"
+
+        self.server.count(name, answer)
+        if answer == "rate_limited":
+            self._send(429, "Too Many Requests", "text/plain", {"Retry-After": "1"})
+        elif answer == "html":
+            self._send(200, HTML_ERROR_PAGE, "text/html")
+        elif answer == "empty" or ts.weekday() in (5, 6):
+            self._send(200, "", _content_type(name))
+        else:
+            payload = render(name, ts, self.server.options.n_securities)
+            self._send(200, payload, _content_type(name))
+
+    def _send_statement(self, query: dict[str, list[str]]):
+        answer = self.server.decide()
+        try:
+            code = query["CO_ID"][0]
+            year, quarter = int(query["SYEAR"][0]), int(query["SSEASON"][0])
+            consolidated = query["REPORT_ID"][0] == "C"
+        except (KeyError, ValueError):
+            answer = "html"
+        if answer == "ok" and (
+            not consolidated or self.server.draw() < self.server.options.unfiled_rate
+        ):
+            answer = "unfiled"
+
+        self.server.count("mops_fin_stmt", answer)
+        if answer == "rate_limited":
+            self._send(429, "Too Many Requests", "text/plain", {"Retry-After": "1"})
+        elif answer in ("html", "empty", "unfiled"):
+            self._send(200, STATEMENT_NOT_FOUND_PAGE, "text/html")
+        else:
+            self._send(200, render_statement(code, year, quarter), "text/html")
+
+    def _send_revenue(self, market_path: str, roc_year: str, month: str):
+        answer, codes = self.server.decide(), []
+        ts = datetime.datetime(int(roc_year) + 1911, int(month), 10)
+        ts += relativedelta(months=1)
+        if answer == "ok":
+            codes = self.server.report(market_path, ts)
+
+        self.server.count(f"{market_path}_revenue", answer)
+        if answer == "rate_limited":
+            self._send(429, "Too Many Requests", "text/plain", {"Retry-After": "1"})
+        elif answer in ("html", "empty") or not codes:
+            self._send(200, HTML_ERROR_PAGE, "text/html")
+        else:
+            self._send(
+                200,
+                render_revenue(ts, tuple(codes), self.server.options.n_securities),
+                "text/html",
+            )
+
+    def log_message(self, format: str, *args):
+        logging.debug(f"{self.address_string()} {format % args}")
+
+    def _send(
+        self, status: int, body: str, content_type: str, headers: dict[str, str] = None
+    ):
+        content = body.encode("UTF-8")
+        self.send_response(status)
+        self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+        self.send_header("Content-Length", str(len(content)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+
+@functools.lru_cache(maxsize=64)
+def render(name: str, ts: datetime.datetime, n_securities: int) -> str:
+    manifest = record.read_manifest()
+    if manifest.get(name, {}).get("ts") == f"{ts:%Y-%m-%d}":
+        return record.read_fixture(name)
+
+    securities = synthetic.securities(n_securities)
+    market = "上市" if name.startswith("twse") else "上櫃"
+    codes = list(securities.index[securities["market"] == market])
+    # The same date is rendered the same on every run
+    seed = ts.toordinal()
+    if name == "twse_price":
+        return synthetic.twse_price_csv(synthetic.daily_prices(codes, ts, ts, seed))
+    if name == "tpex_price":
+        return synthetic.tpex_price_json(synthetic.daily_prices(codes, ts, ts, seed))
+    if name == "twse_pera":
+        return synthetic.twse_pera_json(synthetic.peras(codes, [ts.year], seed))
+    return synthetic.tpex_pera_json(synthetic.peras(codes, [ts.year], seed))
+
+
+@functools.lru_cache(maxsize=4096)
+def render_statement(code: str, year: int, quarter: int) -> str:
+    ifrs_ts = util.IFRSDateIter(year, quarter).current_ifrs_dt()
+    # The same company and quarter are rendered the same on every run
+    seed = zlib.crc32(f"{code}/{year}Q{quarter}".encode())
+    stmts = synthetic.fin_stmts(
+        [code], datetime.datetime(year, quarter * 3, 1), ifrs_ts, seed
+    )
+    return synthetic.mops_statement_html(stmts, code, ifrs_ts)
+
+
+@functools.lru_cache(maxsize=64)
+def render_revenue(
+    ts: datetime.datetime, codes: tuple[str, ...], n_securities: int
+) -> str:
+    securities = synthetic.securities(n_securities)
+    # A company reports the same revenue however many reported with it, on every run
+    revenues = synthetic.revenues(
+        list(securities.index), ts.replace(day=1), ts, ts.toordinal()
+    )
+    revenues = revenues[
+        revenues.index.get_level_values(util.SECURITY_ID_NAME).isin(codes)
+    ]
+    return synthetic.mops_revenue_html(revenues, securities)
+
+
+def _parse_date(name: str, query: dict[str, list[str]]) -> datetime.datetime:
+    if name.startswith("twse"):
+        return datetime.datetime.strptime(query["date"][0], "%Y%m%d")
+
+    roc_year, month, day = map(int, query["d"][0].split("/"))
+    return datetime.datetime(roc_year + 1911, month, day)
+
+
+def _content_type(name: str) -> str:
+    return "text/csv" if name == "twse_price" else "application/json"
+
+
+def serve(host: str, port: int, options: Options) -> ExchangeServer:
+    """Starts serving in a daemon thread, stop it by `shutdown()`"""
+    server = ExchangeServer((host, port), options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-host", default="127.0.0.1")
+    parser.add_argument("-port", type=int, default=8800)
+    parser.add_argument("-securities", type=int, default=1000)
+    parser.add_argument("-latency", type=float, default=0.0, help="Seconds")
+    parser.add_argument("-jitter", type=float, default=0.0, help="Seconds")
+    parser.add_argument(
+        "-rate-limit", type=float, default=0.0, help="Requests per second, 0 is none"
+    )
+    parser.add_argument("-empty-rate", type=float, default=0.0)
+    parser.add_argument("-html-rate", type=float, default=0.0)
+    parser.add_argument("-unfiled-rate", type=float, default=0.0)
+    parser.add_argument("-seed", type=int, default=0)
+    args = parser.parse_args()
+
+    options = Options(
+        n_securities=args.securities,
+        latency=args.latency,
+        jitter=args.jitter,
+        rate_limit=args.rate_limit,
+        empty_rate=args.empty_rate,
+        html_rate=args.html_rate,
+        unfiled_rate=args.unfiled_rate,
+        seed=args.seed,
+    )
+    with ExchangeServer((args.host, args.port), options) as server:
+        logging.info(f"Serve on http://{args.host}:{args.port} with {options}")
+        server.serve_forever()
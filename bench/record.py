@@ -0,0 +1,126 @@
+"""
+Records the exchange payloads the parser benchmarks run on into `bench/fixtures`.
+
+    python -m bench.record -date 2024-05-02
+    python -m bench.record -synthetic 1000
+
+Recording takes the responses of the URLs the crawlers use, on the exchange URLs of
+`util.get_exchange_url`, as they are. `-synthetic` renders `bench.synthetic` data in the
+same formats instead, for machines without access to the exchanges. `manifest.json` keeps the date and the origin of each file.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os.path
+
+from bench import synthetic
+from stock_tw import util
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+MANIFEST_FILE_NAME = "manifest.json"
+
+# name -> (file name, exchange, path, query)
+FIXTUREs = {
+    "twse_price": (
+        "twse_price.csv",
+        "TWSE",
+        "/exchangeReport/MI_INDEX",
+        "response=csv&date={ts:%Y%m%d}&type=ALLBUT0999",
+    ),
+    "tpex_price": (
+        "tpex_price.json",
+        "TPEX",
+        "/web/stock/aftertrading/otc_quotes_no1430/stk_wn1430_result.php",
+        "l=zh-tw&d={roc_year}/{ts:%m/%d}&se=EW",
+    ),
+    "twse_pera": (
+        "twse_pera.json",
+        "TWSE",
+        "/rwd/zh/afterTrading/BWIBBU_d",
+        "date={ts:%Y%m%d}&selectType=ALL&response=json",
+    ),
+    "tpex_pera": (
+        "tpex_pera.json",
+        "TPEX",
+        "/web/stock/aftertrading/peratio_analysis/pera_result.php",
+        "l=zh-tw&d={roc_year}/{ts:%m/%d}&c=",
+    ),
+}
+
+
+def read_manifest() -> dict:
+    with open(os.path.join(FIXTURE_DIR, MANIFEST_FILE_NAME), encoding="UTF-8") as fp:
+        return json.load(fp)
+
+
+def read_fixture(name: str) -> str:
+    file_name, *_ = FIXTUREs[name]
+    with open(os.path.join(FIXTURE_DIR, file_name), encoding="UTF-8") as fp:
+        return fp.read()
+
+
+def record(ts: datetime.datetime) -> dict[str, str]:
+    payloads = {}
+    for name, (_, exchange, path, query) in FIXTUREs.items():
+        query = query.format(ts=ts, roc_year=ts.year - 1911)
+        response = util.fetch(f"{util.get_exchange_url(exchange)}{path}?{query}", name)
+        if not response.text:
+            raise ValueError(f"The payload `{name}` of `{ts:%Y-%m-%d}` is empty.")
+        payloads[name] = response.text
+
+    return payloads
+
+
+def generate(ts: datetime.datetime, n_securities: int) -> dict[str, str]:
+    codes = list(synthetic.securities(n_securities).index)
+    prices = synthetic.daily_prices(codes, ts, ts)
+    peras = synthetic.peras(codes, [ts.year])
+
+    return {
+        "twse_price": synthetic.twse_price_csv(prices),
+        "tpex_price": synthetic.tpex_price_json(prices),
+        "twse_pera": synthetic.twse_pera_json(peras),
+        "tpex_pera": synthetic.tpex_pera_json(peras),
+    }
+
+
+def main(ts: datetime.datetime, n_securities: int = None):
+    if n_securities:
+        payloads = generate(ts, n_securities)
+        origin = f"synthetic, {n_securities} securities"
+    else:
+        payloads = record(ts)
+        origin = "recorded"
+
+    os.makedirs(FIXTURE_DIR, exist_ok=True)
+    manifest = {}
+    for name, payload in payloads.items():
+        file_name, *_ = FIXTUREs[name]
+        with open(os.path.join(FIXTURE_DIR, file_name), "w", encoding="UTF-8") as fp:
+            fp.write(payload)
+        manifest[name] = {"file": file_name, "ts": f"{ts:%Y-%m-%d}", "origin": origin}
+        logging.info(f"Wrote fixture `{file_name}` {len(payload)} chars ({origin})")
+
+    with open(
+        os.path.join(FIXTURE_DIR, MANIFEST_FILE_NAME), "w", encoding="UTF-8"
+    ) as fp:
+        json.dump(manifest, fp, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-date",
+        help="The trading date of the payloads in format 'YYYY-MM-DD'",
+        default=datetime.date.today().strftime("%Y-%m-%d"),
+    )
+    parser.add_argument(
+        "-synthetic",
+        type=int,
+        help="Generate payloads of this many securities instead of recording them",
+    )
+    args = parser.parse_args()
+
+    main(datetime.datetime.strptime(args.date, "%Y-%m-%d"), args.synthetic)
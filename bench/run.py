@@ -0,0 +1,443 @@
+"""
+Times the hot paths on the fixtures and on a synthetic database, and reports the best
+wall time of `-repeat` runs and the peak memory traced by `tracemalloc` of one more run.
+
+    python -m bench.run -securities 2000 -years 5 -output usr/data/bench.json
+    python -m bench.run -baseline usr/data/bench.json
+
+With `-baseline`, a case slower or heavier than the baseline by more than `-tolerance`
+is reported as a regression and the exit status is 1. A suite which fails, as an
+analysis which differs from the pandas one, is reported as failed and the exit status is
+1 as well; a suite which misses an optional dependency is skipped.
+"""
+
+import argparse
+import dataclasses
+import datetime
+import functools
+import importlib
+import json
+import logging
+import os
+import os.path
+import sqlite3
+import sys
+import tempfile
+import time
+import traceback
+import tracemalloc
+from typing import Callable, Iterator, Optional
+
+import pandas
+
+from bench import record, synthetic
+from stock_tw import pipeline, util
+from stock_tw.變易 import adjusted, indicator, pera, price, profit, security
+from stock_tw.變易.fin_stmt import (
+    account_store,
+    balance_sheet,
+    cumulate_income_sheet,
+    income_sheet,
+)
+
+# The optional dependencies, a suite without them is skipped
+OPTIONAL_MODULEs = ["duckdb", "polars", "pyarrow"]
+
+
+@dataclasses.dataclass
+class Result:
+    name: str
+    seconds: Optional[float] = None
+    peak_bytes: Optional[int] = None
+    note: str = ""
+    failed: bool = False
+
+
+def measure(name: str, func: Callable, repeat: int) -> Result:
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return Result(name=name, seconds=min(seconds), peak_bytes=peak_bytes)
+
+
+def parser_cases() -> Iterator[tuple[str, Callable]]:
+    manifest = record.read_manifest()
+    twse_price_text = record.read_fixture("twse_price")
+    tpex_price_data = json.loads(record.read_fixture("tpex_price"))
+    twse_pera_data = json.loads(record.read_fixture("twse_pera"))
+    tpex_pera_data = json.loads(record.read_fixture("tpex_pera"))
+
+    def ts(name: str) -> datetime.datetime:
+        return datetime.datetime.strptime(manifest[name]["ts"], "%Y-%m-%d")
+
+    yield "parse.twse_price", lambda: price._parse_daily_price_from_twse(
+        twse_price_text, ts("twse_price")
+    )
+    yield "parse.tpex_price", lambda: price._parse_daily_price_from_tpex(
+        tpex_price_data, ts("tpex_price")
+    )
+    yield "parse.twse_pera", lambda: pera._parse_pera_from_twse(
+        twse_pera_data, ts("twse_pera")
+    )
+    yield "parse.tpex_pera", lambda: pera._parse_pera_from_tpex(
+        tpex_pera_data, ts("tpex_pera")
+    )
+
+
+def storage_cases(db_path: str) -> Iterator[tuple[str, Callable]]:
+    with sqlite3.connect(db_path) as conn:
+        prices = price.read_sql(conn, start_time=datetime.datetime(1990, 1, 1))
+        stmts = balance_sheet.read_sql(conn, start_time=datetime.datetime(1990, 1, 1))
+    last_ts = prices.index.get_level_values(util.TIME_COL_NAME).max()
+    last_day = prices.loc[[last_ts]]
+    last_quarter = stmts.loc[[stmts.index.get_level_values(util.TIME_COL_NAME).max()]]
+    with sqlite3.connect(db_path) as conn:
+        cumulate_stmts = cumulate_income_sheet.read_sql(
+            conn, start_time=datetime.datetime(1990, 1, 1)
+        )
+    # A few accounts of the statements, as `dataset` reads them
+    accounts = [
+        column
+        for column in balance_sheet.BALANCE_TB_DTYPEs
+        if column not in util.STATEMENT_META_COLs
+    ][:3]
+    with sqlite3.connect(db_path) as conn:
+        for _, quarter_df in stmts.groupby(level=util.TIME_COL_NAME):
+            account_store.write_sqlite3(quarter_df, conn, balance_sheet.BALANCE_TB_NAME)
+
+    def read_prices():
+        with sqlite3.connect(db_path) as conn:
+            price.read_sql(conn, start_time=datetime.datetime(1990, 1, 1))
+
+    def write_prices():
+        with sqlite3.connect(db_path) as conn:
+            price.write_sqlite3(last_day, price.PRICE_TB_NAME, conn)
+
+    def write_balance_sheets():
+        with sqlite3.connect(db_path) as conn:
+            balance_sheet.write_sqlite3(last_quarter, conn)
+
+    def write_account_store():
+        with sqlite3.connect(db_path) as conn:
+            account_store.write_sqlite3(
+                last_quarter, conn, balance_sheet.BALANCE_TB_NAME
+            )
+
+    def read_balance_sheets():
+        with sqlite3.connect(db_path) as conn:
+            balance_sheet.read_sql(
+                conn, start_time=datetime.datetime(1990, 1, 1), columns=accounts
+            )
+
+    def read_account_store():
+        with sqlite3.connect(db_path) as conn:
+            account_store.read_sql(
+                conn,
+                balance_sheet.BALANCE_TB_NAME,
+                start_time=datetime.datetime(1990, 1, 1),
+                columns=accounts,
+            )
+
+    def read_account_store_as_of():
+        with sqlite3.connect(db_path) as conn:
+            account_store.read_as_of(
+                conn,
+                balance_sheet.BALANCE_TB_NAME,
+                datetime.datetime.now(),
+                start_time=datetime.datetime(1990, 1, 1),
+                columns=accounts,
+            )
+
+    def replay_indicators():
+        indicator.replay(indicator.new_state(), prices)
+
+    def rebuild_his_profits():
+        engine = synthetic.create_sqlite3_engine(db_path)
+        with sqlite3.connect(db_path) as conn, engine.connect() as connection:
+            profit.create_tables(conn)
+            conn.execute(f"DELETE FROM `{profit.WATERMARK_TB_NAME}`;")
+            profit.refresh(conn, connection)
+
+    yield "read_sql.daily_price", read_prices
+    yield "write_sqlite3.daily_price", write_prices
+    yield "write_sqlite3.balance_sheet", write_balance_sheets
+    yield "account_store.write_sqlite3.balance_sheet", write_account_store
+    yield "read_sql.balance_sheet", read_balance_sheets
+    yield "account_store.read_sql.balance_sheet", read_account_store
+    yield "account_store.read_as_of.balance_sheet", read_account_store_as_of
+    yield "income_sheet.derive", lambda: income_sheet.derive(cumulate_stmts)
+    yield "profit.refresh.rebuild", rebuild_his_profits
+    yield "indicator.replay", replay_indicators
+    yield "adjusted.calculate", lambda: adjusted.calculate(prices)
+
+
+def pipeline_cases(db_path: str) -> Iterator[tuple[str, Callable]]:
+    """
+    The adjusted prices of the last days derived by a pipelined backfill, a day at a
+    time on one kept connection, checked against the ones of the whole history
+    """
+    util.DB_ENGINE = synthetic.create_sqlite3_engine(db_path)
+    with sqlite3.connect(db_path) as conn:
+        prices = price.read_sql(conn, start_time=datetime.datetime(1990, 1, 1))
+        securities = security.read_sql(conn)
+    market_codes = {
+        "twse": securities.index[securities["market"] == "上市"],
+        "tpex": securities.index[securities["market"] == "上櫃"],
+    }
+    days = prices.index.get_level_values(util.TIME_COL_NAME)
+    dates = sorted(days.unique())[-10:]
+    _, history_df = adjusted.calculate(prices[days < dates[0]])
+    _, expected_df = adjusted.calculate(prices)
+
+    def write_adjusted(df: pandas.DataFrame, if_exists: str):
+        with sqlite3.connect(db_path) as conn:
+            df.to_sql(adjusted.ADJUSTED_PRICE_TB_NAME, con=conn, if_exists=if_exists)
+
+    def fetch(ts: datetime.datetime, market: str) -> pandas.DataFrame:
+        day = prices.loc[[ts]]
+        codes = day.index.get_level_values(util.SECURITY_ID_NAME)
+        return day[codes.isin(market_codes[market])]
+
+    def derive(conns, ts: datetime.datetime, df: pandas.DataFrame):
+        last_df = adjusted.read_last(conns.get_connection(), ts)
+        write_adjusted(adjusted.calculate(df, last_df)[1], "append")
+
+    dataset = pipeline.Dataset(
+        name=adjusted.ADJUSTED_PRICE_TB_NAME,
+        fetch=fetch,
+        parse=lambda df, ts, market: df,
+        load=lambda conns, df: len(df),
+        derive=derive,
+    )
+
+    def backfill():
+        write_adjusted(history_df, "replace")
+        pipeline.run(dataset, dates, fetch_interval=0.0)
+
+    backfill()
+    with sqlite3.connect(db_path) as conn:
+        adjusted_df = adjusted.read_sql(conn, start_time=datetime.datetime(1990, 1, 1))
+    pandas.testing.assert_frame_equal(
+        expected_df, adjusted_df.sort_index(), check_freq=False
+    )
+
+    yield "pipeline.derive", backfill
+
+
+def dataset_cases(db_path: str) -> Iterator[tuple[str, Callable]]:
+    """`dataset` loads at import, from `util.DB_ENGINE` and the SQLite3 of STORAGE_ROOT"""
+    os.environ["STORAGE_ROOT"] = os.path.dirname(db_path)
+    util.DB_ENGINE = synthetic.create_sqlite3_engine(db_path)
+    from stock_tw.變易 import dataset
+
+    yield "dataset.import", lambda: importlib.reload(dataset)
+    yield "dataset.analyze_prices", dataset.analyze_prices
+    yield "dataset.calculate_his_fin_stmt", dataset.calculate_his_fin_stmt
+    yield "dataset.analyze_revenue", dataset.analyze_revenue
+    yield "dataset.analyze_peras", dataset.analyze_peras
+    yield "dataset.analyze_profit", dataset.analyze_profit
+
+
+def warehouse_cases(db_path: str) -> Iterator[tuple[str, Callable]]:
+    """
+    The analyses of `dataset` as SQL over the tables mirrored into DuckDB, checked
+    against the pandas ones
+    """
+    from stock_tw.變易 import dataset, warehouse
+
+    def mirror():
+        duck = warehouse.connect(":memory:")
+        with sqlite3.connect(db_path) as conn, util.DB_ENGINE.connect() as connection:
+            warehouse.mirror(duck, connection, conn, datetime.datetime(1990, 1, 1))
+        return duck
+
+    duck = mirror()
+    anal_per = dataset.anal_per[dataset.ANAL_PERA_COLs]
+
+    # In the order of `dataset`, as the later analyses read the frames of the former
+    dataset.analyze_prices()
+    pandas.testing.assert_frame_equal(
+        dataset.daily_price, warehouse.analyze_prices(duck)
+    )
+    dataset.calculate_his_fin_stmt()
+    pandas.testing.assert_frame_equal(
+        dataset.his_profits,
+        warehouse.calculate_his_fin_stmt(duck, dataset._FIN_DATA_START_DT),
+    )
+    dataset.analyze_revenue()
+    anal_revenue = warehouse.analyze_revenue(duck)
+    # The synthetic SQLite3 keeps the DATETIME of MySQL as text
+    anal_revenue["updated_ts"] = pandas.to_datetime(anal_revenue["updated_ts"])
+    pandas.testing.assert_frame_equal(dataset.anal_revenue, anal_revenue)
+    dataset.analyze_profit()
+    pandas.testing.assert_frame_equal(
+        dataset.anal_profit,
+        warehouse.analyze_profit(duck, anal_per, dataset.daily_price),
+    )
+
+    yield "warehouse.mirror", mirror
+    yield "warehouse.analyze_prices", lambda: warehouse.analyze_prices(duck)
+    yield "warehouse.calculate_his_fin_stmt", lambda: warehouse.calculate_his_fin_stmt(
+        duck, dataset._FIN_DATA_START_DT
+    )
+    yield "warehouse.analyze_revenue", lambda: warehouse.analyze_revenue(duck)
+    yield "warehouse.analyze_profit", lambda: warehouse.analyze_profit(
+        duck, anal_per, dataset.daily_price
+    )
+
+
+def polars_cases() -> Iterator[tuple[str, Callable]]:
+    """The analyses of `dataset` by the lazy Polars, checked against the pandas ones"""
+    from stock_tw.變易 import dataset
+
+    analyses = {
+        "analyze_prices": dataset.analyze_prices,
+        "analyze_peras": dataset.analyze_peras,
+        "analyze_revenue": dataset.analyze_revenue,
+        "calculate_his_fin_stmt": dataset.calculate_his_fin_stmt,
+        "analyze_profit": dataset.analyze_profit,
+    }
+    # In the order of `dataset`, as the later analyses read the frames of the former
+    for analyze in analyses.values():
+        pandas.testing.assert_frame_equal(
+            analyze(engine="pandas"), analyze(engine="polars")
+        )
+
+    for name, analyze in analyses.items():
+        yield f"polars.{name}", functools.partial(analyze, engine="polars")
+
+
+def run(n_securities: int, years: int, repeat: int, only: str = None) -> list[Result]:
+    results = []
+
+    def collect(suite: str, cases: Callable[[], Iterator[tuple[str, Callable]]]):
+        try:
+            for name, func in cases():
+                if only and only not in name:
+                    continue
+                logging.info(f"Run `{name}`")
+                results.append(measure(name, func, repeat))
+        except ModuleNotFoundError as e:
+            if e.name not in OPTIONAL_MODULEs:
+                fail(suite, e)
+                return
+            logging.warning(f"Skip the `{suite}` cases, {type(e).__name__}: {e}")
+            results.append(Result(name=suite, note=f"skipped, {type(e).__name__}: {e}"))
+        except Exception as e:
+            fail(suite, e)
+
+    def fail(suite: str, e: Exception):
+        logging.error(f"Fail the `{suite}` cases, {traceback.format_exc()}")
+        results.append(
+            Result(name=suite, note=f"failed, {type(e).__name__}: {e}", failed=True)
+        )
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, "stock-tw.db")
+        start = time.perf_counter()
+        counts = synthetic.build_database(db_path, n_securities, years)
+        logging.info(
+            f"Built the synthetic database in {time.perf_counter() - start:.1f}s {counts}"
+        )
+
+        collect("parse", parser_cases)
+        collect("storage", lambda: storage_cases(db_path))
+        collect("pipeline", lambda: pipeline_cases(db_path))
+        collect("dataset", lambda: dataset_cases(db_path))
+        collect("warehouse", lambda: warehouse_cases(db_path))
+        collect("polars", polars_cases)
+
+    return results
+
+
+def compare(results: list[Result], baseline: list[dict], tolerance: float) -> list[str]:
+    baseline_by_name = {item["name"]: item for item in baseline}
+    regressions = []
+    for result in results:
+        base = baseline_by_name.get(result.name)
+        if result.seconds is None or not base or base["seconds"] is None:
+            continue
+        if result.seconds > base["seconds"] * (1 + tolerance):
+            regressions.append(
+                f"{result.name}: {base['seconds']:.4f}s -> {result.seconds:.4f}s"
+            )
+        if result.peak_bytes > base["peak_bytes"] * (1 + tolerance):
+            regressions.append(
+                f"{result.name}: peak {base['peak_bytes'] / 2**20:.1f}MiB ->"
+                f" {result.peak_bytes / 2**20:.1f}MiB"
+            )
+
+    return regressions
+
+
+def report(results: list[Result]) -> str:
+    df = pandas.DataFrame([dataclasses.asdict(result) for result in results])
+    df["peak_MiB"] = (pandas.to_numeric(df["peak_bytes"]) / 2**20).round(2)
+    df["seconds"] = pandas.to_numeric(df["seconds"]).round(4)
+    return df[["name", "seconds", "peak_MiB", "note"]].to_string(index=False)
+
+
+def main(args: argparse.Namespace) -> int:
+    # Time the work itself, not the stage logs and metric files
+    os.environ.pop("METRICS_DIR", None)
+    logging.getLogger().setLevel(logging.INFO)
+
+    results = run(args.securities, args.years, args.repeat, args.only)
+    print(report(results))
+
+    if args.output:
+        meta = {
+            "time": datetime.datetime.now().isoformat(),
+            "securities": args.securities,
+            "years": args.years,
+            "repeat": args.repeat,
+        }
+        with open(args.output, "w", encoding="UTF-8") as fp:
+            json.dump(
+                {**meta, "results": [dataclasses.asdict(result) for result in results]},
+                fp,
+                ensure_ascii=False,
+                indent=2,
+            )
+
+    if args.baseline:
+        with open(args.baseline, encoding="UTF-8") as fp:
+            baseline = json.load(fp)
+        regressions = compare(results, baseline["results"], args.tolerance)
+        for regression in regressions:
+            logging.error(f"Regression {regression}")
+        if regressions:
+            return 1
+
+    if any(result.failed for result in results):
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-securities", type=int, default=1000)
+    parser.add_argument("-years", type=int, default=3)
+    parser.add_argument("-repeat", type=int, default=3)
+    parser.add_argument("-only", help="Run the cases whose name contains it")
+    parser.add_argument("-output", help="Write the results to this JSON file")
+    parser.add_argument("-baseline", help="Compare with the results of this JSON file")
+    parser.add_argument(
+        "-tolerance",
+        type=float,
+        default=0.2,
+        help="The allowed relative increase over the baseline",
+    )
+
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,484 @@
+"""
+Synthetic market data at a configurable scale (securities x years).
+
+The frames have the index and columns of the real tables, the financial statements
+follow the `CONF` headers, and the payload functions render them in the formats served
+by TWSE (MI_INDEX CSV, BWIBBU_d JSON), TPEX (stk_wn1430, pera_result JSON) and MOPS
+(t164sb01 and t21sc03 HTML), so the same generator feeds the benchmarks, the fixtures and the
+stand-in exchange server.
+"""
+
+import datetime
+import json
+import sqlite3
+
+import numpy
+import pandas
+import sqlalchemy
+from dateutil.relativedelta import relativedelta
+
+from stock_tw import util
+from stock_tw.變易 import pera, price, revenue, security
+from stock_tw.變易.fin_stmt import (
+    balance_sheet,
+    cash_flow,
+    cumulate_income_sheet,
+    income_sheet,
+)
+
+GROUPs = [
+    "水泥工業",
+    "食品工業",
+    "塑膠工業",
+    "半導體業",
+    "電腦及週邊設備業",
+    "金融保險業",
+]
+
+
+def securities(n_securities: int, seed: int = 0) -> pandas.DataFrame:
+    rng = numpy.random.default_rng(seed)
+    codes = [str(1101 + i) for i in range(n_securities)]
+    df = pandas.DataFrame(
+        {
+            util.SECURITY_ID_NAME: codes,
+            "type": "股票",
+            "name": [f"公司{code}" for code in codes],
+            "ISIN": [f"TW000{code}000" for code in codes],
+            "start": "2000/01/01",
+            "market": ["上市" if i % 2 == 0 else "上櫃" for i in range(n_securities)],
+            "group": rng.choice(GROUPs, n_securities),
+            "CFI": "ESVUFR",
+        }
+    )
+    return df.set_index([util.SECURITY_ID_NAME])[security.SECURITY_TB_COLs]
+
+
+def daily_prices(
+    codes: list[str], start: datetime.datetime, end: datetime.datetime, seed: int = 0
+) -> pandas.DataFrame:
+    rng = numpy.random.default_rng(seed)
+    days = pandas.bdate_range(start, end)
+    shape = (len(days), len(codes))
+
+    closes = 50 * numpy.exp(numpy.cumsum(rng.normal(0, 0.015, shape), axis=0))
+    closes = numpy.round(closes * rng.uniform(0.2, 10, len(codes)), 2)
+    changes = numpy.vstack([numpy.zeros((1, len(codes))), numpy.diff(closes, axis=0)])
+    opens = numpy.round(closes - changes * rng.uniform(0, 1, shape), 2)
+    highs = numpy.maximum(opens, closes) + numpy.round(
+        rng.uniform(0, 0.02, shape) * closes, 2
+    )
+    lows = numpy.minimum(opens, closes) - numpy.round(
+        rng.uniform(0, 0.02, shape) * closes, 2
+    )
+    volumes = rng.integers(1_000, 50_000_000, shape)
+
+    index = pandas.MultiIndex.from_product([days, codes], names=util.TIMED_INDEX_COLs)
+    df = pandas.DataFrame(
+        {
+            "成交股數": volumes.ravel(),
+            "成交筆數": (volumes // 1_000 + 1).ravel(),
+            "成交金額": (volumes * closes).round().ravel(),
+            "開盤價": opens.ravel(),
+            "最高價": highs.ravel(),
+            "最低價": lows.ravel(),
+            "收盤價": closes.ravel(),
+            "漲跌幅(%)": (changes / (closes - changes) * 100).ravel(),
+            "漲跌價差": changes.round(2).ravel(),
+            "最後揭示買價": (closes - 0.05).round(2).ravel(),
+            "最後揭示買量": rng.integers(1, 500, shape).ravel(),
+            "最後揭示賣價": (closes + 0.05).round(2).ravel(),
+            "最後揭示賣量": rng.integers(1, 500, shape).ravel(),
+            "本益比": rng.uniform(5, 40, shape).round(2).ravel(),
+        },
+        index=index,
+    )
+    return df[price.PRICE_TB_COLs]
+
+
+def peras(codes: list[str], years: list[int], seed: int = 0) -> pandas.DataFrame:
+    rng = numpy.random.default_rng(seed)
+    index = pandas.MultiIndex.from_product(
+        [[datetime.datetime(year, 12, 31) for year in years], codes],
+        names=util.TIMED_INDEX_COLs,
+    )
+    n = len(index)
+    df = pandas.DataFrame(
+        {
+            "殖利率(%)": rng.uniform(0, 8, n).round(2),
+            "股利年度": numpy.repeat([year - 1912 for year in years], len(codes)),
+            "本益比": rng.uniform(5, 40, n).round(2),
+            "股價淨值比": rng.uniform(0.5, 6, n).round(2),
+            "每股股利(註)": rng.uniform(0, 10, n).round(2),
+        },
+        index=index,
+    )
+    return df[pera.PERA_TB_COLs]
+
+
+def revenues(
+    codes: list[str], start: datetime.datetime, end: datetime.datetime, seed: int = 0
+) -> pandas.DataFrame:
+    """Monthly revenues, '2023-06-10' stands for the revenue of 2023-05"""
+    rng = numpy.random.default_rng(seed)
+    months = pandas.date_range(start, end, freq="MS") + pandas.Timedelta(days=9)
+    shape = (len(months), len(codes))
+    monthly = rng.uniform(1e5, 1e8, len(codes)) * rng.lognormal(0, 0.2, shape)
+    monthly = monthly.round()
+
+    df = pandas.DataFrame(
+        monthly.ravel(),
+        index=pandas.MultiIndex.from_product(
+            [months, codes], names=util.TIMED_INDEX_COLs
+        ),
+        columns=["當月營收"],
+    )
+    revenue_years = (
+        df.index.get_level_values(util.TIME_COL_NAME) - pandas.DateOffset(months=1)
+    ).year
+    df["當月累計營收"] = df.groupby(
+        [revenue_years, df.index.get_level_values(util.SECURITY_ID_NAME)]
+    )["當月營收"].cumsum()
+    df["去年累計營收"] = (df["當月累計營收"] * rng.uniform(0.7, 1.3, len(df))).round()
+    df["updated_ts"] = df.index.get_level_values(util.TIME_COL_NAME)
+    return df[["updated_ts", "當月營收", "當月累計營收", "去年累計營收"]]
+
+
+def fin_stmts(
+    codes: list[str], start: datetime.datetime, end: datetime.datetime, seed: int = 0
+) -> dict[str, pandas.DataFrame]:
+    """All statements by table name, with every account of the `CONF` headers"""
+    rng = numpy.random.default_rng(seed)
+    ifrs_dates = []
+    ifrs_iter = util.IFRSDateIter(ifrs_dt=util.IFRSDateIter.dt_in_ifrs_dt(start))
+    while (ifrs_dt := ifrs_iter.current_ifrs_dt()) <= end:
+        ifrs_dates.append(ifrs_dt)
+        ifrs_iter.next_ifrs_dt()
+
+    index = pandas.MultiIndex.from_product(
+        [ifrs_dates, codes], names=util.TIMED_INDEX_COLs
+    )
+    n = len(index)
+    scale = numpy.tile(rng.uniform(1e6, 1e9, len(codes)), len(ifrs_dates))
+
+    stmts = {}
+    for table_name, columns in [
+        (balance_sheet.BALANCE_TB_NAME, balance_sheet.BALANCE_TB_COLs),
+        (income_sheet.INCOME_TB_NAME, income_sheet.INCOME_TB_COLs),
+        (
+            cumulate_income_sheet.CUMULATE_INCOME_TB_NAME,
+            cumulate_income_sheet.CUMULATE_INCOME_TB_COLs,
+        ),
+        (cash_flow.CASH_TB_NAME, cash_flow.CASH_TB_COLs),
+    ]:
+        accounts = [
+            column
+            for column in dict.fromkeys(columns)
+            if column not in util.TIMED_INDEX_COLs + ["created_ts", "updated_ts"]
+        ]
+        values = rng.normal(0.05, 0.1, (n, len(accounts))) * scale[:, None]
+        df = pandas.DataFrame(values.round(), index=index, columns=accounts)
+        # Statements are mostly NaN, an account is only filed by some companies
+        df = df.mask(rng.random(df.shape) < 0.3)
+        df["created_ts"] = df.index.get_level_values(util.TIME_COL_NAME)
+        df["updated_ts"] = df["created_ts"]
+        stmts[table_name] = df
+
+    balance = stmts[balance_sheet.BALANCE_TB_NAME]
+    balance["資產總計"] = scale * 10
+    balance["權益總額"] = (balance["資產總計"] * rng.uniform(0.2, 0.8, n)).round()
+    balance["普通股股本"] = (balance["權益總額"] * rng.uniform(0.1, 0.5, n)).round()
+    income = stmts[income_sheet.INCOME_TB_NAME]
+    income["營業收入合計"] = scale * rng.uniform(0.5, 1.5, n)
+    income["營業毛利（毛損）"] = income["營業收入合計"] * rng.uniform(0.05, 0.6, n)
+    income["本期淨利（淨損）"] = income["營業毛利（毛損）"] * rng.uniform(-0.2, 0.8, n)
+    income["基本每股盈餘合計"] = (
+        income["本期淨利（淨損）"] / balance["普通股股本"] * 10
+    ).round(2)
+
+    return stmts
+
+
+def build_database(
+    path: str, n_securities: int, years: int, seed: int = 0
+) -> dict[str, int]:
+    """Writes all the tables into one SQLite3 file, returns the row count by table"""
+    end = datetime.datetime.today().replace(hour=0, minute=0, second=0, microsecond=0)
+    start = end - relativedelta(years=years)
+    securities_df = securities(n_securities, seed)
+    codes = list(securities_df.index)
+    stmts = fin_stmts(codes, start, end, seed)
+
+    tables = {
+        security.SECURITY_TB_NAME: securities_df,
+        price.PRICE_TB_NAME: daily_prices(codes, start, end, seed),
+        pera.PERA_TB_NAME: peras(codes, list(range(start.year, end.year + 1)), seed),
+        revenue.REVENUE_TB_NAME: revenues(codes, start, end, seed),
+        **stmts,
+        f"{balance_sheet.BALANCE_TB_NAME}_metatime": stmts[
+            balance_sheet.BALANCE_TB_NAME
+        ][["資產總計", "created_ts"]],
+    }
+    with sqlite3.connect(path) as conn:
+        for table_name, df in tables.items():
+            df.to_sql(table_name, con=conn, if_exists="replace")
+
+    return {table_name: len(df) for table_name, df in tables.items()}
+
+
+def create_sqlite3_engine(path: str) -> sqlalchemy.Engine:
+    """A stand-in of `util.DB_ENGINE`, with the MySQL functions the queries use"""
+    engine = sqlalchemy.create_engine(f"sqlite:///{path}")
+
+    @sqlalchemy.event.listens_for(engine, "connect")
+    def _register_functions(dbapi_connection, _):
+        dbapi_connection.create_function("YEAR", 1, lambda ts: int(ts[:4]))
+
+    return engine
+
+
+def twse_price_csv(prices: pandas.DataFrame) -> str:
+    """One day of `daily_prices` as the MI_INDEX CSV of TWSE"""
+    ts = prices.index.get_level_values(util.TIME_COL_NAME)[0]
+    lines = [
+        f'"{ts.year - 1911}年{ts.month:02d}月{ts.day:02d}日 每日收盤行情(全部(不含權證、牛熊證))"',
+        '"價格指數(臺灣證券交易所)"',
+        '"指數","收盤指數","漲跌(+/-)","漲跌點數","漲跌百分比(%)","特殊處理註記",',
+        '"發行量加權股價指數","17,005.09","+","47.21","0.28","",',
+        "",
+        '"每日收盤行情(全部(不含權證、牛熊證))"',
+        '"證券代號","證券名稱","成交股數","成交筆數","成交金額","開盤價","最高價","最低價","收盤價",'
+        '"漲跌(+/-)","漲跌價差","最後揭示買價","最後揭示買量","最後揭示賣價","最後揭示賣量","本益比",',
+    ]
+    for (_, code), row in prices.iterrows():
+        sign = "+" if row["漲跌價差"] > 0 else "-" if row["漲跌價差"] < 0 else " "
+        values = [
+            code,
+            f"公司{code}",
+            f"{int(row['成交股數']):,}",
+            f"{int(row['成交筆數']):,}",
+            f"{int(row['成交金額']):,}",
+            f"{row['開盤價']:,.2f}",
+            f"{row['最高價']:,.2f}",
+            f"{row['最低價']:,.2f}",
+            f"{row['收盤價']:,.2f}",
+            sign,
+            f"{abs(row['漲跌價差']):.2f}",
+            f"{row['最後揭示買價']:,.2f}",
+            f"{int(row['最後揭示買量']):,}",
+            f"{row['最後揭示賣價']:,.2f}",
+            f"{int(row['最後揭示賣量']):,}",
+            f"{row['本益比']:.2f}",
+        ]
+        # The code is written as a formula, so spreadsheets keep its leading zeros
+        lines.append(
+            f'="{values[0]}",' + ",".join(f'"{value}"' for value in values[1:]) + ","
+        )
+    lines += ["", '"備註:"', '"符號說明:+/-/X表示漲/跌/不比價"']
+    return "\n".join(lines) + "\n"
+
+
+def tpex_price_json(prices: pandas.DataFrame) -> str:
+    """One day of `daily_prices` as the stk_wn1430 JSON of TPEX"""
+    ts = prices.index.get_level_values(util.TIME_COL_NAME)[0]
+    rows = [
+        [
+            code,
+            f"公司{code}",
+            f"{row['收盤價']:.2f}",
+            f"{row['漲跌價差']:+.2f}",
+            f"{row['開盤價']:.2f}",
+            f"{row['最高價']:.2f}",
+            f"{row['最低價']:.2f}",
+            f"{int(row['成交股數']):,}",
+            f"{int(row['成交金額']):,}",
+            f"{int(row['成交筆數']):,}",
+            f"{row['最後揭示買價']:.2f}",
+            f"{int(row['最後揭示買量']):,}",
+            f"{row['最後揭示賣價']:.2f}",
+            f"{int(row['最後揭示賣量']):,}",
+            "100,000,000",
+            f"{row['收盤價'] * 1.1:.2f}",
+            f"{row['收盤價'] * 0.9:.2f}",
+        ]
+        for (_, code), row in prices.iterrows()
+    ]
+    data = {
+        "reportDate": f"{ts.year - 1911}/{ts.month:02d}/{ts.day:02d}",
+        "iTotalRecords": len(rows),
+        "aaData": rows,
+    }
+    return json.dumps(data, ensure_ascii=False)
+
+
+def twse_pera_json(peras_df: pandas.DataFrame) -> str:
+    """Rows of `peras` as the BWIBBU_d JSON of TWSE"""
+    rows = [
+        [
+            code,
+            f"公司{code}",
+            f"{row['殖利率(%)']:.2f}",
+            int(row["股利年度"]),
+            f"{row['本益比']:.2f}",
+            f"{row['股價淨值比']:.2f}",
+            f"{int(row['股利年度']) + 1}/2",
+        ]
+        for (_, code), row in peras_df.iterrows()
+    ]
+    data = {
+        "stat": "OK",
+        "fields": [
+            "證券代號",
+            "證券名稱",
+            "殖利率(%)",
+            "股利年度",
+            "本益比",
+            "股價淨值比",
+            "財報年/季",
+        ],
+        "data": rows,
+    }
+    return json.dumps(data, ensure_ascii=False)
+
+
+def tpex_pera_json(peras_df: pandas.DataFrame) -> str:
+    """Rows of `peras` as the pera_result JSON of TPEX"""
+    rows = [
+        [
+            code,
+            f"公司{code}",
+            f"{row['本益比']:.2f}",
+            f"{row['每股股利(註)']:.2f}",
+            int(row["股利年度"]),
+            f"{row['殖利率(%)']:.2f}",
+            f"{row['股價淨值比']:.2f}",
+        ]
+        for (_, code), row in peras_df.iterrows()
+    ]
+    return json.dumps({"iTotalRecords": len(rows), "aaData": rows}, ensure_ascii=False)
+
+
+def mops_statement_html(
+    stmts: dict[str, pandas.DataFrame], code: str, ifrs_ts: datetime.datetime
+) -> str:
+    """The statements of `fin_stmts` of a company as the t164sb01 page of MOPS"""
+    year, quarter = util.IFRSDateIter.ifrs_dt2quarter(ifrs_ts)
+
+    def row_of(table_name: str) -> pandas.Series:
+        row = stmts[table_name].loc[(ifrs_ts, code)]
+        return row.drop(["created_ts", "updated_ts"]).dropna()
+
+    def render(title: str, periods: list[str], columns: list[pandas.Series]) -> str:
+        header = "".join(f"<th>{period}</th>" for period in periods)
+        lines = [
+            f'<table class="hasBorder"><tr><th>代號<br>Code</th>'
+            f"<th>會計項目<br>Accounting Title</th>{header}</tr>"
+        ]
+        for i, account in enumerate(columns[0].index):
+            cells = "".join(
+                f"<td>{value:,.0f}</td>" if value >= 0 else f"<td>({-value:,.0f})</td>"
+                for value in (column[account] for column in columns)
+            )
+            lines.append(
+                f'<tr><td>{1000 + i}</td><td><span class="zh">　{account}</span>'
+                f'<span class="en">Account {i}</span></td>{cells}</tr>'
+            )
+        return f"<h2>{title}</h2>" + "\n".join(lines) + "</table>"
+
+    balance = row_of(balance_sheet.BALANCE_TB_NAME)
+    quarter_income = row_of(income_sheet.INCOME_TB_NAME)
+    cumulate_income = row_of(cumulate_income_sheet.CUMULATE_INCOME_TB_NAME)
+    cumulate_income.index = cumulate_income.index.str.removeprefix("累計")
+    cumulate_income = cumulate_income.reindex(quarter_income.index).fillna(0)
+    cash = row_of(cash_flow.CASH_TB_NAME)
+
+    if quarter in (2, 3):
+        income_periods = [
+            f"{year}年第{quarter}季",
+            f"{year - 1}年第{quarter}季",
+            f"{year}年01月01日至{ifrs_ts:%m月%d日}",
+            f"{year - 1}年01月01日至{ifrs_ts:%m月%d日}",
+        ]
+        income_columns = [
+            quarter_income,
+            quarter_income * 0.9,
+            cumulate_income,
+            cumulate_income * 0.9,
+        ]
+    elif quarter == 1:
+        income_periods = [f"{year}年第1季", f"{year - 1}年第1季"]
+        income_columns = [quarter_income, quarter_income * 0.9]
+    else:
+        income_periods = [f"{year}年度", f"{year - 1}年度"]
+        income_columns = [cumulate_income, cumulate_income * 0.9]
+
+    return (
+        f"<html><head><meta charset='UTF-8'><title>{code}</title></head><body>"
+        + render(
+            "資產負債表",
+            [f"{year}年第{quarter}季", f"{year - 1}年度"],
+            [balance, balance * 0.9],
+        )
+        + render("綜合損益表", income_periods, income_columns)
+        + render(
+            "現金流量表",
+            [f"{year}年第{quarter}季", f"{year - 1}年第{quarter}季"],
+            [cash, cash * 0.9],
+        )
+        + "</body></html>"
+    )
+
+
+def mops_revenue_html(
+    revenues_df: pandas.DataFrame, securities_df: pandas.DataFrame
+) -> str:
+    """The revenues of `revenues` of a month as the t21sc03 page of MOPS, by industry"""
+    ts = revenues_df.index.get_level_values(util.TIME_COL_NAME)[0]
+    month = ts - relativedelta(months=1)
+    df = revenues_df.droplevel(util.TIME_COL_NAME)
+    df = df.join(securities_df[["name", "group"]])
+
+    tables = []
+    for group, group_df in df.groupby("group"):
+        lines = [
+            f"<table class='hasBorder'><tr><th colspan='11'>產業別：{group}</th></tr>",
+            "<tr><th rowspan='2'>公司代號</th><th rowspan='2'>公司名稱</th>"
+            "<th colspan='5'>營業收入</th><th colspan='3'>累計營業收入</th>"
+            "<th rowspan='2'>備註</th></tr>",
+            "<tr><th>當月營收</th><th>上月營收</th><th>去年當月營收</th>"
+            "<th>上月比較增減(%)</th><th>去年同月增減(%)</th><th>當月累計營收</th>"
+            "<th>去年累計營收</th><th>前期比較增減(%)</th></tr>",
+        ]
+        for code, row in group_df.iterrows():
+            values = [
+                row["當月營收"],
+                row["當月營收"] * 0.95,
+                row["當月營收"] * 0.9,
+                5.26,
+                11.11,
+                row["當月累計營收"],
+                row["去年累計營收"],
+                (row["當月累計營收"] / row["去年累計營收"] - 1) * 100,
+            ]
+            cells = "".join(
+                f"<td>{value:,.2f}</td>" if i in (3, 4, 7) else f"<td>{value:,.0f}</td>"
+                for i, value in enumerate(values)
+            )
+            lines.append(
+                f"<tr><td>{code}</td><td>{row['name']}</td>{cells}<td>-</td></tr>"
+            )
+        subtotal = group_df[revenue.REVENUE_TB_COLs].sum()
+        lines.append(
+            f"<tr><th>合計</th><th></th><td>{subtotal['當月營收']:,.0f}</td>"
+            + "<td></td>" * 4
+            + f"<td>{subtotal['當月累計營收']:,.0f}</td>"
+            f"<td>{subtotal['去年累計營收']:,.0f}</td><td></td><td></td></tr>"
+        )
+        tables.append("\n".join(lines) + "</table>")
+
+    return (
+        "<html><head><meta charset='UTF-8'></head><body>"
+        f"<center>{month.year - 1911}年{month.month}月</center>"
+        + "".join(tables)
+        + "</body></html>"
+    )
@@ -0,0 +1,48 @@
+import argparse
+import datetime
+import logging
+import traceback
+
+from dateutil.relativedelta import relativedelta
+
+from stock_tw import util
+from stock_tw.變易.fin_stmt import account_store, cumulate_income_sheet, income_sheet
+
+
+def main(stime: datetime.datetime):
+    conn = util.get_sqlite3()
+    try:
+        # Extract the year to date, also of the quarter before `stime`
+        cumulate_df = cumulate_income_sheet.read_sql(
+            conn, start_time=stime - relativedelta(months=5)
+        )
+        logging.info(f"Extracted the year to date {len(cumulate_df)} rows")
+
+        # Derive the single quarters since `stime`, only the accounts of a year to date
+        # as the crawled values of the others are kept
+        df = income_sheet.derive(cumulate_df, columns=income_sheet.DERIVABLE_COLs)
+        df = df[df.index.get_level_values(util.TIME_COL_NAME) >= stime]
+
+        count = income_sheet.write_sqlite3(df, conn)
+        logging.info(f"Write table `{income_sheet.INCOME_TB_NAME}` {count} rows")
+        count = account_store.write_sqlite3(df, conn, income_sheet.INCOME_TB_NAME)
+        logging.info(
+            f"Write `{income_sheet.INCOME_TB_NAME}` {count} values into the account store"
+        )
+    except Exception:
+        logging.error(traceback.format_exc())
+        raise
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-sdate",
+        help="The first date of the derived statements in format 'YYYY-MM-DD'",
+        default="2013-01-01",
+    )
+    args = parser.parse_args()
+
+    main(datetime.datetime.strptime(args.sdate, "%Y-%m-%d"))
@@ -0,0 +1,48 @@
+import argparse
+import datetime
+import logging
+import traceback
+
+from stock_tw import util
+from stock_tw.變易 import warehouse
+
+
+def main(stime: datetime.datetime, table_names: list[str], parquet_dir: str = None):
+    connection = util.DB_ENGINE.connect()
+    conn = util.get_sqlite3()
+    duck = warehouse.connect()
+    try:
+        counts = warehouse.mirror(duck, connection, conn, stime, table_names)
+        logging.info(f"Mirrored the tables into DuckDB {counts}")
+        if parquet_dir:
+            paths = warehouse.export_parquet(duck, parquet_dir)
+            logging.info(f"Export {len(paths)} Parquet files into `{parquet_dir}`")
+    except Exception:
+        logging.error(traceback.format_exc())
+        raise
+    finally:
+        duck.close()
+        conn.close()
+        connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-sdate",
+        help="The first date of the mirrored rows in format 'YYYY-MM-DD'",
+        default="2018-01-01",
+    )
+    parser.add_argument(
+        "-tables",
+        nargs="*",
+        choices=warehouse.TB_NAMEs,
+        default=warehouse.TB_NAMEs,
+        help="The mirrored tables, default all of them",
+    )
+    parser.add_argument(
+        "-parquet", help="Also export the tables into this directory as Parquet"
+    )
+    args = parser.parse_args()
+
+    main(datetime.datetime.strptime(args.sdate, "%Y-%m-%d"), args.tables, args.parquet)
@@ -1,15 +1,35 @@
+"""
+Rows of a table upserted within a time window.
+
+Without `-format`, the keys of the rows are printed as one JSON document. With
+`-format ndjson` or `-format arrow` (requires pyarrow), the rows are streamed from a
+server-side cursor in `-batch-size` chunks as a change feed, ordered by
+(updated_ts, code, ts). The position after the last row is a cursor token, printed
+to stderr and kept in `-cursor-file`, so a consumer polls the feed incrementally:
+
+    python bin/query_upsert.py daily_price -format ndjson -cursor-file feed.cursor
+"""
+
 import argparse
+import base64
 import calendar
 import datetime
 import json
 import logging
+import os
+import os.path
+import sys
 import traceback
+from typing import Iterator, Optional
 
 import pandas
 import pytz
+import sqlalchemy
 
 from stock_tw import util
 
+FEED_ORDER_COLs = ["updated_ts", util.SECURITY_ID_NAME, util.TIME_COL_NAME]
+
 
 def main(table_name, stime: datetime.datetime, etime: datetime.datetime):
     sql = f"""
@@ -40,11 +60,175 @@ def main(table_name, stime: datetime.datetime, etime: datetime.datetime):
     print(json.dumps(output, indent=2))
 
 
+def encode_cursor(row: pandas.Series) -> str:
+    position = {
+        "updated_ts": row["updated_ts"].isoformat(),
+        "code": str(row[util.SECURITY_ID_NAME]),
+        "ts": row[util.TIME_COL_NAME].isoformat(),
+    }
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_cursor(token: str) -> dict:
+    try:
+        position = json.loads(base64.urlsafe_b64decode(token.encode()))
+        return {
+            "updated_ts": datetime.datetime.fromisoformat(position["updated_ts"]),
+            "code": position["code"],
+            "ts": datetime.datetime.fromisoformat(position["ts"]),
+        }
+    except (ValueError, KeyError, TypeError):
+        raise util.YiException(f"Invalid cursor token `{token}`.")
+
+
+def iter_changes(
+    connection: sqlalchemy.Connection,
+    table_name: str,
+    stime: datetime.datetime,
+    etime: datetime.datetime,
+    cursor: Optional[dict],
+    columns: Optional[list[str]],
+    batch_size: int,
+) -> Iterator[pandas.DataFrame]:
+    """Rows after `cursor` (or since `stime`) until `etime`, `batch_size` at a time"""
+    if columns is not None:
+        # The cursor is taken from the order columns of the last row
+        columns = list(dict.fromkeys(FEED_ORDER_COLs + columns))
+    _fields = "*" if columns is None else ", ".join(f"`{c}`" for c in columns)
+    # Expanded from (updated_ts, code, ts) > (...), which MySQL cannot range scan
+    after_cursor = """
+        AND `updated_ts` >= :updated_ts
+        AND (
+            `updated_ts` > :updated_ts
+            OR `code` > :code
+            OR (`code` = :code AND `ts` > :ts)
+        )"""
+    sql_stmt = f"""
+    SELECT {_fields}
+        FROM `{table_name}`
+    WHERE 1
+        AND `updated_ts` >= :stime
+        AND `updated_ts` <= :etime
+        {after_cursor if cursor else ""}
+    ORDER BY `updated_ts`, `code`, `ts`
+    ;"""
+    params = {"stime": stime, "etime": etime, **(cursor or {})}
+
+    # A server-side cursor, MySQLdb fetches the rows as they are read
+    streaming = connection.execution_options(stream_results=True)
+    yield from pandas.read_sql(
+        sqlalchemy.text(sql_stmt),
+        con=streaming,
+        params=params,
+        parse_dates=["updated_ts", "created_ts", util.TIME_COL_NAME],
+        chunksize=batch_size,
+    )
+
+
+def write_ndjson(chunks: Iterator[pandas.DataFrame], fp) -> Optional[pandas.Series]:
+    last_row = None
+    for chunk in chunks:
+        if chunk.empty:
+            continue
+        fp.write(
+            chunk.to_json(
+                orient="records",
+                lines=True,
+                date_format="iso",
+                date_unit="s",
+                force_ascii=False,
+            )
+        )
+        last_row = chunk.iloc[-1]
+
+    return last_row
+
+
+def write_arrow(chunks: Iterator[pandas.DataFrame], fp) -> Optional[pandas.Series]:
+    import pyarrow
+
+    last_row, writer = None, None
+    try:
+        for chunk in chunks:
+            if chunk.empty:
+                continue
+            if writer is None:
+                schema = pyarrow.Schema.from_pandas(chunk, preserve_index=False)
+                writer = pyarrow.ipc.new_stream(fp, schema)
+            batch = pyarrow.RecordBatch.from_pandas(
+                chunk, schema=schema, preserve_index=False
+            )
+            writer.write_batch(batch)
+            last_row = chunk.iloc[-1]
+    finally:
+        writer and writer.close()
+
+    return last_row
+
+
+def stream(
+    table_name: str,
+    stime: datetime.datetime,
+    etime: datetime.datetime,
+    output_format: str,
+    cursor_token: Optional[str],
+    cursor_file: Optional[str],
+    columns: Optional[list[str]],
+    batch_size: int,
+):
+    if cursor_token is None and cursor_file and os.path.exists(cursor_file):
+        with open(cursor_file) as fp:
+            cursor_token = fp.read().strip() or None
+    cursor = decode_cursor(cursor_token) if cursor_token else None
+
+    connection = None
+    try:
+        connection = util.DB_ENGINE.connect()
+        chunks = iter_changes(
+            connection, table_name, stime, etime, cursor, columns, batch_size
+        )
+        if output_format == "arrow":
+            last_row = write_arrow(chunks, sys.stdout.buffer)
+            sys.stdout.buffer.flush()
+        else:
+            last_row = write_ndjson(chunks, sys.stdout)
+            sys.stdout.flush()
+    except Exception:
+        logging.error(traceback.format_exc())
+        raise
+    finally:
+        connection and connection.close()
+
+    # No new rows, the consumer resumes from the same position
+    next_token = cursor_token if last_row is None else encode_cursor(last_row)
+    if next_token:
+        print(f"cursor: {next_token}", file=sys.stderr)
+    if cursor_file and next_token:
+        with open(f"{cursor_file}.tmp", "w") as fp:
+            fp.write(next_token)
+        os.replace(f"{cursor_file}.tmp", cursor_file)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("table_name", help="query table name")
     parser.add_argument("-stime", help="start time in format 'YYYY-mm-ddTHH:MM:SS'")
     parser.add_argument("-etime", help="end time in format 'YYYY-mm-ddTHH:MM:SS'")
+    parser.add_argument(
+        "-format",
+        choices=["ndjson", "arrow"],
+        help="stream the rows as a change feed instead of one JSON document",
+    )
+    parser.add_argument("-cursor", help="resume the change feed after this token")
+    parser.add_argument(
+        "-cursor-file", help="read the cursor token from and save the next one to it"
+    )
+    parser.add_argument(
+        "-columns",
+        nargs="*",
+        help="columns of the change feed, default all, e.g. 收盤價 成交股數",
+    )
+    parser.add_argument("-batch-size", type=int, default=10000)
     args = parser.parse_args()
 
     now = datetime.datetime.now(tz=pytz.timezone("Asia/Taipei")).replace(tzinfo=None)
@@ -58,6 +242,9 @@ if __name__ == "__main__":
     # Determine start time, parse from command line or use today
     if args.stime:
         start_time = datetime.datetime.strptime(args.stime, "%Y-%m-%dT%H:%M:%S")
+    elif args.format and (args.cursor or args.cursor_file):
+        # The cursor is the lower bound of a change feed
+        start_time = datetime.datetime(1990, 1, 1)
     else:
         start_time = datetime.datetime(now.year, now.month, now.day)
         if (
@@ -68,4 +255,16 @@ if __name__ == "__main__":
             start_time -= datetime.timedelta(days=weekday - 4)
             logging.info(f"Shift `{weekday - 4}` days")
 
-    main(args.table_name, start_time, end_time)
+    if args.format:
+        stream(
+            args.table_name,
+            start_time,
+            end_time,
+            args.format,
+            args.cursor,
+            args.cursor_file,
+            args.columns,
+            args.batch_size,
+        )
+    else:
+        main(args.table_name, start_time, end_time)
@@ -0,0 +1,48 @@
+import argparse
+import datetime
+import logging
+import traceback
+
+from stock_tw.變易 import adjusted, price
+from stock_tw import util
+
+
+def main(stime: datetime.datetime):
+    connection = None
+    db_proxy = None
+    try:
+        # Extract the price history
+        logging.info(f"Extract prices since `{stime}`")
+        connection = util.DB_ENGINE.connect()
+        df = price.read_sql(conn=connection, start_time=stime)
+        logging.info(f"Extracted data {len(df)} rows")
+
+        # Calculate the adjustments
+        event_df, adjusted_df = adjusted.calculate(df)
+
+        # Transform and load data into DB
+        db_proxy = util.get_db_proxy()
+        for table_name, _df in [
+            (adjusted.ADJUSTMENT_TB_NAME, event_df),
+            (adjusted.ADJUSTED_PRICE_TB_NAME, adjusted_df),
+        ]:
+            count = util.upsert(db_proxy, _df, table_name)
+            logging.info(f"Upsert table `{table_name}` {count} rows")
+    except Exception:
+        logging.error(traceback.format_exc())
+        raise
+    finally:
+        db_proxy and db_proxy.close()
+        connection and connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-sdate",
+        help="The first date of the adjusted prices in format 'YYYY-MM-DD'",
+        default="2010-01-01",
+    )
+    args = parser.parse_args()
+
+    main(datetime.datetime.strptime(args.sdate, "%Y-%m-%d"))
@@ -0,0 +1,63 @@
+import argparse
+import datetime
+import logging
+import traceback
+
+from stock_tw import util
+from stock_tw.變易.fin_stmt import (
+    account_store,
+    balance_sheet,
+    cash_flow,
+    cumulate_income_sheet,
+    income_sheet,
+)
+
+READERs = {
+    balance_sheet.BALANCE_TB_NAME: balance_sheet.read_sql,
+    income_sheet.INCOME_TB_NAME: income_sheet.read_sql,
+    cumulate_income_sheet.CUMULATE_INCOME_TB_NAME: cumulate_income_sheet.read_sql,
+    cash_flow.CASH_TB_NAME: cash_flow.read_sql,
+}
+
+
+def main(table_names: list[str], stime: datetime.datetime):
+    conn = util.get_sqlite3()
+    try:
+        for table_name in table_names:
+            if not util.is_table_existed_in_sqlite3(table_name, con=conn):
+                logging.warning(f"Skip table `{table_name}`, not existed")
+                continue
+
+            # Extract the wide table
+            df = READERs[table_name](conn, start_time=stime)
+            logging.info(f"Extracted table `{table_name}` {len(df)} rows")
+
+            # Load it into the account store a quarter at a time
+            count = 0
+            for _, quarter_df in df.groupby(level=util.TIME_COL_NAME):
+                count += account_store.write_sqlite3(quarter_df, conn, table_name)
+            logging.info(f"Write `{table_name}` {count} values into the account store")
+    except Exception:
+        logging.error(traceback.format_exc())
+        raise
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-tables",
+        nargs="*",
+        choices=list(READERs),
+        default=list(READERs),
+        help="The statement tables, default all of them",
+    )
+    parser.add_argument(
+        "-sdate",
+        help="The first date of the statements in format 'YYYY-MM-DD'",
+        default="1990-01-01",
+    )
+    args = parser.parse_args()
+
+    main(args.tables, datetime.datetime.strptime(args.sdate, "%Y-%m-%d"))
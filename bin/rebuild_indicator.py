@@ -0,0 +1,51 @@
+import argparse
+import datetime
+import logging
+import traceback
+
+from stock_tw.變易 import indicator, price
+from stock_tw import util
+
+
+def main(stime: datetime.datetime):
+    connection = None
+    db_proxy = None
+    try:
+        # Extract the price history
+        logging.info(f"Extract prices since `{stime}`")
+        connection = util.DB_ENGINE.connect()
+        df = price.read_sql(conn=connection, start_time=stime)
+        logging.info(f"Extracted data {len(df)} rows")
+
+        # Replay it into a new state
+        state = indicator.new_state()
+        indicator_df = indicator.replay(state, df)
+
+        # Load the indicators of every replayed day into DB
+        db_proxy = util.get_db_proxy()
+        count = util.upsert(db_proxy, indicator_df, indicator.INDICATOR_TB_NAME)
+        logging.info(f"Upsert table `{indicator.INDICATOR_TB_NAME}` {count} rows")
+
+        indicator.save_state(state)
+        logging.info(
+            f"Saved the state of {len(state['codes'])} securities to"
+            f" `{indicator.get_state_path()}`"
+        )
+    except Exception:
+        logging.error(traceback.format_exc())
+        raise
+    finally:
+        db_proxy and db_proxy.close()
+        connection and connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-sdate",
+        help="The start date of the replayed prices in format 'YYYY-MM-DD'",
+        default="2010-01-01",
+    )
+    args = parser.parse_args()
+
+    main(datetime.datetime.strptime(args.sdate, "%Y-%m-%d"))
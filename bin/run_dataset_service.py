@@ -0,0 +1,22 @@
+import argparse
+
+from stock_tw import service
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-host", default="127.0.0.1")
+    parser.add_argument("-port", type=int, default=service.DEFAULT_PORT)
+    parser.add_argument(
+        "-reload",
+        type=int,
+        default=0,
+        help="Minutes between two reloads of the frames, 0 is never",
+    )
+    parser.add_argument(
+        "-share",
+        action="store_true",
+        help="Also publish the frames into shared memory for the processes of the host",
+    )
+    args = parser.parse_args()
+
+    service.serve(args.host, args.port, args.reload, args.share)
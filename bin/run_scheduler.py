@@ -0,0 +1,17 @@
+import argparse
+
+from stock_tw import scheduler
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-datasets",
+        nargs="*",
+        help="The datasets to schedule, default all, e.g. daily_price pera",
+    )
+    parser.add_argument(
+        "-poll", type=int, default=60, help="Seconds between two scans of the jobs"
+    )
+    args = parser.parse_args()
+
+    scheduler.run(args.datasets, args.poll)
@@ -3,54 +3,22 @@ import datetime
 import logging
 import traceback
 
-import numpy as np
 import pytz
 
-from stock_tw import util
-from stock_tw.變易.fin_stmt import balance_sheet
+from stock_tw import ingest, util
 
 
 def main(ts: datetime.datetime):
-    db_proxy = None
+    conns = ingest.Connections()
     try:
-        # Extract DataFrame from SQLite3
-        logging.info(f"Extract `{ts}`")
-        conn = util.get_sqlite3()
-        sql_stmt = f"""
-            SELECT `ts`, `code`, `資產總計` 
-            FROM {balance_sheet.BALANCE_TB_NAME}
-            WHERE `ts` = '{ts}';
-        """
-        df = balance_sheet.read_sql(conn=conn, sql_stmt=sql_stmt)
-        conn.close()
-        logging.info(f"Extracted data {len(df)} rows")
-
-        db_proxy = util.get_db_proxy()
-        # Transform DataFrame
-        _reset_df = df.replace({np.nan: None})
-        _reset_df.reset_index(inplace=True)
-        table_content = [list(_reset_df.columns)]
-        table_content.extend(list(row) for row in _reset_df.values)
-        table_unique_keys = list(df.index.names)
-
-        # Load data into DB
-        count = db_proxy.todb(
-            table_content,
-            unique_key=table_unique_keys,
-            table_name=f"{balance_sheet.BALANCE_TB_NAME}_metatime",
-            mode="UPDATE",
-        )
-        logging.info(
-            f"upsert table `{balance_sheet.BALANCE_TB_NAME}_metatime`"
-            f" {count} rows"
-        )
+        ingest.load_balance_sheet_metatime(conns, ts)
     except util.YiException as e:
         logging.warning(str(e))
     except Exception:
         logging.error(traceback.format_exc())
         raise
     finally:
-        db_proxy and db_proxy.close()
+        conns.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,53 @@
+import argparse
+import datetime
+
+import pytz
+
+from stock_tw import ingest, util
+
+
+def main(ts: datetime.datetime, codes: list[str], workers: int, interval: float):
+    conns = ingest.Connections()
+    try:
+        ingest.load_fin_stmts(conns, ts, codes, workers, interval)
+    finally:
+        conns.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-quarter", help="The year and quarter values, example: 20231")
+    parser.add_argument(
+        "-codes", nargs="*", help="The companies, default all the listed stocks"
+    )
+    parser.add_argument(
+        "-workers", type=int, default=4, help="The number of concurrent requests"
+    )
+    parser.add_argument(
+        "-interval",
+        type=float,
+        default=1.0,
+        help="Seconds between two requests to MOPS",
+    )
+    args = parser.parse_args()
+
+    year: int
+    quarter: int
+    if args.quarter:
+        year, quarter = int(args.quarter[:4]), int(args.quarter[4])
+        # in case '20230' -> '20224'
+        if quarter == 0:
+            year -= 1
+            quarter = 4
+    else:
+        now = datetime.datetime.now(tz=pytz.timezone("Asia/Taipei")).replace(
+            tzinfo=None
+        )
+        year = now.year
+        quarter = now.month // 3
+        if quarter == 0:
+            year -= 1
+            quarter = 4
+
+    ifrs_dt: datetime = util.IFRSDateIter(year, quarter).current_ifrs_dt()
+    main(ifrs_dt, args.codes, args.workers, args.interval)
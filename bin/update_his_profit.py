@@ -0,0 +1,40 @@
+import argparse
+import logging
+import traceback
+
+from stock_tw import ingest, util
+from stock_tw.變易 import profit
+
+
+def main(rebuild: bool):
+    if rebuild:
+        # Forget the rows and the watermarks, the refresh computes every quarter again
+        conn = util.get_sqlite3()
+        try:
+            profit.create_tables(conn)
+            conn.execute(f"DELETE FROM `{profit.HIS_PROFIT_TB_NAME}`;")
+            conn.execute(f"DELETE FROM `{profit.WATERMARK_TB_NAME}`;")
+            conn.commit()
+        finally:
+            conn.close()
+
+    conns = ingest.Connections()
+    try:
+        ingest.load_his_profits(conns)
+    except Exception:
+        logging.error(traceback.format_exc())
+        raise
+    finally:
+        conns.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-rebuild",
+        action="store_true",
+        help="Compute every quarter, not only those touched since the watermarks",
+    )
+    args = parser.parse_args()
+
+    main(args.rebuild)
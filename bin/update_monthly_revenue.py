@@ -4,47 +4,31 @@ import logging
 import time
 import traceback
 
-import numpy as np
 from dateutil.relativedelta import relativedelta
 
-from stock_tw.變易 import revenue
-from stock_tw import util
+from stock_tw import ingest, util
 
 
 def main(stime: datetime.datetime, etime: datetime.datetime):
-    while stime <= etime:
-        db_proxy = None
-        try:
-            # Extract DataFrame from internet
-            logging.info(f"Extract `{stime}`")
-            df = revenue.extract(stime)
-            logging.info(f"Extracted data {len(df)} rows")
-
-            # Transform DataFrame
-            _reset_df = df.replace({np.nan: None})
-            _reset_df.reset_index(inplace=True)
-            table_content = [list(_reset_df.columns)]
-            table_content.extend(list(row) for row in _reset_df.values)
-            table_unique_keys = list(df.index.names)
-
-            # Load data into DB
-            db_proxy = util.get_db_proxy()
-            count = db_proxy.todb(
-                table_content,
-                unique_key=table_unique_keys,
-                table_name=revenue.REVENUE_TB_NAME,
-                mode="UPDATE",
-            )
-            logging.info(f"upsert table `{revenue.REVENUE_TB_NAME}` {count} rows")
-        except util.YiException as e:
-            logging.warning(str(e))
-        except Exception:
-            logging.error(traceback.format_exc())
-            raise
-        finally:
-            db_proxy and db_proxy.close()
-        time.sleep(10)
-        stime += relativedelta(months=1)
+    conns = ingest.Connections()
+    try:
+        while stime <= etime:
+            # Polled by cron until the 12th, done once every company reported
+            if ingest.is_revenue_complete(conns, stime):
+                logging.info(f"The revenues of `{stime}` are complete")
+                stime += relativedelta(months=1)
+                continue
+            try:
+                ingest.load_revenues(conns, stime)
+            except util.YiException as e:
+                logging.warning(str(e))
+            except Exception:
+                logging.error(traceback.format_exc())
+                raise
+            time.sleep(10)
+            stime += relativedelta(months=1)
+    finally:
+        conns.close()
 
 
 if __name__ == "__main__":
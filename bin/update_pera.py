@@ -4,40 +4,25 @@ import logging
 import time
 import traceback
 
-import numpy as np
 import pytz
 from dateutil.relativedelta import relativedelta
 
-from stock_tw.變易 import pera
-from stock_tw import util
+from stock_tw import ingest, util
 
 
 def main(stime: datetime.datetime, etime: datetime.datetime):
     max_retry, retry = 10, 0
+    conns = ingest.Connections()
     while stime <= etime and retry < 10:
-        db_proxy = None
         try:
-            # Extract DataFrame from internet
-            logging.info(f"Extract date `{stime}`")
-            df = pera.extract(stime)
-            logging.info(f"Extracted data {len(df)} rows")
-
-            # Transform DataFrame
-            _reset_df = df.replace({np.nan: None})
-            _reset_df.reset_index(inplace=True)
-            table_content = [list(_reset_df.columns)]
-            table_content.extend(list(row) for row in _reset_df.values)
-            table_unique_keys = list(df.index.names)
-
-            # Load data into DB
-            db_proxy = util.get_db_proxy()
-            count = db_proxy.todb(
-                table_content,
-                unique_key=table_unique_keys,
-                table_name=pera.PERA_TB_NAME,
-                mode="UPDATE",
-            )
-            logging.info(f"Upsert table `{pera.PERA_TB_NAME}` {count} rows")
+            for market in ingest.MARKETs:
+                try:
+                    ingest.load_peras(conns, stime, market)
+                except util.YiException as e:
+                    # TPEX publishes later than TWSE, go on without it
+                    if market == "twse":
+                        raise
+                    logging.warning(str(e))
             tmp = stime + relativedelta(years=1)
             stime = datetime.datetime(tmp.year, 12, 31)
             retry = 0
@@ -47,9 +32,9 @@ def main(stime: datetime.datetime, etime: datetime.datetime):
             retry += 1
         except Exception:
             logging.error(traceback.format_exc())
-        finally:
-            db_proxy and db_proxy.close()
+            conns.close()
         time.sleep(15)
+    conns.close()
 
 
 if __name__ == "__main__":
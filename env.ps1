@@ -2,3 +2,4 @@ $env:PYTHONPATH = "."
 $env:STORAGE_ROOT = ".\usr\data\"
 $env:CONF_PATH = ".\usr\share\etc\config.yaml"
 $env:DB_CONF_PATH = ".\usr\share\etc\dbconfig.yaml"
+$env:METRICS_DIR = ".\usr\data\metrics\"
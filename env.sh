@@ -2,3 +2,4 @@ export PYTHONPATH=.
 export STORAGE_ROOT=./usr/data/
 export CONF_PATH=./usr/share/etc/config.yaml
 export DB_CONF_PATH=./usr/share/etc/dbconfig.yaml
+export METRICS_DIR=./usr/data/metrics/
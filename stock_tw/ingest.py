@@ -0,0 +1,262 @@
+"""
+The ETL of the daily jobs, one partition (date, market) per call, shared by the bin
+scripts and the resident scheduler.
+
+The DB handles are passed in as `Connections`, so a process running many jobs keeps
+them open between the jobs instead of connecting for every one of them.
+"""
+
+import dataclasses
+import datetime
+import logging
+from typing import Optional
+
+import dbman
+import numpy
+import pandas
+import sqlalchemy
+from dateutil.relativedelta import relativedelta
+
+from stock_tw import instrument, util
+from stock_tw.變易 import adjusted, indicator, pera, price, profit, revenue, security
+from stock_tw.變易.fin_stmt import balance_sheet, mops
+
+MARKETs = ["twse", "tpex"]
+
+
+@dataclasses.dataclass
+class Connections:
+    """DB handles opened on first use and kept until `close`"""
+
+    _db_proxy: Optional[dbman.DBProxy] = None
+    _connection: Optional[sqlalchemy.Connection] = None
+
+    def get_db_proxy(self) -> dbman.DBProxy:
+        if self._db_proxy is None:
+            self._db_proxy = util.get_db_proxy()
+        return self._db_proxy
+
+    def get_connection(self) -> sqlalchemy.Connection:
+        """
+        The connection out of the transaction the reads before left open, so a read on
+        it sees the upserts of `db_proxy` since, not the snapshot of REPEATABLE READ
+        """
+        if self._connection is None:
+            self._connection = util.DB_ENGINE.connect()
+        self.end_reads()
+        return self._connection
+
+    def end_reads(self):
+        """Ends the transaction the reads on the connection left open, if any"""
+        if self._connection is not None and self._connection.in_transaction():
+            self._connection.rollback()
+
+    def close(self):
+        self._db_proxy and self._db_proxy.close()
+        self._connection and self._connection.close()
+        self._db_proxy = None
+        self._connection = None
+
+
+def load_prices(
+    conns: Connections,
+    ts: datetime.datetime,
+    market: str,
+    indicator_state: dict[str, numpy.ndarray],
+    derive: bool = True,
+) -> int:
+    """Loads the prices of the partition, and derives the tables of them if `derive`"""
+    # Extract DataFrame from internet
+    logging.info(f"Extract prices of `{market}` at `{ts}`")
+    with instrument.stage("extract", table=price.PRICE_TB_NAME) as record:
+        df = price.extract_market(ts, market)
+        record.rows = len(df)
+    logging.info(f"Extracted data {len(df)} rows")
+
+    # Transform and load data into DB
+    count = util.upsert(conns.get_db_proxy(), df, price.PRICE_TB_NAME)
+    logging.info(f"Upsert table `{price.PRICE_TB_NAME}` {count} rows")
+
+    if derive:
+        try:
+            derive_prices(conns, ts, df, indicator_state)
+        except util.YiException as e:
+            # The day is published and loaded, a derive refused is no absence of it
+            raise ValueError(f"Derive prices of `{market}` at `{ts}`, {e}") from e
+    return count
+
+
+def derive_prices(
+    conns: Connections,
+    ts: datetime.datetime,
+    df: pandas.DataFrame,
+    indicator_state: dict[str, numpy.ndarray],
+):
+    """
+    The adjusted prices and indicators of the day `ts`, the days must come in order,
+    `adjusted.calculate` raises `YiException` if a day before was not derived, and
+    `indicator.update` if a later day of another market advanced the state already
+    """
+    # Adjust the day from the last adjusted rows before it
+    last_df = adjusted.read_last(conns.get_connection(), ts)
+    event_df, adjusted_df = adjusted.calculate(df, last_df)
+    for table_name, _df in [
+        (adjusted.ADJUSTMENT_TB_NAME, event_df),
+        (adjusted.ADJUSTED_PRICE_TB_NAME, adjusted_df),
+    ]:
+        _count = util.upsert(conns.get_db_proxy(), _df, table_name)
+        logging.info(f"Upsert table `{table_name}` {_count} rows")
+
+    # Advance the indicators by the day, persist the state after loading them
+    indicator_df = indicator.update(indicator_state, df)
+    _count = util.upsert(
+        conns.get_db_proxy(), indicator_df, indicator.INDICATOR_TB_NAME
+    )
+    logging.info(f"Upsert table `{indicator.INDICATOR_TB_NAME}` {_count} rows")
+    indicator.save_state(indicator_state)
+
+
+def load_peras(conns: Connections, ts: datetime.datetime, market: str) -> int:
+    logging.info(f"Extract PER analyses of `{market}` at `{ts}`")
+    with instrument.stage("extract", table=pera.PERA_TB_NAME) as record:
+        df = pera.extract_market(ts, market)
+        record.rows = len(df)
+    logging.info(f"Extracted data {len(df)} rows")
+
+    count = util.upsert(conns.get_db_proxy(), df, pera.PERA_TB_NAME)
+    logging.info(f"Upsert table `{pera.PERA_TB_NAME}` {count} rows")
+    return count
+
+
+def load_revenues(conns: Connections, ts: datetime.datetime) -> int:
+    """
+    Loads the revenues of `ts` which are new or corrected since the last poll, as
+    `util.upsert` sends only the changed rows, until every listed stock reported them
+    """
+    conn = util.get_sqlite3()
+    try:
+        reported = revenue.read_reported(conn, ts)
+        if is_revenue_complete(conns, ts, reported):
+            logging.info(f"Every listed stock reported the revenues of `{ts}`")
+            return 0
+
+        logging.info(f"Extract revenues `{ts}`, {len(reported)} reported before")
+        with instrument.stage("extract", table=revenue.REVENUE_TB_NAME) as record:
+            df = revenue.extract(ts)
+            record.rows = len(df)
+        logging.info(f"Extracted data {len(df)} rows")
+
+        count = util.upsert(conns.get_db_proxy(), df, revenue.REVENUE_TB_NAME)
+        logging.info(f"Upsert table `{revenue.REVENUE_TB_NAME}` {count} rows")
+        revenue.write_reported(
+            conn, ts, list(df.index.get_level_values(util.SECURITY_ID_NAME))
+        )
+    finally:
+        conn.close()
+
+    load_his_profits(conns)
+    return count
+
+
+def is_revenue_complete(
+    conns: Connections, ts: datetime.datetime, reported: set[str] = None
+) -> bool:
+    """Whether every stock listed before the month of `ts` reported its revenue"""
+    if reported is None:
+        conn = util.get_sqlite3()
+        try:
+            reported = revenue.read_reported(conn, ts)
+        finally:
+            conn.close()
+
+    month = util.time2monthly_date(ts) - relativedelta(months=1)
+    codes = set(get_listed_stocks(conns, month.replace(day=1)))
+    return bool(codes) and codes <= reported
+
+
+def get_listed_stocks(
+    conns: Connections, before: Optional[datetime.datetime] = None
+) -> list[str]:
+    """The codes of the stocks of TWSE and TPEX, listed before `before` if given"""
+    securities = security.read_sql(conns.get_connection(), ["股票"])
+    securities = securities[securities["market"].isin(["上市", "上櫃"])]
+    if before is not None:
+        starts = pandas.to_datetime(securities["start"], errors="coerce")
+        securities = securities[starts < before]
+    return list(securities.index)
+
+
+def load_securities(conns: Connections) -> int:
+    with instrument.stage("extract", table=security.SECURITY_TB_NAME) as record:
+        df = security.extract_securities()
+        record.rows = len(df)
+    logging.info(f"Extracted data {len(df)} rows")
+
+    count = util.upsert(conns.get_db_proxy(), df, security.SECURITY_TB_NAME)
+    logging.info(f"Upsert table `{security.SECURITY_TB_NAME}` {count} rows")
+    return count
+
+
+def load_balance_sheet_metatime(conns: Connections, ifrs_ts: datetime.datetime) -> int:
+    """Copy the keys of the `ifrs_ts` statements in SQLite3 to MySQL, which stamps them"""
+    table_name = f"{balance_sheet.BALANCE_TB_NAME}_metatime"
+    logging.info(f"Extract `{ifrs_ts}`")
+    sql_stmt = f"""
+        SELECT `ts`, `code`, `資產總計`
+        FROM {balance_sheet.BALANCE_TB_NAME}
+        WHERE `ts` = '{ifrs_ts}';
+    """
+    conn = util.get_sqlite3()
+    try:
+        with instrument.stage("extract", table=table_name) as record:
+            df = balance_sheet.read_sql(conn=conn, sql_stmt=sql_stmt)
+            record.rows = len(df)
+    finally:
+        conn.close()
+    logging.info(f"Extracted data {len(df)} rows")
+
+    count = util.upsert(conns.get_db_proxy(), df, table_name)
+    logging.info(f"Upsert table `{table_name}` {count} rows")
+
+    load_his_profits(conns)
+    return count
+
+
+def load_his_profits(conns: Connections) -> int:
+    """Recomputes the quarters of `his_profit` touched since its watermarks"""
+    connection = conns.get_connection()
+    conn = util.get_sqlite3()
+    try:
+        with instrument.stage("transform", table=profit.HIS_PROFIT_TB_NAME) as record:
+            count = profit.refresh(conn, connection)
+            record.rows = count
+    finally:
+        conn.close()
+        # End the transaction of the reads, the next one sees the upserts since
+        connection.rollback()
+    logging.info(f"Recompute table `{profit.HIS_PROFIT_TB_NAME}` {count} quarters")
+    return count
+
+
+def load_fin_stmts(
+    conns: Connections,
+    ifrs_ts: datetime.datetime,
+    codes: list[str] = None,
+    workers: int = 4,
+    interval: float = 1.0,
+) -> dict[str, int]:
+    """Crawl the statements of the listed companies into SQLite3, see `mops.crawl`"""
+    if codes is None:
+        codes = get_listed_stocks(conns)
+
+    conn = util.get_sqlite3()
+    try:
+        with instrument.stage("extract", table="fin_stmt") as record:
+            counts = mops.crawl(conn, ifrs_ts, codes, workers, interval)
+            record.rows = counts.get(mops.STATUS_FILED, 0)
+    finally:
+        conn.close()
+    logging.info(f"Crawled the statements of `{ifrs_ts}` {counts}")
+
+    load_his_profits(conns)
+    return counts
@@ -0,0 +1,132 @@
+"""
+Timing of named ETL stages (fetch, parse, coerce, transform, load).
+
+    with instrument.stage("fetch", source="twse_price") as record:
+        response = requests.get(url)
+        record.bytes = len(response.content)
+
+Every finished stage is logged. When `METRICS_DIR` is set, it is also appended as a JSON
+line to `stages.jsonl` there, and the running totals of the process are rewritten to
+`<job>.prom` for the node-exporter textfile collector, where `<job>` is the name of
+the running script.
+"""
+
+import contextlib
+import dataclasses
+import datetime
+import json
+import logging
+import os
+import os.path
+import sys
+import threading
+import time
+from typing import Iterator, Optional
+
+JSONL_FILE_NAME = "stages.jsonl"
+
+_totals: dict[tuple, dict[str, float]] = {}
+# The stages finish in the worker threads of the pipeline and of the crawlers
+_lock = threading.Lock()
+
+
+@dataclasses.dataclass
+class Stage:
+    name: str
+    labels: dict[str, str]
+    rows: Optional[int] = None
+    bytes: Optional[int] = None
+    seconds: float = 0.0
+    status: str = "ok"
+
+
+@contextlib.contextmanager
+def stage(name: str, **labels) -> Iterator[Stage]:
+    record = Stage(name=name, labels={key: str(value) for key, value in labels.items()})
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException:
+        record.status = "error"
+        raise
+    finally:
+        record.seconds = time.perf_counter() - start
+        _emit(record)
+
+
+def get_job_name() -> str:
+    return os.path.splitext(os.path.basename(sys.argv[0]))[0] or "python"
+
+
+def _emit(record: Stage):
+    logging.debug(
+        f"Stage `{record.name}` {record.labels} {record.status} in"
+        f" {record.seconds:.3f}s, rows={record.rows} bytes={record.bytes}"
+    )
+
+    metrics_dir = os.getenv("METRICS_DIR")
+    if not metrics_dir:
+        return
+
+    line = {
+        "time": datetime.datetime.now().isoformat(),
+        "job": get_job_name(),
+        "stage": record.name,
+        **record.labels,
+        "status": record.status,
+        "seconds": round(record.seconds, 6),
+        "rows": record.rows,
+        "bytes": record.bytes,
+    }
+    key = (record.name, record.status, tuple(sorted(record.labels.items())))
+    with _lock:
+        os.makedirs(metrics_dir, exist_ok=True)
+        with open(
+            os.path.join(metrics_dir, JSONL_FILE_NAME), "a", encoding="UTF-8"
+        ) as fp:
+            fp.write(json.dumps(line, ensure_ascii=False) + "\n")
+
+        totals = _totals.setdefault(
+            key,
+            {"runs": 0, "seconds": 0.0, "rows": 0, "bytes": 0, "last_seconds": 0.0},
+        )
+        totals["runs"] += 1
+        totals["seconds"] += record.seconds
+        totals["rows"] += record.rows or 0
+        totals["bytes"] += record.bytes or 0
+        totals["last_seconds"] = record.seconds
+        _write_textfile(metrics_dir)
+
+
+def _write_textfile(metrics_dir: str):
+    """Rewrites the totals, called with `_lock` held"""
+    job = get_job_name()
+    metrics = [
+        ("stock_tw_stage_runs_total", "counter", "runs"),
+        ("stock_tw_stage_seconds_total", "counter", "seconds"),
+        ("stock_tw_stage_rows_total", "counter", "rows"),
+        ("stock_tw_stage_bytes_total", "counter", "bytes"),
+        ("stock_tw_stage_last_seconds", "gauge", "last_seconds"),
+    ]
+
+    lines = []
+    for metric, kind, field in metrics:
+        lines.append(f"# TYPE {metric} {kind}")
+        for (name, status, labels), totals in list(_totals.items()):
+            all_labels = [("job", job), ("stage", name), ("status", status), *labels]
+            label_str = ",".join(
+                f'{key}="{_escape(value)}"' for key, value in all_labels
+            )
+            lines.append(f"{metric}{{{label_str}}} {totals[field]}")
+
+    # The collector may read at any time, so write aside and rename, apart from the
+    # other processes of the job
+    path = os.path.join(metrics_dir, f"{job}.prom")
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="UTF-8") as fp:
+        fp.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, path)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -0,0 +1,333 @@
+"""
+A pipelined backfill of many partitions (date, market) in place of extracting, parsing
+and loading them one after another.
+
+    counts = pipeline.run(pipeline.get_dataset("daily_price", indicator_state), dates)
+
+Fetcher threads download the payloads, parser threads turn them into frames and one
+loader thread, which owns the DB connections, upserts the frames in batches, all at the
+same time. The stages are joined by bounded queues, so a slow stage blocks the ones
+before it instead of piling payloads up in memory, and the requests to each market are
+spaced by `fetch_interval` seconds, the rate limit of the exchanges.
+
+A partition not published (`YiException`), e.g. a holiday, is absent. A partition
+failing with any other error is put back to the stage it failed in after a backoff,
+while the others go on, and is failed after `max_attempts`. The derived tables, e.g.
+the adjusted prices, depend on the days before, so the loader derives a date only when
+every partition up to it is settled, and no more dates of a market once a partition of
+it failed, or its derive did, the days after are left to be derived after the day
+missed is loaded again.
+"""
+
+import collections
+import dataclasses
+import datetime
+import logging
+import queue
+import threading
+import traceback
+from typing import Any, Callable, Optional
+
+import numpy
+import pandas
+
+from stock_tw import ingest, util
+from stock_tw.變易 import pera, price
+
+STATUS_LOADED = "loaded"
+STATUS_ABSENT = "absent"
+STATUS_FAILED = "failed"
+
+BACKOFF_INITIAL = 5.0
+BACKOFF_MAX = 120.0
+
+
+@dataclasses.dataclass
+class Dataset:
+    name: str
+    fetch: Callable[[datetime.datetime, str], Any]
+    parse: Callable[[Any, datetime.datetime, str], pandas.DataFrame]
+    # Upserts the frames of a batch of partitions at once, returns the number of rows
+    load: Callable[[ingest.Connections, pandas.DataFrame], int]
+    # Derives the tables of a date from its loaded frames, the dates come in order
+    derive: Optional[
+        Callable[[ingest.Connections, datetime.datetime, pandas.DataFrame], None]
+    ] = None
+
+
+@dataclasses.dataclass
+class Partition:
+    ts: datetime.datetime
+    market: str
+    attempts: int = 0
+    payload: Any = None
+    df: Optional[pandas.DataFrame] = None
+
+
+def get_dataset(name: str, indicator_state: dict[str, numpy.ndarray] = None) -> Dataset:
+    def upsert(
+        table_name: str,
+    ) -> Callable[[ingest.Connections, pandas.DataFrame], int]:
+        def load(conns: ingest.Connections, df: pandas.DataFrame) -> int:
+            count = util.upsert(conns.get_db_proxy(), df, table_name)
+            logging.info(f"Upsert table `{table_name}` {count} rows")
+            return count
+
+        return load
+
+    if name == price.PRICE_TB_NAME:
+        return Dataset(
+            name=name,
+            fetch=price.fetch_market,
+            parse=price.parse_market,
+            load=upsert(price.PRICE_TB_NAME),
+            derive=lambda conns, ts, df: ingest.derive_prices(
+                conns, ts, df, indicator_state
+            ),
+        )
+    if name == pera.PERA_TB_NAME:
+        return Dataset(
+            name=name,
+            fetch=pera.fetch_market,
+            parse=pera.parse_market,
+            load=upsert(pera.PERA_TB_NAME),
+        )
+    raise util.YiException(f"Unknown dataset `{name}`.")
+
+
+class Pipeline:
+    def __init__(
+        self,
+        dataset: Dataset,
+        partitions: list[Partition],
+        fetchers: int,
+        parsers: int,
+        batch_size: int,
+        queue_size: int,
+        fetch_interval: float,
+        max_attempts: int,
+    ):
+        self.dataset = dataset
+        self.partitions = partitions
+        self.fetchers = fetchers
+        self.parsers = parsers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+
+        # Partitions are small, only the queues of payloads and frames are bounded
+        self.fetch_queue: queue.Queue = queue.Queue()
+        self.parse_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.load_queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.throttles = collections.defaultdict(lambda: util.Throttle(fetch_interval))
+
+        self.statuses: dict[tuple[datetime.datetime, str], str] = {}
+        self._unsettled = len(partitions)
+        self._lock = threading.Lock()
+        # Dates not derived yet, oldest first, with their loaded frames
+        self._derive_dates = sorted({partition.ts for partition in partitions})
+        self._derive_frames = collections.defaultdict(dict)
+        # Markets not derived any more, after a day of them failed
+        self._underived_markets: set[str] = set()
+
+    def run(self) -> dict[str, int]:
+        workers = [
+            threading.Thread(target=self._fetch, name=f"fetch-{i}")
+            for i in range(self.fetchers)
+        ]
+        workers += [
+            threading.Thread(target=self._parse, name=f"parse-{i}")
+            for i in range(self.parsers)
+        ]
+        workers.append(threading.Thread(target=self._load, name="load"))
+        for worker in workers:
+            worker.start()
+
+        if not self.partitions:
+            self._stop()
+        for partition in self.partitions:
+            self.fetch_queue.put(partition)
+        for worker in workers:
+            worker.join()
+
+        return dict(collections.Counter(self.statuses.values()))
+
+    def _fetch(self):
+        while (partition := self.fetch_queue.get()) is not None:
+            self.throttles[partition.market].wait()
+            try:
+                partition.payload = self.dataset.fetch(partition.ts, partition.market)
+            except Exception as e:
+                self._fail(partition, e, self.fetch_queue)
+                continue
+            self.parse_queue.put(partition)
+
+    def _parse(self):
+        while (partition := self.parse_queue.get()) is not None:
+            try:
+                partition.df = self.dataset.parse(
+                    partition.payload, partition.ts, partition.market
+                )
+            except Exception as e:
+                # The payload may be truncated, download it again
+                self._fail(partition, e, self.fetch_queue)
+                continue
+            finally:
+                partition.payload = None
+            self.load_queue.put(partition)
+
+    def _load(self):
+        conns = ingest.Connections()
+        try:
+            stopped = False
+            while not stopped:
+                batch = []
+                try:
+                    # Wake up now and then to derive the dates settled meanwhile
+                    batch.append(self.load_queue.get(timeout=1))
+                    while len(batch) < self.batch_size:
+                        batch.append(self.load_queue.get_nowait())
+                except queue.Empty:
+                    pass
+                if batch and batch[-1] is None:
+                    stopped = True
+                    batch.pop()
+                if batch:
+                    self._load_batch(conns, batch)
+                self._derive(conns)
+        finally:
+            conns.close()
+
+    def _load_batch(self, conns: ingest.Connections, batch: list[Partition]):
+        try:
+            self.dataset.load(conns, pandas.concat([p.df for p in batch]))
+        except Exception as e:
+            # The error may have broken a connection
+            conns.close()
+            for partition in batch:
+                self._fail(partition, e, self.load_queue)
+            return
+
+        for partition in batch:
+            if self.dataset.derive:
+                self._derive_frames[partition.ts][partition.market] = partition.df
+            partition.df = None
+            self._settle(partition, STATUS_LOADED)
+
+    def _derive(self, conns: ingest.Connections):
+        if self.dataset.derive is None:
+            return
+        while self._derive_dates:
+            ts = self._derive_dates[0]
+            with self._lock:
+                settled = all(
+                    self.statuses.get((partition.ts, partition.market))
+                    for partition in self.partitions
+                    if partition.ts <= ts
+                )
+                failed_markets = {
+                    partition.market
+                    for partition in self.partitions
+                    if partition.ts == ts
+                    and self.statuses.get((partition.ts, partition.market))
+                    == STATUS_FAILED
+                }
+            if not settled:
+                return
+            self._derive_dates.pop(0)
+            self._stop_deriving(ts, failed_markets)
+            frames = {
+                market: df
+                for market, df in self._derive_frames.pop(ts, {}).items()
+                if market not in self._underived_markets
+            }
+            if not frames:
+                continue
+            try:
+                self.dataset.derive(conns, ts, pandas.concat(frames.values()))
+            except Exception:
+                logging.error(traceback.format_exc())
+                conns.close()
+                self._stop_deriving(ts, set(frames))
+            else:
+                # The next date reads the rows derived for this one
+                conns.end_reads()
+
+    def _stop_deriving(self, ts: datetime.datetime, markets: set[str]):
+        if markets - self._underived_markets:
+            logging.error(
+                f"Stop deriving {sorted(markets - self._underived_markets)} of"
+                f" `{self.dataset.name}` from {ts:%Y-%m-%d} on, derive them after"
+                " the day is loaded again"
+            )
+        self._underived_markets |= markets
+
+    def _fail(self, partition: Partition, e: Exception, retry_queue: queue.Queue):
+        key = f"({self.dataset.name}, {partition.ts:%Y-%m-%d}, {partition.market})"
+        if isinstance(e, util.YiException) and retry_queue is self.fetch_queue:
+            # Not published, e.g. a holiday
+            logging.warning(f"Partition {key} is absent, {e}")
+            self._settle(partition, STATUS_ABSENT)
+            return
+
+        partition.attempts += 1
+        if partition.attempts >= self.max_attempts:
+            logging.error(f"Partition {key} failed {partition.attempts} times, {e!r}")
+            self._settle(partition, STATUS_FAILED)
+            return
+
+        backoff = min(BACKOFF_INITIAL * 2 ** (partition.attempts - 1), BACKOFF_MAX)
+        logging.warning(f"Retry partition {key} in {backoff}s, {e!r}")
+        # Put back from a timer, the workers go on with the other partitions
+        timer = threading.Timer(backoff, retry_queue.put, (partition,))
+        timer.daemon = True
+        timer.start()
+
+    def _settle(self, partition: Partition, status: str):
+        with self._lock:
+            self.statuses[(partition.ts, partition.market)] = status
+            self._unsettled -= 1
+            done = self._unsettled == 0
+        logging.info(
+            f"Partition ({self.dataset.name}, {partition.ts:%Y-%m-%d},"
+            f" {partition.market}) is {status}"
+        )
+        if done:
+            self._stop()
+
+    def _stop(self):
+        # Every partition is settled, nothing is in the queues any more
+        for _ in range(self.fetchers):
+            self.fetch_queue.put(None)
+        for _ in range(self.parsers):
+            self.parse_queue.put(None)
+        self.load_queue.put(None)
+
+
+def run(
+    dataset: Dataset,
+    dates: list[datetime.datetime],
+    markets: list[str] = None,
+    fetchers: int = 2,
+    parsers: int = 2,
+    batch_size: int = 10,
+    queue_size: int = 4,
+    fetch_interval: float = 5.0,
+    max_attempts: int = 5,
+) -> dict[str, int]:
+    """Loads the partitions of `dates` and `markets`, returns the counts of the statuses"""
+    partitions = [
+        Partition(ts, market)
+        for ts in sorted(dates)
+        for market in markets or ingest.MARKETs
+    ]
+    logging.info(f"Run {len(partitions)} partitions of `{dataset.name}` in a pipeline")
+    return Pipeline(
+        dataset,
+        partitions,
+        fetchers,
+        parsers,
+        batch_size,
+        queue_size,
+        fetch_interval,
+        max_attempts,
+    ).run()
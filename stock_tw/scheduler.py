@@ -0,0 +1,347 @@
+"""
+A resident scheduler of the ingestion jobs, in place of polling them from cron.
+
+A job covers partitions (dataset, date, market) and every attempt on a partition is
+recorded in the ledger table `ingest_ledger` of the SQLite3 database:
+
+    final    loaded after the source is complete, never polled again
+    partial  loaded while the source may still change, e.g. revenues before the 10th
+             day, polled again after the `interval` of the job
+    waiting  not published yet (`YiException`), retried with exponential backoff
+    absent   still not published `ABSENT_AFTER` its date, e.g. a holiday, not polled
+    failed   any other error, retried with the same backoff as waiting
+
+The derived tables of a day, e.g. the adjusted prices, depend on the day before, and the
+indicators advance one state of every market a day at a time, so a partition whose
+previous weekday is not final or absent in every market yet is loaded by
+`load_underived`, without them, and stays partial until it is loaded after.
+
+All the jobs run in one process and share one `ingest.Connections`, which is reopened
+only after an error.
+"""
+
+import dataclasses
+import datetime
+import logging
+import os
+import os.path
+import sqlite3
+import time
+import traceback
+from typing import Callable, Optional
+
+import pandas
+import pytz
+from dateutil.relativedelta import relativedelta
+
+from stock_tw import ingest, util
+from stock_tw.變易 import indicator
+
+LEDGER_TB_NAME = "ingest_ledger"
+LOCK_FILE_NAME = "scheduler.lock"
+
+STATUS_FINAL = "final"
+STATUS_PARTIAL = "partial"
+STATUS_WAITING = "waiting"
+STATUS_ABSENT = "absent"
+STATUS_FAILED = "failed"
+
+BACKOFF_INITIAL = datetime.timedelta(minutes=10)
+BACKOFF_MAX = datetime.timedelta(hours=2)
+ABSENT_AFTER = datetime.timedelta(days=2)
+# Days of the past a job still polls when the scheduler was down
+LOOKBACK_DAYS = 7
+
+
+@dataclasses.dataclass
+class Job:
+    dataset: str
+    markets: list[str]
+    # The dates due at a time
+    partitions: Callable[[datetime.datetime], list[datetime.datetime]]
+    # Loads one partition and returns the number of rows
+    load: Callable[[ingest.Connections, datetime.datetime, str], int]
+    # A partition loaded at or after this time of its date is final
+    final_after: Callable[[datetime.datetime], datetime.datetime]
+    # The time between two loads of a partial partition
+    interval: datetime.timedelta
+    # Loads one partition without the tables derived from the days before
+    load_underived: Optional[
+        Callable[[ingest.Connections, datetime.datetime, str], int]
+    ] = None
+
+
+def now_in_taipei() -> datetime.datetime:
+    return datetime.datetime.now(tz=pytz.timezone("Asia/Taipei")).replace(tzinfo=None)
+
+
+def trading_days(
+    now: datetime.datetime, publish_time: datetime.time
+) -> list[datetime.datetime]:
+    """Weekdays of the last `LOOKBACK_DAYS` days, today only after `publish_time`"""
+    today = datetime.datetime(now.year, now.month, now.day)
+    days = [today - datetime.timedelta(days=n) for n in range(LOOKBACK_DAYS, -1, -1)]
+    return [
+        day
+        for day in days
+        if day.weekday() < 5 and (day < today or now.time() >= publish_time)
+    ]
+
+
+def revenue_months(now: datetime.datetime) -> list[datetime.datetime]:
+    """The revenues of last month, published from the 1st to the 10th of this month"""
+    this_month = util.time2monthly_date(now)
+    return [this_month - relativedelta(months=1), this_month]
+
+
+def ifrs_quarters(now: datetime.datetime) -> list[datetime.datetime]:
+    """The statements of the quarter whose deadline is the nearest ahead"""
+    year, quarter = now.year, now.month // 3
+    if quarter == 0:
+        year, quarter = year - 1, 4
+    return [util.IFRSDateIter(year, quarter).current_ifrs_dt()]
+
+
+def get_jobs(indicator_state: dict) -> list[Job]:
+    def load_prices(conns, ts, market, derive=True):
+        return ingest.load_prices(conns, ts, market, indicator_state, derive=derive)
+
+    return [
+        Job(
+            dataset="security_list",
+            markets=["all"],
+            partitions=lambda now: trading_days(now, datetime.time(8, 0))[-1:],
+            load=lambda conns, ts, market: ingest.load_securities(conns),
+            final_after=lambda ts: ts,
+            interval=datetime.timedelta(days=1),
+        ),
+        Job(
+            dataset="daily_price",
+            markets=ingest.MARKETs,
+            partitions=lambda now: trading_days(now, datetime.time(14, 0)),
+            load=load_prices,
+            # Corrections of the day are published until the evening
+            final_after=lambda ts: ts + datetime.timedelta(hours=18),
+            interval=datetime.timedelta(hours=1),
+            load_underived=lambda conns, ts, market: load_prices(
+                conns, ts, market, derive=False
+            ),
+        ),
+        Job(
+            dataset="pera",
+            markets=ingest.MARKETs,
+            partitions=lambda now: trading_days(now, datetime.time(19, 0)),
+            load=ingest.load_peras,
+            final_after=lambda ts: ts + datetime.timedelta(hours=19),
+            interval=datetime.timedelta(hours=1),
+        ),
+        Job(
+            dataset="monthly_revenue",
+            markets=["all"],
+            partitions=revenue_months,
+            load=lambda conns, ts, market: ingest.load_revenues(conns, ts),
+            # Late reports and corrections arrive for a few days after the 10th
+            final_after=lambda ts: ts + datetime.timedelta(days=3),
+            interval=datetime.timedelta(minutes=10),
+        ),
+        Job(
+            dataset="balance_sheet_metatime",
+            markets=["all"],
+            partitions=ifrs_quarters,
+            load=lambda conns, ts, market: ingest.load_balance_sheet_metatime(
+                conns, ts
+            ),
+            final_after=lambda ts: ts + datetime.timedelta(days=3),
+            interval=datetime.timedelta(hours=1),
+        ),
+    ]
+
+
+def create_ledger(conn: sqlite3.Connection):
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS `{LEDGER_TB_NAME}` (
+            `dataset` TEXT NOT NULL,
+            `ts` TEXT NOT NULL,
+            `market` TEXT NOT NULL,
+            `status` TEXT NOT NULL,
+            `attempts` INTEGER NOT NULL,
+            `failures` INTEGER NOT NULL,
+            `rows` INTEGER,
+            `message` TEXT,
+            `updated_ts` TEXT NOT NULL,
+            `next_ts` TEXT,
+            PRIMARY KEY (`dataset`, `ts`, `market`)
+        );""")
+    conn.commit()
+
+
+def read_ledger(
+    conn: sqlite3.Connection, dataset: str = None, status: str = None
+) -> pandas.DataFrame:
+    create_ledger(conn)
+    conditions = {"dataset": dataset, "status": status}
+    where = " ".join(
+        f"AND `{key}` = '{value}'" for key, value in conditions.items() if value
+    )
+    return pandas.read_sql(
+        f"SELECT * FROM `{LEDGER_TB_NAME}` WHERE 1 {where};",
+        con=conn,
+        index_col=["dataset", util.TIME_COL_NAME, "market"],
+        parse_dates=[util.TIME_COL_NAME, "updated_ts", "next_ts"],
+    )
+
+
+def run_partition(
+    job: Job,
+    ts: datetime.datetime,
+    market: str,
+    conns: ingest.Connections,
+    ledger: sqlite3.Connection,
+    now: datetime.datetime,
+) -> Optional[str]:
+    """Loads the partition if it is due, returns its new status or None if not due"""
+    entry = ledger.execute(
+        f"SELECT `status`, `attempts`, `failures`, `next_ts` FROM `{LEDGER_TB_NAME}`"
+        " WHERE `dataset` = ? AND `ts` = ? AND `market` = ?;",
+        (job.dataset, str(ts), market),
+    ).fetchone()
+    status, attempts, failures, next_ts = entry or (None, 0, 0, None)
+    if status in (STATUS_FINAL, STATUS_ABSENT) or (next_ts and str(now) < next_ts):
+        return None
+
+    rows, message = None, None
+    is_derivable = job.load_underived is None or is_previous_settled(
+        job, ts, ledger, now
+    )
+    try:
+        if is_derivable:
+            rows = job.load(conns, ts, market)
+        else:
+            rows = job.load_underived(conns, ts, market)
+            message = "Not derived, the previous weekday is not final or absent yet"
+            logging.warning(f"{message}, ({job.dataset}, {ts:%Y-%m-%d}, {market})")
+        is_final = is_derivable and now >= job.final_after(ts)
+        status = STATUS_FINAL if is_final else STATUS_PARTIAL
+        failures = 0
+        next_ts = None if status == STATUS_FINAL else now + job.interval
+    except util.YiException as e:
+        logging.warning(str(e))
+        status = STATUS_ABSENT if now - ts >= ABSENT_AFTER else STATUS_WAITING
+        message = str(e)
+    except Exception:
+        logging.error(traceback.format_exc())
+        status, message = STATUS_FAILED, traceback.format_exc(limit=1)
+        # The error may have broken a connection
+        conns.close()
+    if status in (STATUS_WAITING, STATUS_FAILED):
+        failures += 1
+        next_ts = now + min(BACKOFF_INITIAL * 2 ** (failures - 1), BACKOFF_MAX)
+
+    ledger.execute(
+        f"INSERT OR REPLACE INTO `{LEDGER_TB_NAME}` VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
+        (
+            job.dataset,
+            str(ts),
+            market,
+            status,
+            attempts + 1,
+            failures,
+            rows,
+            message,
+            str(now),
+            next_ts and str(next_ts),
+        ),
+    )
+    ledger.commit()
+    logging.info(f"Partition ({job.dataset}, {ts:%Y-%m-%d}, {market}) is {status}")
+
+    return status
+
+
+def is_previous_settled(
+    job: Job,
+    ts: datetime.datetime,
+    ledger: sqlite3.Connection,
+    now: datetime.datetime,
+) -> bool:
+    """
+    Whether the partitions of every market of the previous weekday of `ts` are final or
+    absent, or before the partitions of the job, which the scheduler does not poll
+    """
+    previous_ts = ts - datetime.timedelta(days=1)
+    while previous_ts.weekday() >= 5:
+        previous_ts -= datetime.timedelta(days=1)
+    if previous_ts not in job.partitions(now):
+        return True
+
+    statuses = dict(
+        ledger.execute(
+            f"SELECT `market`, `status` FROM `{LEDGER_TB_NAME}`"
+            " WHERE `dataset` = ? AND `ts` = ?;",
+            (job.dataset, str(previous_ts)),
+        ).fetchall()
+    )
+    return all(
+        statuses.get(market) in (STATUS_FINAL, STATUS_ABSENT) for market in job.markets
+    )
+
+
+def run_once(
+    jobs: list[Job],
+    conns: ingest.Connections,
+    ledger: sqlite3.Connection,
+    now: datetime.datetime = None,
+) -> int:
+    """Loads every due partition once, oldest dates first, returns how many were run"""
+    now = now or now_in_taipei()
+    count = 0
+    for job in jobs:
+        for ts in job.partitions(now):
+            for market in job.markets:
+                if run_partition(job, ts, market, conns, ledger, now):
+                    count += 1
+
+    return count
+
+
+def run(datasets: list[str] = None, poll_seconds: int = 60):
+    lock_fp = _lock()
+    if lock_fp is None:
+        logging.info("Another scheduler is running, exit")
+        return
+
+    indicator_state = indicator.load_state()
+    jobs = [
+        job
+        for job in get_jobs(indicator_state)
+        if not datasets or job.dataset in datasets
+    ]
+    conns = ingest.Connections()
+    ledger = util.get_sqlite3()
+    create_ledger(ledger)
+    logging.info(f"Schedule jobs {[job.dataset for job in jobs]}")
+    try:
+        while True:
+            run_once(jobs, conns, ledger)
+            time.sleep(poll_seconds)
+    finally:
+        conns.close()
+        ledger.close()
+        lock_fp.close()
+
+
+def _lock():
+    """An exclusive lock of the STORAGE_ROOT, None if held by another process"""
+    lock_fp = open(os.path.join(os.getenv("STORAGE_ROOT"), LOCK_FILE_NAME), "w")
+    try:
+        import fcntl
+    except ImportError:
+        # Windows, go without the lock
+        return lock_fp
+
+    try:
+        fcntl.flock(lock_fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_fp.close()
+        return None
+    return lock_fp
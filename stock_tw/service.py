@@ -0,0 +1,326 @@
+"""
+A local read-only service of the `dataset` frames, which are loaded and analyzed once
+and kept warm in one process, so that notebooks and scripts query slices of them in
+place of each importing `dataset` and holding its own copy.
+
+    python bin/run_dataset_service.py -port 8801 -reload 60
+    df = service.query("prices", stime="2024-05-01", codes=["2330"], columns=["收盤價"])
+
+`GET /frames` lists the frames with their index names, columns and rows, and
+`GET /frames/<name>?stime=&etime=&codes=&columns=&format=` returns a slice of a frame as
+an Arrow IPC stream (the default) or as Parquet. `stime` and `etime` bound the `ts`
+level inclusively, `codes` and `columns` are comma separated. Answers are cached by
+their query until the frames are reloaded. Requires pyarrow.
+
+With `-share`, the frames of `dataset.SHARED_FRAME_NAMEs` are also published into
+shared memory on every load, for processes of the host which attach them zero-copy by
+`sharedmem.attach_published` in place of querying.
+"""
+
+import datetime
+import functools
+import http.server
+import importlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+import urllib.parse
+from typing import Optional
+
+import numpy
+import pandas
+import requests
+
+from stock_tw import util
+
+DEFAULT_PORT = 8801
+
+FRAME_NAMEs = [
+    "securities",
+    "prices",
+    "peras",
+    "revenues",
+    "income_sheets",
+    "cumulate_income_sheets",
+    "balance_sheets",
+    "balance_sheet_metatime",
+    "cash_flows",
+    "daily_price",
+    "his_profits",
+    "anal_per",
+    "anal_revenue",
+    "anal_profit",
+]
+
+CONTENT_TYPEs = {
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+# Answers of the latest queries, a full `prices` may take hundreds of MB
+CACHE_SIZE = 64
+
+
+def load_frames() -> dict[str, pandas.DataFrame]:
+    """Loads and analyzes `dataset`, again on every call after the first one"""
+    if "stock_tw.變易.dataset" in sys.modules:
+        dataset = sys.modules["stock_tw.變易.dataset"]
+        # The reload forgets the frames published in shared memory, free them before
+        dataset.release_shared()
+        dataset = importlib.reload(dataset)
+    else:
+        from stock_tw.變易 import dataset
+
+    try:
+        dataset.analyze_profit()
+    except KeyError as e:
+        # Fewer than five quarters of statements
+        logging.warning(f"Skip `anal_profit`, missing {e}")
+
+    return {
+        name: getattr(dataset, name) for name in FRAME_NAMEs if hasattr(dataset, name)
+    }
+
+
+def select(
+    df: pandas.DataFrame,
+    stime: Optional[datetime.datetime] = None,
+    etime: Optional[datetime.datetime] = None,
+    codes: Optional[list[str]] = None,
+    columns: Optional[list[str]] = None,
+) -> pandas.DataFrame:
+    mask = numpy.ones(len(df), dtype=bool)
+    if stime or etime:
+        if util.TIME_COL_NAME not in df.index.names:
+            raise util.YiException(
+                f"The frame is not indexed by `{util.TIME_COL_NAME}`."
+            )
+        ts = df.index.get_level_values(util.TIME_COL_NAME)
+        if stime:
+            mask &= ts >= stime
+        if etime:
+            mask &= ts <= etime
+    if codes:
+        if util.SECURITY_ID_NAME not in df.index.names:
+            raise util.YiException(
+                f"The frame is not indexed by `{util.SECURITY_ID_NAME}`."
+            )
+        mask &= df.index.get_level_values(util.SECURITY_ID_NAME).isin(codes)
+    if columns:
+        unknown_columns = [column for column in columns if column not in df.columns]
+        if unknown_columns:
+            raise util.YiException(f"Unknown columns {unknown_columns}.")
+
+    return df.loc[mask, columns or list(df.columns)]
+
+
+def serialize(df: pandas.DataFrame, output_format: str) -> bytes:
+    import pyarrow
+    import pyarrow.parquet
+
+    # The index is kept, `to_pandas` restores it
+    table = pyarrow.Table.from_pandas(df, preserve_index=True)
+    sink = pyarrow.BufferOutputStream()
+    if output_format == "parquet":
+        pyarrow.parquet.write_table(table, sink)
+    else:
+        with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def deserialize(content: bytes, output_format: str) -> pandas.DataFrame:
+    import pyarrow
+    import pyarrow.parquet
+
+    if output_format == "parquet":
+        table = pyarrow.parquet.read_table(pyarrow.BufferReader(content))
+    else:
+        table = pyarrow.ipc.open_stream(content).read_all()
+    return table.to_pandas()
+
+
+class DatasetServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], share: bool = False):
+        super().__init__(address, DatasetHandler)
+        self.share = share
+        self.frames: dict[str, pandas.DataFrame] = {}
+        self.generation = 0
+        self._lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        """Swaps in newly loaded frames, queries in flight finish on the old ones"""
+        start = time.perf_counter()
+        frames = load_frames()
+        if self.share:
+            dataset = sys.modules["stock_tw.變易.dataset"]
+            names = [name for name in dataset.SHARED_FRAME_NAMEs if name in frames]
+            logging.info(
+                f"Published frames {names} in `{dataset.publish_shared(names)}`"
+            )
+        with self._lock:
+            self.frames = frames
+            self.generation += 1
+            self.answer.cache_clear()
+        logging.info(
+            f"Loaded frames {list(frames)} in {time.perf_counter() - start:.1f}s"
+        )
+
+    def describe(self) -> dict:
+        return {
+            name: {
+                "index": list(df.index.names),
+                "columns": list(df.columns),
+                "rows": len(df),
+            }
+            for name, df in self.frames.items()
+        }
+
+    @functools.lru_cache(maxsize=CACHE_SIZE)
+    def answer(
+        self,
+        generation: int,
+        name: str,
+        stime: Optional[datetime.datetime],
+        etime: Optional[datetime.datetime],
+        codes: Optional[tuple[str, ...]],
+        columns: Optional[tuple[str, ...]],
+        output_format: str,
+    ) -> bytes:
+        # `generation` only keys the cache, entries of the old frames are never hit
+        df = select(
+            self.frames[name],
+            stime,
+            etime,
+            codes and list(codes),
+            columns and list(columns),
+        )
+        return serialize(df, output_format)
+
+
+class DatasetHandler(http.server.BaseHTTPRequestHandler):
+    server: DatasetServer
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == "/frames":
+            body = json.dumps(self.server.describe(), ensure_ascii=False)
+            self._send(200, body.encode("UTF-8"), "application/json; charset=utf-8")
+            return
+
+        name = urllib.parse.unquote(url.path.removeprefix("/frames/"))
+        if not url.path.startswith("/frames/") or name not in self.server.frames:
+            self._send(404, f"Unknown frame `{name}`.".encode("UTF-8"))
+            return
+
+        try:
+            query = _parse_query(urllib.parse.parse_qs(url.query))
+            content = self.server.answer(self.server.generation, name, *query)
+        except util.YiException as e:
+            self._send(400, str(e).encode("UTF-8"))
+            return
+        except Exception:
+            logging.error(traceback.format_exc())
+            self._send(500, traceback.format_exc(limit=1).encode("UTF-8"))
+            return
+        self._send(200, content, CONTENT_TYPEs[query[-1]])
+
+    def log_message(self, format: str, *args):
+        logging.debug(f"{self.address_string()} {format % args}")
+
+    def _send(
+        self,
+        status: int,
+        content: bytes,
+        content_type: str = "text/plain; charset=utf-8",
+    ):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def _parse_query(query: dict[str, list[str]]) -> tuple:
+    def get(key: str) -> Optional[str]:
+        return query[key][0] if query.get(key) and query[key][0] else None
+
+    def split(key: str) -> Optional[tuple[str, ...]]:
+        return tuple(get(key).split(",")) if get(key) else None
+
+    try:
+        stime = get("stime") and datetime.datetime.fromisoformat(get("stime"))
+        etime = get("etime") and datetime.datetime.fromisoformat(get("etime"))
+    except ValueError as e:
+        raise util.YiException(str(e))
+    output_format = get("format") or "arrow"
+    if output_format not in CONTENT_TYPEs:
+        raise util.YiException(f"Unknown format `{output_format}`.")
+
+    return stime, etime, split("codes"), split("columns"), output_format
+
+
+def serve(host: str, port: int, reload_minutes: int = 0, share: bool = False):
+    with DatasetServer((host, port), share) as server:
+        if reload_minutes:
+
+            def reload_forever():
+                while True:
+                    time.sleep(reload_minutes * 60)
+                    try:
+                        server.reload()
+                    except Exception:
+                        # Keep answering on the frames loaded before
+                        logging.error(traceback.format_exc())
+
+            threading.Thread(target=reload_forever, daemon=True).start()
+
+        logging.info(f"Serve frames on http://{host}:{port}")
+        try:
+            server.serve_forever()
+        finally:
+            share and sys.modules["stock_tw.變易.dataset"].release_shared()
+
+
+def get_service_url() -> str:
+    return os.getenv("DATASET_SERVICE_URL") or f"http://127.0.0.1:{DEFAULT_PORT}"
+
+
+def list_frames(url: str = None) -> dict:
+    response = requests.get(f"{url or get_service_url()}/frames")
+    response.raise_for_status()
+    return response.json()
+
+
+def query(
+    name: str,
+    stime: Optional[str] = None,
+    etime: Optional[str] = None,
+    codes: Optional[list[str]] = None,
+    columns: Optional[list[str]] = None,
+    output_format: str = "arrow",
+    url: str = None,
+) -> pandas.DataFrame:
+    """A slice of a frame of the service, e.g. query("prices", stime="2024-05-01")"""
+    params = {
+        "stime": stime,
+        "etime": etime,
+        "codes": codes and ",".join(codes),
+        "columns": columns and ",".join(columns),
+        "format": output_format,
+    }
+    response = requests.get(
+        f"{url or get_service_url()}/frames/{urllib.parse.quote(name)}",
+        params={key: value for key, value in params.items() if value},
+    )
+    if response.status_code == 400:
+        raise util.YiException(response.text)
+    response.raise_for_status()
+    return deserialize(response.content, output_format)
@@ -0,0 +1,220 @@
+"""
+Publish pandas frames into named `multiprocessing.shared_memory` blocks and attach
+zero-copy views of them from other processes.
+
+A published frame is described by a small picklable manifest (block names, dtypes,
+shape, index levels and column order), which is all another process needs in order to
+rebuild the frame on top of the same memory. Columns are grouped by dtype and each group
+is stored column-contiguous, so every attached column is a plain view into the block.
+Columns that can not live in a raw buffer (object, string and extension dtypes) are
+left out and listed under `skipped`; index levels are copied out on attach because
+pandas keeps string labels as Python objects.
+
+Processes which are not started by the publisher find the manifests of its frames in a
+JSON file under STORAGE_ROOT, written by `write_manifest` and read by `attach_published`.
+"""
+
+import datetime
+import json
+import os
+import os.path
+import sys
+import uuid
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any
+
+import numpy
+import pandas
+
+from stock_tw import util
+
+MANIFEST_FILE_NAME = "shared_frames.json"
+
+# Handles must outlive the views built on top of them.
+_PUBLISHED: dict[str, list[shared_memory.SharedMemory]] = {}
+_ATTACHED: dict[str, list[shared_memory.SharedMemory]] = {}
+
+
+def publish_frame(df: pandas.DataFrame, prefix: str = None) -> dict[str, Any]:
+    """Copy the numeric columns and the index of `df` into shared memory once."""
+    prefix = prefix or f"stw{uuid.uuid4().hex[:12]}"
+    handles = []
+
+    index = []
+    for i in range(df.index.nlevels):
+        values = df.index.get_level_values(i)
+        array = _to_buffer_array(values.to_numpy())
+        block = _create(f"{prefix}i{i}", array)
+        handles.append(block)
+        index.append(
+            {
+                "name": df.index.names[i],
+                "block": block.name,
+                "dtype": array.dtype.str,
+                "length": len(array),
+            }
+        )
+
+    groups: dict[str, list[str]] = {}
+    skipped = []
+    for column, dtype in df.dtypes.items():
+        if isinstance(dtype, numpy.dtype) and dtype.kind in "biufcmM":
+            groups.setdefault(dtype.str, []).append(column)
+        else:
+            skipped.append(column)
+
+    columns = []
+    for j, (dtype, names) in enumerate(groups.items()):
+        # One row per column, so each column is contiguous in the block
+        array = numpy.ascontiguousarray(df[names].to_numpy(dtype=dtype).T)
+        block = _create(f"{prefix}c{j}", array)
+        handles.append(block)
+        columns.append(
+            {
+                "block": block.name,
+                "dtype": dtype,
+                "shape": array.shape,
+                "columns": names,
+            }
+        )
+
+    _PUBLISHED[prefix] = handles
+    return {
+        "prefix": prefix,
+        "index": index,
+        "columns": columns,
+        "order": [column for column in df.columns if column not in skipped],
+        "skipped": skipped,
+    }
+
+
+def attach_frame(manifest: dict[str, Any]) -> pandas.DataFrame:
+    """Rebuild a published frame whose columns are views into the shared blocks."""
+    handles = []
+
+    levels = []
+    for level in manifest["index"]:
+        block = _open(level["block"])
+        handles.append(block)
+        levels.append(
+            numpy.ndarray(
+                (level["length"],), dtype=numpy.dtype(level["dtype"]), buffer=block.buf
+            )
+        )
+    names = [level["name"] for level in manifest["index"]]
+    if len(levels) == 1:
+        index = pandas.Index(levels[0], name=names[0])
+    else:
+        index = pandas.MultiIndex.from_arrays(levels, names=names)
+
+    views = {}
+    for group in manifest["columns"]:
+        block = _open(group["block"])
+        handles.append(block)
+        array = numpy.ndarray(
+            tuple(group["shape"]), dtype=numpy.dtype(group["dtype"]), buffer=block.buf
+        )
+        for j, column in enumerate(group["columns"]):
+            views[column] = array[j]
+
+    _ATTACHED[manifest["prefix"]] = handles
+    return pandas.DataFrame(
+        {column: views[column] for column in manifest["order"]},
+        index=index,
+        copy=False,
+    )
+
+
+def detach_frame(manifest: dict[str, Any]):
+    """Drop this process's mapping; frames returned by `attach_frame` become invalid."""
+    for block in _ATTACHED.pop(manifest["prefix"], []):
+        block.close()
+
+
+def release_frame(manifest: dict[str, Any]):
+    """Free the blocks of a frame published by this process."""
+    for block in _PUBLISHED.pop(manifest["prefix"], []):
+        if sys.version_info < (3, 13):
+            # Attaching processes may have unregistered the block from a shared
+            # resource tracker, register again so that `unlink` stays balanced.
+            resource_tracker.register(block._name, "shared_memory")
+        block.close()
+        block.unlink()
+
+
+def get_manifest_path() -> str:
+    return os.path.join(os.getenv("STORAGE_ROOT"), MANIFEST_FILE_NAME)
+
+
+def write_manifest(manifests: dict[str, dict[str, Any]], path: str = None) -> str:
+    """Save the manifests of the frames published by this process under their names"""
+    path = path or get_manifest_path()
+    content = {
+        "pid": os.getpid(),
+        "published_ts": datetime.datetime.now().isoformat(timespec="seconds"),
+        "frames": manifests,
+    }
+    # Replaced at once, an attaching process never reads a partial file
+    with open(f"{path}.tmp", "w", encoding="UTF-8") as fp:
+        json.dump(content, fp, ensure_ascii=False)
+    os.replace(f"{path}.tmp", path)
+    return path
+
+
+def remove_manifest(path: str = None):
+    path = path or get_manifest_path()
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def attach_published(
+    names: list[str] = None, path: str = None
+) -> dict[str, pandas.DataFrame]:
+    """Attach the frames listed in the manifest file, all of them by default"""
+    path = path or get_manifest_path()
+    if not os.path.exists(path):
+        raise util.YiException(f"No frames are published, `{path}` does not exist.")
+    with open(path, encoding="UTF-8") as fp:
+        content = json.load(fp)
+
+    unknown_names = set(names or []) - set(content["frames"])
+    if unknown_names:
+        raise util.YiException(f"Frames {unknown_names} are not published.")
+
+    frames = {}
+    for name in names or content["frames"]:
+        try:
+            frames[name] = attach_frame(content["frames"][name])
+        except FileNotFoundError:
+            raise util.YiException(
+                f"The frame `{name}` of process {content['pid']} is gone, publish it"
+                " again."
+            )
+    return frames
+
+
+def _to_buffer_array(values: numpy.ndarray) -> numpy.ndarray:
+    if values.dtype.kind in "biufcmM":
+        return numpy.ascontiguousarray(values)
+    # Labels such as security codes are stored as fixed-width unicode
+    return numpy.asarray(values.astype(str), dtype=str)
+
+
+def _create(name: str, array: numpy.ndarray) -> shared_memory.SharedMemory:
+    block = shared_memory.SharedMemory(
+        name=name, create=True, size=max(array.nbytes, 1)
+    )
+    shared = numpy.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+    shared[...] = array
+    return block
+
+
+def _open(name: str) -> shared_memory.SharedMemory:
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+
+    block = shared_memory.SharedMemory(name=name)
+    # Before Python 3.13 attaching registers the block with the resource tracker of
+    # this process, which would unlink it at exit while the publisher still owns it.
+    resource_tracker.unregister(block._name, "shared_memory")
+    return block
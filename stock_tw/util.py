@@ -2,15 +2,24 @@ import datetime
 import logging
 import os
 import os.path
+import re
 import sqlite3
-from typing import Any, Union
+import threading
+import time
+from typing import Any, Optional, Union
 
 import dbman
 import MySQLdb
+import numpy
 import pandas
+import requests
+import requests.adapters
 import sqlalchemy
+import urllib3.util
 import yaml
 
+from stock_tw import instrument
+
 logging.basicConfig(
     format="[%(asctime)s][%(levelname)s][%(name)s][%(module)s]: %(message)s",
     level=logging.DEBUG,
@@ -19,10 +28,19 @@ logging.basicConfig(
 TIME_COL_NAME = "ts"
 SECURITY_ID_NAME = "code"
 TIMED_INDEX_COLs = [TIME_COL_NAME, SECURITY_ID_NAME]
+# Columns of the statements besides the accounts, kept as read
+STATEMENT_META_COLs = ["created_ts", "updated_ts"]
+
+_PLACEHOLDER_PATTERN = re.compile(r"(?<![:\w]):([A-Za-z_]\w*)")
+
+# Hashes of the rows last upserted into MySQL, cached in SQLite3
+ROW_HASH_TB_NAME = "upsert_row_hash"
 
 CONF: dict[str, Any]
 DB_ENGINE: sqlalchemy.Engine
 
+_http_session: Optional[requests.Session] = None
+
 
 with open(os.getenv("CONF_PATH"), encoding="UTF-8") as _fp:
     CONF = yaml.load(_fp, yaml.SafeLoader)
@@ -50,6 +68,182 @@ def get_db_proxy() -> dbman.DBProxy:
     return dbman.DBProxy(connection=DB_ENGINE.raw_connection())
 
 
+def upsert(
+    db_proxy: dbman.DBProxy,
+    df: pandas.DataFrame,
+    table_name: str,
+    changed_only: bool = True,
+) -> int:
+    """
+    Upsert `df` into the MySQL table `table_name`, unique by the index of `df`.
+
+    With `changed_only`, the rows are hashed and compared with the hashes of the last
+    upsert cached in SQLite3, only new and changed rows are sent, so a rerun of the same
+    data leaves MySQL and the `updated_ts` of its rows untouched. Rows changed by other
+    writers are not seen by the cache, upsert them with `changed_only=False`.
+    """
+    conn = get_sqlite3() if changed_only else None
+    try:
+        if changed_only:
+            with instrument.stage("diff", table=table_name) as record:
+                keys, hashes = _hash_rows(df)
+                changed = _is_changed(conn, table_name, keys, hashes)
+                record.rows = int(changed.sum())
+            logging.debug(f"Changed rows of `{table_name}` {changed.sum()}/{len(df)}")
+            df, keys, hashes = df[changed], keys[changed], hashes[changed]
+            if df.empty:
+                return 0
+
+        with instrument.stage("transform", table=table_name) as record:
+            _reset_df = df.replace({numpy.nan: None})
+            _reset_df.reset_index(inplace=True)
+            table_content = [list(_reset_df.columns)]
+            table_content.extend(list(row) for row in _reset_df.values)
+            table_unique_keys = list(df.index.names)
+            record.rows = len(df)
+
+        with instrument.stage("load", table=table_name) as record:
+            count = db_proxy.todb(
+                table_content,
+                unique_key=table_unique_keys,
+                table_name=table_name,
+                mode="UPDATE",
+            )
+            record.rows = count
+
+        # Cache the hashes only once the rows are loaded
+        if changed_only:
+            _write_row_hashes(conn, table_name, keys, hashes)
+    finally:
+        conn and conn.close()
+
+    return count
+
+
+def _hash_rows(df: pandas.DataFrame) -> tuple[numpy.ndarray, numpy.ndarray]:
+    """Keys of the index as strings and int64 hashes of the values and column names"""
+    keys = df.index.get_level_values(0).astype(str)
+    for level in range(1, df.index.nlevels):
+        keys = keys + "|" + df.index.get_level_values(level).astype(str)
+
+    # Hash numbers as float, so a column turning float by a NaN still matches
+    numeric_columns = df.select_dtypes(["number", "bool"]).columns
+    values = df.astype(dict.fromkeys(numeric_columns, "float64"))
+    hashes = pandas.util.hash_pandas_object(values, index=False).to_numpy()
+    columns_hash = pandas.util.hash_array(numpy.array(["|".join(map(str, df.columns))]))
+    return keys.to_numpy(dtype=str), (hashes ^ columns_hash).view(numpy.int64)
+
+
+def _is_changed(
+    conn: sqlite3.Connection,
+    table_name: str,
+    keys: numpy.ndarray,
+    hashes: numpy.ndarray,
+) -> numpy.ndarray:
+    _create_row_hash_table(conn)
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS `_upsert_keys` (`key` TEXT);")
+    conn.execute("DELETE FROM `_upsert_keys`;")
+    conn.executemany("INSERT INTO `_upsert_keys` VALUES (?);", ((k,) for k in keys))
+    cached = conn.execute(
+        f"SELECT h.`key`, h.`hash` FROM `{ROW_HASH_TB_NAME}` AS h"
+        " JOIN `_upsert_keys` AS k ON h.`key` = k.`key`"
+        " WHERE h.`table_name` = ?;",
+        (table_name,),
+    ).fetchall()
+
+    if not cached:
+        return numpy.ones(len(keys), dtype=bool)
+
+    cached_keys = pandas.Index([key for key, _ in cached])
+    cached_hashes = numpy.array([value for _, value in cached], dtype=numpy.int64)
+    positions = cached_keys.get_indexer(keys)
+    found = positions >= 0
+    return ~found | (cached_hashes[numpy.where(found, positions, 0)] != hashes)
+
+
+def _write_row_hashes(
+    conn: sqlite3.Connection,
+    table_name: str,
+    keys: numpy.ndarray,
+    hashes: numpy.ndarray,
+):
+    conn.executemany(
+        f"INSERT OR REPLACE INTO `{ROW_HASH_TB_NAME}` VALUES (?, ?, ?);",
+        ((table_name, key, int(value)) for key, value in zip(keys, hashes)),
+    )
+    conn.commit()
+
+
+def _create_row_hash_table(conn: sqlite3.Connection):
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS `{ROW_HASH_TB_NAME}` (
+            `table_name` TEXT NOT NULL,
+            `key` TEXT NOT NULL,
+            `hash` INTEGER NOT NULL,
+            PRIMARY KEY (`table_name`, `key`)
+        ) WITHOUT ROWID;""")
+
+
+def get_exchange_url(exchange: str) -> str:
+    """
+    Base URL of `exchange` ("TWSE", "TPEX" or "MOPS") from the config, the environment
+    variable `<exchange>_URL` overrides it, e.g. to point the crawlers at `bench.exchange`.
+    """
+    return (os.getenv(f"{exchange}_URL") or CONF[f"{exchange}網址"]).rstrip("/")
+
+
+def get_http_session() -> requests.Session:
+    """A shared session retrying connection errors, 429 and 5xx with backoff"""
+    global _http_session
+    if _http_session is None:
+        retry = urllib3.util.Retry(
+            total=CONF["HTTP重試次數"],
+            backoff_factor=CONF["HTTP重試間隔"],
+            status_forcelist=[429, 500, 502, 503, 504],
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = requests.adapters.HTTPAdapter(max_retries=retry)
+        _http_session = requests.Session()
+        _http_session.mount("https://", adapter)
+        _http_session.mount("http://", adapter)
+
+    return _http_session
+
+
+def fetch(url: str, source: str, html: bool = False) -> requests.Response:
+    """
+    GET `url` as the `fetch` stage of `source`, raise if not answered with data, which
+    is expected not to be an HTML page unless `html`.
+    """
+    with instrument.stage("fetch", source=source) as record:
+        response = get_http_session().get(url, timeout=CONF["HTTP逾時"])
+        record.bytes = len(response.content)
+
+    response.raise_for_status()
+    # The exchanges answer blocked or malformed requests with an HTML page and 200 OK
+    if not html and response.text.lstrip()[:1] == "<":
+        raise YiException(f"An HTML page instead of data is responded from `{url}`.")
+
+    return response
+
+
+class Throttle:
+    """Spaces the calls of `wait` from all the threads by `interval` seconds"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._next_time = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_time)
+            self._next_time = start + self.interval
+        time.sleep(start - now)
+
+
 def is_table_existed_in_sqlite3(table_name: str, con: sqlite3.Connection):
     sql = (
         "SELECT COUNT(*) FROM sqlite_master WHERE type='table' and"
@@ -76,23 +270,102 @@ def read_csv(
 
 def read_sql(
     sql: str,
-    conn: Union[sqlite3.Connection, MySQLdb.Connection],
+    conn: Union[sqlite3.Connection, MySQLdb.Connection, sqlalchemy.Connection],
     index_col: list[str] = None,
     parse_dates: list[str] = None,
+    params: Optional[dict[str, Any]] = None,
 ) -> pandas.DataFrame:
+    """`sql` with the `:name` placeholders of `params`, see `bind_params`"""
     index_col = TIMED_INDEX_COLs if index_col is None else index_col
     parse_dates = [TIME_COL_NAME] if parse_dates is None else parse_dates
+    if params is not None:
+        sql, params = bind_params(sql, conn, params)
 
     df = pandas.read_sql(
         sql,
         con=conn,
         index_col=index_col,
         parse_dates=parse_dates,
+        params=params,
     )
 
     return df
 
 
+def bind_params(
+    sql: str,
+    conn: Union[sqlite3.Connection, MySQLdb.Connection, sqlalchemy.Connection],
+    params: dict[str, Any],
+) -> tuple[Any, dict[str, Any]]:
+    """
+    `sql` and `params` in the paramstyle of `conn`, from `:name` placeholders. A list
+    value is expanded to one placeholder per item, e.g. `code` IN (:codes), and an
+    empty list to NULL, which matches nothing.
+    """
+    is_sqlalchemy = isinstance(conn, (sqlalchemy.Engine, sqlalchemy.Connection))
+    # sqlite3 and SQLAlchemy take `:name`, MySQLdb takes `%(name)s`
+    if is_sqlalchemy or isinstance(conn, sqlite3.Connection):
+        placeholder = ":{}"
+    else:
+        placeholder = "%({})s"
+    bound = {}
+
+    def expand(match: re.Match) -> str:
+        name = match.group(1)
+        if name not in params:
+            return match.group(0)
+        value = params[name]
+        if not isinstance(value, (list, tuple, set)):
+            bound[name] = value
+            return placeholder.format(name)
+        names = [f"{name}_{i}" for i in range(len(value))]
+        bound.update(zip(names, value))
+        return ", ".join(map(placeholder.format, names)) or "NULL"
+
+    sql = _PLACEHOLDER_PATTERN.sub(expand, sql)
+    return (sqlalchemy.text(sql) if is_sqlalchemy else sql), bound
+
+
+def codes_clause(codes: Optional[list[str]]) -> str:
+    """The condition of `read_sql` on the codes of `params["codes"]`, if any"""
+    return "" if codes is None else f"AND `{SECURITY_ID_NAME}` IN (:codes)"
+
+
+def get_statement_dtypes(header: list[str]) -> dict[str, Optional[str]]:
+    """
+    The column registry of a statement header of `CONF`, column -> dtype, without the
+    index. The accounts are float64, also when a column read is all NULL.
+    """
+    return {
+        column: None if column in STATEMENT_META_COLs else "float64"
+        for column in dict.fromkeys(header)
+        if column not in TIMED_INDEX_COLs
+    }
+
+
+def select_statement_columns(
+    table_name: str,
+    dtypes: dict[str, Optional[str]],
+    columns: Optional[list[str]] = None,
+) -> list[str]:
+    """`columns` of the registry `dtypes` of `table_name`, all of them if None"""
+    if columns is None:
+        return list(dtypes)
+
+    unknown_columns = [column for column in columns if column not in dtypes]
+    if unknown_columns:
+        raise YiException(f"Unknown columns {unknown_columns} of `{table_name}`.")
+    return list(dict.fromkeys(columns))
+
+
+def astype_statement(
+    df: pandas.DataFrame, dtypes: dict[str, Optional[str]]
+) -> pandas.DataFrame:
+    return df.astype(
+        {column: dtype for column, dtype in dtypes.items() if dtype and column in df}
+    )
+
+
 def write_csv(new_df: pandas.DataFrame, file_path: str) -> int:
     if os.path.exists(file_path):
         existing_df = read_csv(file_path)
@@ -155,6 +428,28 @@ class IFRSDateIter:
 
         return year, quarter
 
+    @staticmethod
+    def ifrs_dts2quarters(
+        ts: pandas.DatetimeIndex,
+    ) -> tuple[numpy.ndarray, numpy.ndarray]:
+        """`ifrs_dt2quarter` of every date at once, the arrays of years and quarters"""
+        month_days = ts.month * 100 + ts.day
+        quarters = numpy.select(
+            [
+                month_days == 331,
+                month_days == 515,
+                month_days == 814,
+                month_days == 1114,
+            ],
+            [4, 1, 2, 3],
+            default=0,
+        )
+        if (quarters == 0).any():
+            raise ValueError(f"Invalid parse datetime {ts[quarters == 0][0]}")
+        years = ts.year.to_numpy() - (quarters == 4)
+
+        return years, quarters
+
     @staticmethod
     def dt_to_closest_ifrs_dt(ts: datetime.datetime) -> datetime.datetime:
         # for case week delay
@@ -0,0 +1,71 @@
+"""
+Run a screen or backtest over a grid of `config.yaml` thresholds on every core.
+
+The frames are published into shared memory once by the parent process, and each
+worker of the pool attaches zero-copy views of them in its initializer, so the data is
+neither reloaded nor pickled per worker. A grid maps CONF keys to candidate values:
+
+    grid = {"預期本益比": [10, 12, 15], "預期殖利率": [3, 4, 5]}
+    summary = sweep.run(screen, grid, {"prices": dataset.prices})
+
+`func(frames, conf)` is called once per combination with `conf` being `util.CONF`
+overridden by the combination, and returns a dict of metrics which becomes a row of
+the summary table. `func` must be defined at module level of a module which does not
+import `dataset`, otherwise every worker would load the data again on start.
+"""
+
+import itertools
+import logging
+import multiprocessing
+import os
+from typing import Any, Callable
+
+import pandas
+
+from stock_tw import sharedmem, util
+
+_frames: dict[str, pandas.DataFrame] = {}
+_func: Callable[[dict[str, pandas.DataFrame], dict[str, Any]], dict[str, Any]]
+
+
+def run(
+    func: Callable[[dict[str, pandas.DataFrame], dict[str, Any]], dict[str, Any]],
+    grid: dict[str, list[Any]],
+    frames: dict[str, pandas.DataFrame],
+    processes: int = None,
+) -> pandas.DataFrame:
+    unknown_keys = set(grid) - set(util.CONF)
+    if unknown_keys:
+        raise util.YiException(f"Unknown config keys {unknown_keys} in the grid.")
+
+    keys = list(grid)
+    combinations = [
+        dict(zip(keys, values)) for values in itertools.product(*grid.values())
+    ]
+    processes = min(processes or os.cpu_count(), len(combinations)) or 1
+    logging.info(f"Sweep {len(combinations)} combinations on {processes} processes")
+
+    manifests = {name: sharedmem.publish_frame(df) for name, df in frames.items()}
+    try:
+        with multiprocessing.Pool(
+            processes, initializer=_init_worker, initargs=(func, manifests)
+        ) as pool:
+            results = pool.map(_evaluate, combinations, chunksize=1)
+    finally:
+        for manifest in manifests.values():
+            sharedmem.release_frame(manifest)
+
+    rows = [{**params, **metrics} for params, metrics in zip(combinations, results)]
+    return pandas.DataFrame(rows).set_index(keys)
+
+
+def _init_worker(func, manifests: dict[str, dict[str, Any]]):
+    global _func
+    _func = func
+    for name, manifest in manifests.items():
+        _frames[name] = sharedmem.attach_frame(manifest)
+
+
+def _evaluate(params: dict[str, Any]) -> dict[str, Any]:
+    conf = {**util.CONF, **params}
+    return _func(_frames, conf)
@@ -0,0 +1,165 @@
+"""
+Dividend- and capital-change-adjusted closing prices.
+
+The exchanges quote `漲跌價差` against the reference price of the day, which already
+accounts for ex-dividend, ex-right and capital changes. So `收盤價 - 漲跌價差` is the
+reference price, and whenever it differs from the previous close the day is an
+adjustment event with `調整因子 = 參考價 / 前收盤價`.
+
+The series is adjusted forward: `還原收盤價 = 收盤價 * 累計調整因子`, where the cumulative
+factor is the product of `1 / 調整因子` over all events up to the day. A new ex-date only
+changes the rows from that day on, so a trading day is maintained from the last
+adjusted row of every security without touching the history, and returns computed from
+`還原收盤價` are continuous across events. That holds only if the last adjusted row is
+of the day before, a day missed in between would be taken for an event, so `calculate`
+refuses a `last` behind the previous trading day of a security.
+"""
+
+import datetime
+import sqlite3
+from typing import Union
+
+import MySQLdb
+import pandas
+from dateutil.relativedelta import relativedelta
+
+from stock_tw import util
+from stock_tw.變易 import price
+
+ADJUSTMENT_TB_NAME = "price_adjustment"
+ADJUSTMENT_TB_COLs = ["參考價", "前收盤價", "調整因子"]
+ADJUSTED_PRICE_TB_NAME = "adjusted_price"
+ADJUSTED_PRICE_TB_COLs = ["收盤價", "累計調整因子", "還原收盤價"]
+
+# Smallest tick, gaps below it are rounding of the quoted prices
+_MIN_GAP = 0.01
+
+# The previous trading day of a security is looked up within this period before a day
+_PREVIOUS_DAY_PERIOD = relativedelta(months=1)
+
+
+def calculate(
+    prices: pandas.DataFrame, last: pandas.DataFrame = None
+) -> tuple[pandas.DataFrame, pandas.DataFrame]:
+    """
+    Returns the adjustment events and the adjusted prices of `prices` (daily_price rows).
+    `last` holds `收盤價` and `累計調整因子` by code as of the day before `prices` starts,
+    see `read_last`, it is omitted when calculating from the first day of the history.
+    Raises `YiException` if a code of `prices` was adjusted up to a day before its
+    previous trading day, the days missed have to be adjusted first.
+    """
+    df = prices[["收盤價", "漲跌價差"]].dropna(subset=["收盤價"]).sort_index()
+    codes = df.index.get_level_values(util.SECURITY_ID_NAME)
+
+    if last is not None:
+        behind = last.reindex(codes.unique())
+        behind = behind[
+            behind["前交易日"].notnull()
+            & (behind[util.TIME_COL_NAME] != behind["前交易日"])
+        ]
+        if len(behind):
+            raise util.YiException(
+                f"The adjusted prices of {len(behind)} codes, e.g."
+                f" {list(behind.index[:5])}, are behind their"
+                f" previous trading days {sorted(set(behind['前交易日'].astype(str)))},"
+                " adjust them first or rebuild by bin/rebuild_adjusted_price.py"
+            )
+
+    prev_close = df.groupby(level=util.SECURITY_ID_NAME)["收盤價"].shift(1)
+    if last is not None:
+        seed = last["收盤價"].reindex(codes).to_numpy()
+        prev_close = prev_close.fillna(pandas.Series(seed, index=df.index))
+
+    ref_price = df["收盤價"] - df["漲跌價差"]
+    factor = ref_price / prev_close
+    is_event = ((ref_price - prev_close).abs().round(4) >= _MIN_GAP) & (factor > 0)
+    factor = factor.where(is_event, 1.0)
+
+    cum_factor = (1 / factor).groupby(level=util.SECURITY_ID_NAME).cumprod()
+    if last is not None:
+        seed = last["累計調整因子"].reindex(codes).fillna(1.0).to_numpy()
+        cum_factor = cum_factor * seed
+
+    events = pandas.DataFrame(
+        {"參考價": ref_price, "前收盤價": prev_close, "調整因子": factor}
+    )[is_event]
+    adjusted_prices = pandas.DataFrame(
+        {
+            "收盤價": df["收盤價"],
+            "累計調整因子": cum_factor,
+            "還原收盤價": df["收盤價"] * cum_factor,
+        }
+    )
+
+    return events[ADJUSTMENT_TB_COLs], adjusted_prices[ADJUSTED_PRICE_TB_COLs]
+
+
+def read_last(
+    conn: Union[sqlite3.Connection, MySQLdb.Connection], ts: datetime.datetime
+) -> pandas.DataFrame:
+    """
+    The last adjusted row of every security before `ts`, by code, and `前交易日`, the
+    last day it was traded before `ts` within `_PREVIOUS_DAY_PERIOD`, which is the day
+    of the row unless a day was missed, NaT if not traded within the period. A day
+    missing from `daily_price` as well is not told here, the callers load the days of
+    a market in order.
+    """
+    sql_stmt = f"""
+    SELECT b.`code`, b.`ts`, b.`收盤價`, b.`累計調整因子`, p.`前交易日`
+    FROM (
+        SELECT a.`code`, a.`ts`, a.`收盤價`, a.`累計調整因子`
+        FROM `{ADJUSTED_PRICE_TB_NAME}` AS a
+        JOIN (
+            SELECT `code` AS code_a, MAX(`ts`) AS max_ts FROM `{ADJUSTED_PRICE_TB_NAME}`
+            WHERE `ts` < :ts
+            GROUP BY `code`
+            ) AS m
+        ON m.code_a = a.`code` AND m.max_ts = a.`ts`
+        ) AS b
+    LEFT JOIN (
+        SELECT `code`, MAX(`ts`) AS `前交易日` FROM `{price.PRICE_TB_NAME}`
+        WHERE 1
+            AND `ts` < :ts
+            AND `ts` >= :start_time
+            AND `收盤價` IS NOT NULL
+        GROUP BY `code`
+        ) AS p
+    ON p.`code` = b.`code`
+    """
+
+    return util.read_sql(
+        sql_stmt,
+        conn,
+        index_col=[util.SECURITY_ID_NAME],
+        parse_dates=[util.TIME_COL_NAME, "前交易日"],
+        params={"ts": str(ts), "start_time": str(ts - _PREVIOUS_DAY_PERIOD)},
+    )
+
+
+def read_sql(
+    conn: Union[sqlite3.Connection, MySQLdb.Connection],
+    start_time: datetime.datetime = None,
+) -> pandas.DataFrame:
+    _start_time = start_time or (datetime.datetime.now() - relativedelta(days=10))
+
+    return util.read_sql(
+        f"""
+        SELECT * FROM `{ADJUSTED_PRICE_TB_NAME}`
+        WHERE `{util.TIME_COL_NAME}` >= :start_time
+        ;""",
+        conn,
+        params={"start_time": str(_start_time)},
+    )
+
+
+def read_adjustment_sql(
+    conn: Union[sqlite3.Connection, MySQLdb.Connection],
+) -> pandas.DataFrame:
+    df = pandas.read_sql(
+        f"SELECT * FROM `{ADJUSTMENT_TB_NAME}`;",
+        con=conn,
+        index_col=util.TIMED_INDEX_COLs,
+        parse_dates=[util.TIME_COL_NAME],
+    )
+
+    return df
@@ -0,0 +1,198 @@
+"""
+Return covariance and correlation matrices of the whole universe with missing days.
+
+Securities list, suspend and delist at different times, so every pair is measured over
+the days both of them traded. Instead of the returns, the state keeps the pairwise
+sufficient statistics (weights, sums, cross products) as N x N matrices:
+
+    W[i, j]   = sum(w * m_i * m_j)          C[i, j] = sum(m_i * m_j)
+    Sx[i, j]  = sum(w * x_i * m_i * m_j)    Sxy[i, j] = sum(w * x_i * x_j)
+    Sxx[i, j] = sum(w * x_i^2 * m_i * m_j)
+
+where `m` marks a present return and `w` is 1, or decays by `halflife` days for an
+exponentially weighted matrix. They are accumulated from (days x block) slices of the
+returns, so memory is bounded by the matrices themselves plus one block of days.
+A new trading day only decays the statistics and adds its outer products, O(N^2)
+instead of O(N^2 * days).
+"""
+
+import os
+import os.path
+
+import numpy
+import pandas
+
+from stock_tw import util
+
+COVARIANCE_STATE_NAME = "return_covariance"
+
+_STAT_KEYS = ["W", "C", "Sx", "Sxy", "Sxx"]
+
+
+def to_returns(prices: pandas.DataFrame, column: str = "收盤價") -> pandas.DataFrame:
+    """Daily returns as a (ts x code) frame, NaN where either day has no price"""
+    closes = prices[column].unstack(util.SECURITY_ID_NAME).sort_index()
+    return closes.pct_change(fill_method=None)
+
+
+def new_state(halflife: float = None) -> dict[str, numpy.ndarray]:
+    return {
+        "halflife": numpy.array(numpy.nan if halflife is None else halflife),
+        "codes": numpy.array([], dtype=str),
+        "last_ts": numpy.array(numpy.datetime64("NaT", "D")),
+        **{key: numpy.zeros((0, 0)) for key in _STAT_KEYS},
+    }
+
+
+def get_state_path() -> str:
+    return os.path.join(os.getenv("STORAGE_ROOT"), f"{COVARIANCE_STATE_NAME}.npz")
+
+
+def load_state(path: str = None) -> dict[str, numpy.ndarray]:
+    path = path or get_state_path()
+    with numpy.load(path) as npz:
+        return {key: npz[key] for key in npz.files}
+
+
+def save_state(state: dict[str, numpy.ndarray], path: str = None):
+    path = path or get_state_path()
+    tmp_path = f"{path[:-len('.npz')]}.tmp.npz"
+    numpy.savez(tmp_path, **state)
+    os.replace(tmp_path, path)
+
+
+def update(
+    state: dict[str, numpy.ndarray],
+    returns: pandas.DataFrame,
+    block_size: int = 256,
+    row_block_size: int = 256,
+):
+    """
+    Accumulates `returns` (ts x code, see `to_returns`) into `state`. It takes the whole
+    history when building a state and single days afterwards, each day only once.
+    """
+    returns = returns.sort_index()
+    last_ts = state["last_ts"][()]
+    if len(returns) == 0:
+        return
+    first_ts = numpy.datetime64(returns.index[0], "D")
+    if not numpy.isnat(last_ts) and first_ts <= last_ts:
+        raise util.YiException(
+            f"The returns of `{first_ts}` are already in the covariance state"
+            f" (last `{last_ts}`)."
+        )
+
+    _align(state, returns.columns.astype(str))
+    positions = pandas.Index(state["codes"]).get_indexer(returns.columns.astype(str))
+    n = len(state["codes"])
+
+    # Older days weigh less, the existing statistics are the oldest
+    halflife = state["halflife"][()]
+    decay = 1.0 if numpy.isnan(halflife) else 0.5 ** (1 / halflife)
+    weights = decay ** numpy.arange(len(returns) - 1, -1, -1)
+    for key in ["W", "Sx", "Sxy", "Sxx"]:
+        state[key] *= decay ** len(returns)
+
+    values = returns.to_numpy(dtype=float)
+    for r0 in range(0, len(values), row_block_size):
+        rows = numpy.full((min(row_block_size, len(values) - r0), n), numpy.nan)
+        rows[:, positions] = values[r0 : r0 + row_block_size]
+        _accumulate(state, rows, weights[r0 : r0 + row_block_size], block_size)
+
+    state["last_ts"] = numpy.array(numpy.datetime64(returns.index[-1], "D"))
+
+
+def covariance(
+    state: dict[str, numpy.ndarray],
+    min_periods: int = 20,
+    shrinkage: float = 0.0,
+    ddof: int = 1,
+) -> pandas.DataFrame:
+    """
+    Pairwise covariance, NaN for pairs sharing less than `min_periods` days.
+    `shrinkage` blends the matrix towards its diagonal: (1 - s) * cov + s * diag(cov).
+    """
+    W, C, Sx, Sxy = state["W"], state["C"], state["Sx"], state["Sxy"]
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        # Bessel's correction in weight units, W * (C - ddof) / C
+        cov = (Sxy - Sx * Sx.T / W) / (W * (C - ddof) / C)
+    cov[C < max(min_periods, ddof + 1)] = numpy.nan
+
+    return _frame(state, _shrink(cov, shrinkage))
+
+
+def correlation(
+    state: dict[str, numpy.ndarray],
+    min_periods: int = 20,
+    shrinkage: float = 0.0,
+) -> pandas.DataFrame:
+    """Pairwise correlation, `shrinkage` blends it towards the identity matrix"""
+    W, C, Sx, Sxy, Sxx = (state[key] for key in _STAT_KEYS)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        var = Sxx - Sx**2 / W
+        corr = (Sxy - Sx * Sx.T / W) / numpy.sqrt(var * var.T)
+    corr = numpy.clip(corr, -1.0, 1.0)
+    corr[C < max(min_periods, 2)] = numpy.nan
+
+    return _frame(state, _shrink(corr, shrinkage))
+
+
+def _accumulate(
+    state: dict[str, numpy.ndarray],
+    rows: numpy.ndarray,
+    weights: numpy.ndarray,
+    block_size: int,
+):
+    present = ~numpy.isnan(rows)
+    mask = present.astype(float)
+    x = numpy.where(present, rows, 0.0)
+    wx = x * weights[:, None]
+    wx2 = wx * x
+    wmask = mask * weights[:, None]
+
+    n = rows.shape[1]
+    for i0 in range(0, n, block_size):
+        i = slice(i0, i0 + block_size)
+        for j0 in range(i0, n, block_size):
+            j = slice(j0, j0 + block_size)
+            # W, C and Sxy are symmetric, Sx and Sxx are not
+            state["W"][i, j] += wmask[:, i].T @ mask[:, j]
+            state["C"][i, j] += mask[:, i].T @ mask[:, j]
+            state["Sxy"][i, j] += wx[:, i].T @ x[:, j]
+            state["Sx"][i, j] += wx[:, i].T @ mask[:, j]
+            state["Sxx"][i, j] += wx2[:, i].T @ mask[:, j]
+            if j0 != i0:
+                state["W"][j, i] = state["W"][i, j].T
+                state["C"][j, i] = state["C"][i, j].T
+                state["Sxy"][j, i] = state["Sxy"][i, j].T
+                state["Sx"][j, i] += wx[:, j].T @ mask[:, i]
+                state["Sxx"][j, i] += wx2[:, j].T @ mask[:, i]
+
+
+def _align(state: dict[str, numpy.ndarray], codes: pandas.Index):
+    new_codes = codes.difference(pandas.Index(state["codes"]))
+    if new_codes.empty:
+        return
+
+    n = len(state["codes"]) + len(new_codes)
+    for key in _STAT_KEYS:
+        stats = numpy.zeros((n, n))
+        stats[: len(state[key]), : len(state[key])] = state[key]
+        state[key] = stats
+    state["codes"] = numpy.concatenate([state["codes"], new_codes.to_numpy(dtype=str)])
+
+
+def _shrink(matrix: numpy.ndarray, shrinkage: float) -> numpy.ndarray:
+    if not shrinkage:
+        return matrix
+    target = numpy.diag(numpy.diag(matrix))
+    return (1 - shrinkage) * matrix + shrinkage * target
+
+
+def _frame(state: dict[str, numpy.ndarray], matrix: numpy.ndarray) -> pandas.DataFrame:
+    codes = pandas.Index(state["codes"], name=util.SECURITY_ID_NAME)
+    return (
+        pandas.DataFrame(matrix, index=codes, columns=codes)
+        .sort_index(axis=0)
+        .sort_index(axis=1)
+    )
@@ -1,13 +1,21 @@
 import collections
 import datetime
-from typing import Optional
+import logging
+import os
+from typing import Optional, Union
 
 import pandas
 from dateutil.relativedelta import relativedelta
 
-from stock_tw.變易 import pera, price, revenue, security
-from stock_tw import util
-from stock_tw.變易.fin_stmt import balance_sheet, cash_flow, income_sheet, cumulate_income_sheet
+from stock_tw.變易 import pera, price, profit, revenue, security
+from stock_tw import sharedmem, util
+from stock_tw.變易.fin_stmt import (
+    account_store,
+    balance_sheet,
+    cash_flow,
+    income_sheet,
+    cumulate_income_sheet,
+)
 
 """
 This module performs analysis on financial data.
@@ -48,6 +56,30 @@ datatime_range: dict[str, Optional[datetime.datetime]] = {
 
 _FIN_DATA_START_DT = datetime.datetime.today() - relativedelta(years=6)
 
+# A name of `股票池` in `CONF`, codes, or a `security.Universe`, None for every security
+Universe = Optional[Union[str, list[str], security.Universe]]
+
+
+def _get_default_universe() -> Universe:
+    """`DATASET_UNIVERSE`, a name of `股票池` or comma separated codes"""
+    universe = os.getenv("DATASET_UNIVERSE")
+    if not universe:
+        return None
+    if universe in (util.CONF.get("股票池") or {}):
+        return universe
+    return [code.strip() for code in universe.split(",") if code.strip()]
+
+
+# The universe of the refreshes which are not given one
+DEFAULT_UNIVERSE: Universe = _get_default_universe()
+
+# Read the statements from the narrow `account_store` in place of the wide tables
+FIN_STMT_LONG_FORMAT = os.getenv("DATASET_FIN_STMT_STORE") == "long"
+
+# The engines of the analyses, "polars" runs them by the lazy queries of `lazy`
+ANALYSIS_ENGINEs = ["pandas", "polars"]
+ANALYSIS_ENGINE = os.getenv("DATASET_ENGINE", "pandas")
+
 
 def refresh_securities(connection):
     global securities
@@ -58,9 +90,12 @@ def refresh_securities(connection):
 def refresh_prices(
     connection,
     dt: datetime.datetime = datetime.datetime.today() - relativedelta(months=6),
+    universe: Universe = None,
 ):
     global prices
-    prices = price.read_sql(conn=connection, start_time=dt)
+    prices = price.read_sql(
+        conn=connection, start_time=dt, codes=select_universe(universe)
+    )
     prices.sort_index(ascending=True, inplace=True)
     datatime_range["max_price"] = max(ts for ts, code in prices.index)
     datatime_range["min_price"] = min(ts for ts, code in prices.index)
@@ -68,20 +103,16 @@ def refresh_prices(
 
 def refresh_peras(
     connection,
+    universe: Universe = None,
 ):
+    """The PER analyses of the years since `_FIN_DATA_START_DT`, a row per year"""
     global peras
 
-    pera_sql = f"""
-    SELECT * FROM `{pera.PERA_TB_NAME}` AS b
-    JOIN (
-        SELECT code AS code_a, YEAR(ts) AS year, MAX(ts) AS max_ts FROM `{pera.PERA_TB_NAME}`
-        WHERE ts >= '{_FIN_DATA_START_DT}'
-        GROUP BY code, YEAR(ts)
-        ) AS a
-    ON a.code_a = b.code AND a.max_ts = b.ts
-    """
-
-    peras = pera.read_sql(conn=connection, sql=pera_sql)
+    peras = pera.read_sql(
+        conn=connection,
+        codes=select_universe(universe),
+        start_time=_FIN_DATA_START_DT,
+    )
     peras.sort_index(ascending=True, inplace=True)
     peras["股利年度"] = peras["股利年度"].fillna(0).astype(int)
     datatime_range["max_pera"] = max(ts for ts, code in peras.index)
@@ -89,49 +120,120 @@ def refresh_peras(
 
 
 def refresh_revenues(
-    connection, dt: datetime.datetime = _FIN_DATA_START_DT - relativedelta(months=5)
+    connection,
+    dt: datetime.datetime = _FIN_DATA_START_DT - relativedelta(months=5),
+    universe: Universe = None,
 ):
     global revenues
-    revenues = revenue.read_sql(conn=connection, start_time=dt)
+    revenues = revenue.read_sql(
+        conn=connection, start_time=dt, codes=select_universe(universe)
+    )
     revenues.sort_index(ascending=True, inplace=True)
     datatime_range["max_revenue"] = max(ts for ts, code in revenues.index)
     datatime_range["min_revenue"] = min(ts for ts, code in revenues.index)
 
 
-def refresh_fin_stmt(connection, dt: datetime.datetime = _FIN_DATA_START_DT):
+def refresh_fin_stmt(
+    connection,
+    dt: datetime.datetime = _FIN_DATA_START_DT,
+    columns: Optional[dict[str, Optional[list[str]]]] = None,
+    universe: Universe = None,
+    long_format: Optional[bool] = None,
+    derive_income_sheets: bool = False,
+):
+    """
+    Reads the statements since `dt`, the columns of `FIN_STMT_COLs` by table name, or of
+    `columns` in its place, where None reads every column of a table. With
+    `long_format`, `FIN_STMT_LONG_FORMAT` by default, they are read from `account_store`.
+    With `derive_income_sheets`, `income_sheets` are derived from the year to date of
+    `cumulate_income_sheet` in place of being read.
+    """
     global income_sheets, cumulate_income_sheets, balance_sheets, cash_flows
-    income_sheets = income_sheet.read_sql(conn=connection, start_time=dt)
-    income_sheets.sort_index(ascending=True, inplace=True)
-    cumulate_income_sheets = cumulate_income_sheet.read_sql(
-        conn=connection, start_time=dt
+    columns = FIN_STMT_COLs if columns is None else columns
+    codes = select_universe(universe)
+    long_format = FIN_STMT_LONG_FORMAT if long_format is None else long_format
+
+    def read_sql(
+        table_name: str,
+        read_wide_sql,
+        start_time: datetime.datetime = dt,
+        table_columns: Optional[list[str]] = None,
+    ) -> pandas.DataFrame:
+        table_columns = table_columns or columns.get(table_name)
+        if long_format:
+            df = account_store.read_sql(
+                connection,
+                table_name,
+                start_time=start_time,
+                columns=table_columns,
+                codes=codes,
+            )
+        else:
+            df = read_wide_sql(
+                conn=connection,
+                start_time=start_time,
+                columns=table_columns,
+                codes=codes,
+            )
+        return df.sort_index(ascending=True)
+
+    if derive_income_sheets:
+        income_columns = columns.get(income_sheet.INCOME_TB_NAME) or list(
+            income_sheet.INCOME_TB_DTYPEs
+        )
+        # The year to date of the quarters since `dt` and of the quarter before
+        cumulate_df = read_sql(
+            cumulate_income_sheet.CUMULATE_INCOME_TB_NAME,
+            cumulate_income_sheet.read_sql,
+            start_time=dt - relativedelta(months=5),
+            table_columns=[
+                f"{cumulate_income_sheet.CUMULATE_PREFIX}{column}"
+                for column in income_columns
+                if f"{cumulate_income_sheet.CUMULATE_PREFIX}{column}"
+                in cumulate_income_sheet.CUMULATE_INCOME_TB_DTYPEs
+            ],
+        )
+        income_sheets = income_sheet.derive(cumulate_df, columns=income_columns)
+        ts = income_sheets.index.get_level_values(util.TIME_COL_NAME)
+        income_sheets = income_sheets[ts >= dt]
+    else:
+        income_sheets = read_sql(income_sheet.INCOME_TB_NAME, income_sheet.read_sql)
+    cumulate_income_sheets = read_sql(
+        cumulate_income_sheet.CUMULATE_INCOME_TB_NAME, cumulate_income_sheet.read_sql
     )
-    cumulate_income_sheets.sort_index(ascending=True, inplace=True)
-    balance_sheets = balance_sheet.read_sql(conn=connection, start_time=dt)
-    balance_sheets.sort_index(ascending=True, inplace=True)
-    cash_flows = cash_flow.read_sql(conn=connection, start_time=dt)
-    cash_flows.sort_index(ascending=True, inplace=True)
+    balance_sheets = read_sql(balance_sheet.BALANCE_TB_NAME, balance_sheet.read_sql)
+    cash_flows = read_sql(cash_flow.CASH_TB_NAME, cash_flow.read_sql)
     datatime_range["max_fin_stmt"] = max(ts for ts, code in balance_sheets.index)
     datatime_range["min_fin_stmt"] = min(ts for ts, code in balance_sheets.index)
 
 
 def refresh_balance_sheet_metatime(
-    connection, dt: datetime.datetime = _FIN_DATA_START_DT,
+    connection,
+    dt: datetime.datetime = _FIN_DATA_START_DT,
+    universe: Universe = None,
 ):
     global balance_sheet_metatime
 
+    codes = select_universe(universe)
     sql_stmt = f"""
         SELECT `code`, `ts`, `created_ts`
         FROM `{balance_sheet.BALANCE_TB_NAME}_metatime`
-        WHERE `{util.TIME_COL_NAME}` >= '{dt}';
+        WHERE `{util.TIME_COL_NAME}` >= :start_time {util.codes_clause(codes)};
     """
-    balance_sheet_metatime = pandas.read_sql(
-        sql=sql_stmt,
-        con=connection,
-        index_col=util.TIMED_INDEX_COLs,
-        parse_dates=[util.TIME_COL_NAME],
+    balance_sheet_metatime = util.read_sql(
+        sql_stmt, connection, params={"start_time": str(dt), "codes": codes}
     )
 
 
+def select_universe(universe: Universe = None) -> Optional[list[str]]:
+    """The codes of `universe` among `securities`, None for every security"""
+    if universe is None:
+        universe = DEFAULT_UNIVERSE
+    if universe is None:
+        return None
+    return security.select_codes(securities, universe)
+
+
 # These column name lists are used to organize and refer to specific columns in data tables or
 # for calculations and analysis.
 # Column names related to table security_list
@@ -139,21 +241,17 @@ TB_STOCK_COLs = ["name", "group"]
 # Column names related to table price
 TB_PRICE_COLs = ["收盤價", "漲跌幅(%)"]
 # Column names related to table balance_sheet
-TB_BALANCE_SHEET_COLs = ["普通股股本", "資產總計", "權益總額"]
+TB_BALANCE_SHEET_COLs = profit.BALANCE_SHEET_COLs
 # Column names related to table income_sheet
-TB_INCOME_SHEET_COLs = [
-    "基本每股盈餘合計",
-    "營業外收入及支出合計",
-    "營業毛利（毛損）",
-    "營業毛利（毛損）淨額",
-    "本期淨利（淨損）",
-    "營業收入合計",
-    "繼續營業單位稅前淨利（淨損）",
-    "繼續營業單位本期淨利（淨損）",
-    "母公司業主（淨利／損）",
-    "繼續營業單位淨利（淨損）",
-    "停業單位淨利（淨損）",
-]
+TB_INCOME_SHEET_COLs = profit.INCOME_SHEET_COLs
+# Columns of the statements read by `refresh_fin_stmt`, by table name, only those the
+# analyses use, every column of the statements they do not use
+FIN_STMT_COLs = {
+    income_sheet.INCOME_TB_NAME: TB_INCOME_SHEET_COLs,
+    cumulate_income_sheet.CUMULATE_INCOME_TB_NAME: None,
+    balance_sheet.BALANCE_TB_NAME: TB_BALANCE_SHEET_COLs,
+    cash_flow.CASH_TB_NAME: None,
+}
 # Column names related to revenues
 TB_REVENUE_COLs = ["updated_ts", "當月營收", "當月累計營收", "去年累計營收"]
 
@@ -212,11 +310,7 @@ ANAL_EPS_COLs = [
     "DBR(0)",
 ]
 # Column names related to custom profit analysis based on revenues
-CUST_ANAL_PROFIT_COLs = [
-    "(C)營收合計",
-    "(C)平均月營收",
-    "(C)合計月數",
-]
+CUST_ANAL_PROFIT_COLs = profit.CUST_PROFIT_COLs
 
 # Column names related to profit analysis
 ANAL_PROFIT_COLs = (
@@ -246,10 +340,16 @@ anal_revenue: pandas.DataFrame
 anal_quarter: pandas.DataFrame
 
 
-def analyze_prices(ts: datetime.datetime = None):
+def analyze_prices(ts: datetime.datetime = None, engine: str = None):
     """Calculates prices and merge them into the latest date price data"""
     global daily_price
     ts = ts or datatime_range["max_price"]
+    if _is_polars(engine):
+        from stock_tw.變易 import lazy
+
+        daily_price = lazy.analyze_prices(prices, ts)
+        return daily_price[TB_PRICE_COLs + ANAL_PRICE_COLs]
+
     daily_price = prices.loc[ts].copy()
 
     # Init ANAL_PRICE_COLs
@@ -280,11 +380,16 @@ def analyze_prices(ts: datetime.datetime = None):
     return daily_price[TB_PRICE_COLs + ANAL_PRICE_COLs]
 
 
-def analyze_peras():
+def analyze_peras(engine: str = None):
     """
     It retrieves the latest `peras` data and calculates the number of consecutive dividend years.
     """
     global peras, anal_per
+    if _is_polars(engine):
+        from stock_tw.變易 import lazy
+
+        anal_per = lazy.analyze_peras(peras, datatime_range["max_pera"])
+        return anal_per[ANAL_PERA_COLs]
 
     anal_per = peras.loc[datatime_range["max_pera"]].copy()
 
@@ -313,55 +418,63 @@ def analyze_peras():
     return anal_per[ANAL_PERA_COLs]
 
 
-def calculate_his_fin_stmt(columns: list[str] = None) -> pandas.DataFrame:
+def calculate_his_fin_stmt(
+    columns: list[str] = None, engine: str = None
+) -> pandas.DataFrame:
     """Perform calculations and analysis on the financial data"""
     global his_profits
     columns = columns or ANAL_FIN_STMT_COLs + CUST_ANAL_PROFIT_COLs
 
-    # 損益表["營業毛利（毛損）", "本期淨利（淨損）", "營業收入合計"]
-    # 加入資產負債表["普通股股本", "資產總計", "權益總額"]
-    tmp = balance_sheet_metatime.merge(balance_sheets, on=util.TIMED_INDEX_COLs)[
-        TB_BALANCE_SHEET_COLs + ["created_ts"]
-    ]
-    tmp = tmp.merge(income_sheets[TB_INCOME_SHEET_COLs], on=util.TIMED_INDEX_COLs)
-    tmp["ROA"] = tmp["本期淨利（淨損）"] / tmp["資產總計"] * 100
-    tmp["ROE"] = tmp["本期淨利（淨損）"] / tmp["權益總額"] * 100
-    tmp["DBR"] = (tmp["資產總計"] - tmp["權益總額"]) / tmp["資產總計"] * 100
-    tmp["GPM"] = tmp["營業毛利（毛損）"] / tmp["營業收入合計"] * 100
-    tmp["NIM"] = tmp["本期淨利（淨損）"] / tmp["營業收入合計"] * 100
-
-    # 加入月營收，以季合計，作為與損益表["營業收入合計"] 做對照
-    ifrs_dated_revenues = collections.defaultdict(list)
-    for (ts, code), _revenue in revenues["當月營收"].items():
-        dt = ts - relativedelta(months=1)  # '2023-06-10' represent '2023-05's revenue
-        ifrs_date = util.IFRSDateIter.dt_in_ifrs_dt(dt)
-        ifrs_dated_revenues[(ifrs_date, code)].append(_revenue)
-    values = (
-        (
-            ts,
-            code,
-            sum(_revenues),
-            sum(_revenues) / len(_revenues),
-            len(_revenues),
-        )
-        for (ts, code), _revenues in ifrs_dated_revenues.items()
-    )
-    cust_tmp = pandas.DataFrame(
-        values, columns=util.TIMED_INDEX_COLs + CUST_ANAL_PROFIT_COLs
-    )
-    cust_tmp.set_index(util.TIMED_INDEX_COLs, inplace=True)
+    if _is_polars(engine):
+        from stock_tw.變易 import lazy
 
-    # 合併 cust_tmp["(C)營收合計", "(C)平均月營收","(C)合計月數"]
-    tmp = tmp.merge(cust_tmp, on=util.TIMED_INDEX_COLs)
-    his_profits = tmp
+        calculate = lazy.calculate_his_fin_stmt
+    else:
+        calculate = profit.calculate
+    his_profits = calculate(
+        balance_sheet_metatime, balance_sheets, income_sheets, revenues
+    )
 
     return his_profits[columns]
 
 
-def analyze_revenue(ts: datetime.datetime = None):
+def refresh_his_profits(
+    connection, dt: datetime.datetime = _FIN_DATA_START_DT, universe: Universe = None
+) -> bool:
+    """
+    Reads `his_profits` from the materialized `his_profit` in place of calculating it,
+    returns False if the table is not built.
+    """
+    global his_profits
+    if not util.is_table_existed_in_sqlite3(profit.HIS_PROFIT_TB_NAME, con=connection):
+        logging.warning(
+            f"Calculate his_profits without `{profit.HIS_PROFIT_TB_NAME}`,"
+            " build it by bin/update_his_profit.py"
+        )
+        return False
+
+    his_profits = profit.read_sql(
+        connection, start_time=dt, codes=select_universe(universe)
+    )
+    his_profits.sort_index(ascending=True, inplace=True)
+    logging.info(
+        f"Read `{profit.HIS_PROFIT_TB_NAME}` {len(his_profits)} rows,"
+        f" watermarks {profit.read_watermarks(connection)}"
+    )
+    return True
+
+
+def analyze_revenue(ts: datetime.datetime = None, engine: str = None):
     """Retrieve and analyze the latest revenue data"""
     global anal_revenue
     ts = ts or datatime_range["max_revenue"]
+    if _is_polars(engine):
+        from stock_tw.變易 import lazy
+
+        anal_revenue = lazy.analyze_revenue(revenues, ts, TB_REVENUE_COLs)
+        return anal_revenue[
+            ANAL_REVENUE_COLs + ["當月累計營收", "去年累計營收", "R(1)", "R(2)", "R(y)"]
+        ]
 
     m0_revenue = revenues.loc[ts]
     m1_revenue = revenues.loc[ts - relativedelta(months=1)]
@@ -395,6 +508,16 @@ def analyze_revenue(ts: datetime.datetime = None):
     ]
 
 
+def _is_polars(engine: Optional[str]) -> bool:
+    """Whether the analysis runs by `engine`, `ANALYSIS_ENGINE` by default, on Polars"""
+    engine = engine or ANALYSIS_ENGINE
+    if engine not in ANALYSIS_ENGINEs:
+        raise util.YiException(
+            f"Unknown analysis engine `{engine}`, {ANALYSIS_ENGINEs}"
+        )
+    return engine == "polars"
+
+
 def append_stock_info(df: pandas.DataFrame) -> pandas.DataFrame:
     return securities[TB_STOCK_COLs].merge(df, on=[util.SECURITY_ID_NAME], how="right")
 
@@ -445,12 +568,20 @@ def analyze_base(
 
 
 def analyze_profit(
-    ifrs_ts: datetime.datetime = None, columns: list[str] = None
+    ifrs_ts: datetime.datetime = None, columns: list[str] = None, engine: str = None
 ) -> pandas.DataFrame:
     global anal_profit
     columns = columns or ANAL_PROFIT_COLs
 
     ifrs_ts = ifrs_ts or datatime_range["max_fin_stmt"]
+    if _is_polars(engine):
+        from stock_tw.變易 import lazy
+
+        anal_profit = lazy.analyze_profit(
+            anal_per[ANAL_PERA_COLs], his_profits, daily_price[TB_PRICE_COLs], ifrs_ts
+        )
+        return anal_profit[columns]
+
     ifrs_iter = util.IFRSDateIter(ifrs_dt=ifrs_ts)
 
     # Based on pera_df
@@ -581,6 +712,41 @@ def analyze_profit(
     return anal_profit[columns]
 
 
+# Frames published by default, their numeric columns only
+SHARED_FRAME_NAMEs = ["prices", "his_profits", "anal_profit"]
+
+_shared_manifests: dict[str, dict] = {}
+
+
+def publish_shared(names: list[str] = None) -> str:
+    """
+    Publishes the frames into shared memory, so that other processes of the host attach
+    them by `sharedmem.attach_published` without loading them again. The frames stay
+    published until `release_shared` or the exit of this process.
+    Returns the path of the manifest file.
+    """
+    names = names or SHARED_FRAME_NAMEs
+    missing_names = [name for name in names if name not in globals()]
+    if missing_names:
+        raise util.YiException(f"Frames {missing_names} are not analyzed yet.")
+
+    release_shared()
+    for name in names:
+        _shared_manifests[name] = sharedmem.publish_frame(globals()[name])
+        if skipped := _shared_manifests[name]["skipped"]:
+            logging.info(f"Publish `{name}` without non-numeric columns {skipped}")
+    return sharedmem.write_manifest(_shared_manifests)
+
+
+def release_shared():
+    if not _shared_manifests:
+        return
+    sharedmem.remove_manifest()
+    for manifest in _shared_manifests.values():
+        sharedmem.release_frame(manifest)
+    _shared_manifests.clear()
+
+
 # New DB session
 _connection = util.DB_ENGINE.connect()
 _sqlite3 = util.get_sqlite3()
@@ -593,6 +759,8 @@ refresh_revenues(_connection)
 refresh_fin_stmt(_sqlite3)
 # We use MySQL to track the change time of the financial data stored in SQLite3
 refresh_balance_sheet_metatime(_connection)
+# The profitability materialized at ingestion time, calculated below without it
+_is_his_profits_read = refresh_his_profits(_sqlite3)
 # Close DB session
 _connection.close()
 _sqlite3.close()
@@ -600,6 +768,7 @@ _sqlite3.close()
 
 # Performs analysis
 analyze_prices()
-calculate_his_fin_stmt()
+if not _is_his_profits_read:
+    calculate_his_fin_stmt()
 analyze_revenue()
 analyze_peras()
@@ -0,0 +1,393 @@
+"""
+The statements in a narrow (long) format, a row per value of an account, in place of a
+wide table per statement whose columns are the accounts of `CONF`.
+
+`fin_stmt_account` is the dictionary of the accounts, an `account_id` per account of a
+statement table, and `fin_stmt_value` holds the values (account_id, ts, code, value)
+WITHOUT ROWID, clustered by (account_id, ts), so reading a few accounts of some quarters
+reads only their ranges. NaN values are not stored, a new account is a row of the
+dictionary rather than a rewrite of the table.
+
+    account_store.write_sqlite3(df, conn, balance_sheet.BALANCE_TB_NAME)
+    df = account_store.read_sql(conn, balance_sheet.BALANCE_TB_NAME, columns=["資產總計"])
+
+`read_sql` pivots the values back to the wide frame of the statement modules, indexed
+by (ts, code) with a column per account.
+
+Every value changed by `write_sqlite3` is also appended to `fin_stmt_revision`, the
+revision log of the values by their valid time `ts` and their transaction time
+`known_ts`, a removed value as NULL. Only the changed values are logged, the deltas
+against the version before, and `read_as_of` answers the statements as known at a time,
+of all companies in one query:
+
+    df = account_store.read_as_of(conn, balance_sheet.BALANCE_TB_NAME, known_time)
+"""
+
+import datetime
+import sqlite3
+from typing import Optional
+
+import numpy
+import pandas
+
+from stock_tw import util
+
+ACCOUNT_TB_NAME = "fin_stmt_account"
+VALUE_TB_NAME = "fin_stmt_value"
+REVISION_TB_NAME = "fin_stmt_revision"
+KEY_COLs = ["account_id"] + util.TIMED_INDEX_COLs
+
+# `ts` is stored as a date, all statements are dated on the deadline of a quarter
+TS_FORMAT = "%Y-%m-%d"
+
+
+def create_tables(conn: sqlite3.Connection):
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS `{ACCOUNT_TB_NAME}` (
+            `account_id` INTEGER PRIMARY KEY,
+            `table_name` TEXT NOT NULL,
+            `account` TEXT NOT NULL,
+            UNIQUE (`table_name`, `account`)
+        );""")
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS `{VALUE_TB_NAME}` (
+            `account_id` INTEGER NOT NULL,
+            `ts` TEXT NOT NULL,
+            `code` TEXT NOT NULL,
+            `value` REAL NOT NULL,
+            PRIMARY KEY (`account_id`, `ts`, `code`)
+        ) WITHOUT ROWID;""")
+    if not util.is_table_existed_in_sqlite3(REVISION_TB_NAME, con=conn):
+        conn.execute(f"""
+            CREATE TABLE `{REVISION_TB_NAME}` (
+                `account_id` INTEGER NOT NULL,
+                `ts` TEXT NOT NULL,
+                `code` TEXT NOT NULL,
+                `known_ts` TEXT NOT NULL,
+                `value` REAL,
+                PRIMARY KEY (`account_id`, `ts`, `code`, `known_ts`)
+            ) WITHOUT ROWID;""")
+        # The values stored before the log are known since it starts
+        conn.execute(
+            f"""
+            INSERT INTO `{REVISION_TB_NAME}`
+            SELECT `account_id`, `ts`, `code`, ?, `value` FROM `{VALUE_TB_NAME}`;""",
+            (str(datetime.datetime.now()),),
+        )
+    conn.commit()
+
+
+def read_accounts(conn: sqlite3.Connection, table_name: str) -> dict[str, int]:
+    """The dictionary of the accounts of `table_name`, account -> account_id"""
+    create_tables(conn)
+    rows = conn.execute(
+        f"""
+        SELECT `account`, `account_id` FROM `{ACCOUNT_TB_NAME}`
+        WHERE `table_name` = ? ORDER BY `account_id`;""",
+        (table_name,),
+    )
+    return dict(rows)
+
+
+def get_account_ids(
+    conn: sqlite3.Connection, table_name: str, accounts: list[str]
+) -> dict[str, int]:
+    """The ids of `accounts`, those new to the dictionary are added"""
+    conn.executemany(
+        f"INSERT OR IGNORE INTO `{ACCOUNT_TB_NAME}` (`table_name`, `account`)"
+        " VALUES (?, ?);",
+        [(table_name, account) for account in accounts],
+    )
+    account_ids = read_accounts(conn, table_name)
+    return {account: account_ids[account] for account in accounts}
+
+
+def read_sql(
+    conn: sqlite3.Connection,
+    table_name: str,
+    start_time: datetime.datetime = None,
+    columns: Optional[list[str]] = None,
+    codes: Optional[list[str]] = None,
+) -> pandas.DataFrame:
+    """
+    The wide frame of `table_name` since `start_time`, only the accounts of `columns`
+    and the companies of `codes` if given. An account without values is all NaN.
+    """
+    return _read_wide(
+        conn,
+        f"""
+        SELECT `account_id`, `ts`, `code`, `value`
+        FROM `{VALUE_TB_NAME}`
+        WHERE 1
+            AND `account_id` IN (:account_ids)
+            AND `{util.TIME_COL_NAME}` >= :start_date
+            {util.codes_clause(codes)}
+        ;""",
+        table_name,
+        start_time,
+        columns,
+        {"codes": codes},
+    )
+
+
+def read_as_of(
+    conn: sqlite3.Connection,
+    table_name: str,
+    known_time: datetime.datetime,
+    start_time: datetime.datetime = None,
+    columns: Optional[list[str]] = None,
+    codes: Optional[list[str]] = None,
+) -> pandas.DataFrame:
+    """
+    `read_sql` of the statements as known at `known_time`, the latest revision of each
+    value written by then
+    """
+    # The other columns of a row with MAX() are those of the row of the maximum, and
+    # the groups come in the order of the primary key, without sorting
+    return _read_wide(
+        conn,
+        f"""
+        SELECT `account_id`, `ts`, `code`, `value`, MAX(`known_ts`)
+        FROM `{REVISION_TB_NAME}`
+        WHERE 1
+            AND `account_id` IN (:account_ids)
+            AND `{util.TIME_COL_NAME}` >= :start_date
+            {util.codes_clause(codes)}
+            AND `known_ts` <= :known_ts
+        GROUP BY `account_id`, `ts`, `code`
+        ;""",
+        table_name,
+        start_time,
+        columns,
+        {"codes": codes, "known_ts": str(known_time)},
+    )
+
+
+def read_revisions(
+    conn: sqlite3.Connection,
+    table_name: str,
+    start_time: datetime.datetime = None,
+    codes: Optional[list[str]] = None,
+) -> pandas.DataFrame:
+    """
+    The revisions of the values of `table_name` since `start_time`, indexed by
+    (ts, code, known_ts) with the account and its new value, NaN if removed
+    """
+    account_ids = read_accounts(conn, table_name)
+    sql, params = util.bind_params(
+        f"""
+        SELECT `account_id`, `ts`, `code`, `known_ts`, `value`
+        FROM `{REVISION_TB_NAME}`
+        WHERE 1
+            AND `account_id` IN (:account_ids)
+            AND `{util.TIME_COL_NAME}` >= :start_date
+            {util.codes_clause(codes)}
+        ;""",
+        conn,
+        {
+            "account_ids": list(account_ids.values()),
+            "start_date": _to_start_date(start_time),
+            "codes": codes,
+        },
+    )
+    df = pandas.read_sql(sql, con=conn, params=params, parse_dates=["ts", "known_ts"])
+    accounts = {account_id: account for account, account_id in account_ids.items()}
+    df.insert(0, "account", df.pop("account_id").map(accounts))
+
+    return df.set_index(util.TIMED_INDEX_COLs + ["known_ts"]).sort_index()
+
+
+def _read_wide(
+    conn: sqlite3.Connection,
+    sql: str,
+    table_name: str,
+    start_time: Optional[datetime.datetime],
+    columns: Optional[list[str]],
+    params: dict,
+) -> pandas.DataFrame:
+    """The wide frame of the values selected by `sql`, the 4 columns of the store"""
+    account_ids = read_accounts(conn, table_name)
+    columns = list(account_ids) if columns is None else list(dict.fromkeys(columns))
+
+    sql, params = util.bind_params(
+        sql,
+        conn,
+        {
+            "account_ids": [
+                account_ids[column] for column in columns if column in account_ids
+            ],
+            "start_date": _to_start_date(start_time),
+            **params,
+        },
+    )
+    # By columns at once, the rows of a DataFrame from `pandas.read_sql` cost as much
+    rows = conn.execute(sql, params).fetchall()
+    account_id_values, ts_values, code_values, values = (
+        list(zip(*rows))[:4] if rows else [()] * 4
+    )
+    long_df = pandas.DataFrame(
+        {
+            "account_id": numpy.array(account_id_values, dtype="int64"),
+            util.TIME_COL_NAME: numpy.array(ts_values, dtype=object),
+            util.SECURITY_ID_NAME: numpy.array(code_values, dtype=object),
+            "value": numpy.array(values, dtype="float64"),
+        }
+    )
+    # Removed values of the revision log
+    long_df = long_df[long_df["value"].notnull()]
+
+    # An account not in the dictionary has no values, a negative id of its own keeps it
+    return pivot(
+        long_df,
+        {account_ids.get(column, -1 - i): column for i, column in enumerate(columns)},
+    )
+
+
+def _to_start_date(start_time: Optional[datetime.datetime]) -> str:
+    return (
+        pandas.Timestamp(start_time or datetime.datetime(1990, 1, 1))
+        .ceil("D")
+        .strftime(TS_FORMAT)
+    )
+
+
+def pivot(long_df: pandas.DataFrame, accounts: dict[int, str]) -> pandas.DataFrame:
+    """
+    The wide frame of the values of `long_df`, indexed by (ts, code) with a column per
+    account of `accounts` (account_id -> account) in its order
+    """
+    ts_ids, ts_values = pandas.factorize(long_df[util.TIME_COL_NAME], sort=True)
+    code_ids, code_values = pandas.factorize(long_df[util.SECURITY_ID_NAME], sort=True)
+    # The rows of the wide frame, the (ts, code) pairs of the values in order
+    keys, row_ids = numpy.unique(
+        ts_ids.astype("int64") * len(code_values) + code_ids, return_inverse=True
+    )
+    column_ids = pandas.Index(list(accounts)).get_indexer(long_df["account_id"])
+
+    values = numpy.full((len(keys), len(accounts)), numpy.nan)
+    values[row_ids, column_ids] = long_df["value"].to_numpy(dtype="float64")
+    index = pandas.MultiIndex.from_arrays(
+        [
+            pandas.DatetimeIndex(ts_values).take(keys // max(len(code_values), 1)),
+            pandas.Index(code_values, dtype=object).take(
+                keys % max(len(code_values), 1)
+            ),
+        ],
+        names=util.TIMED_INDEX_COLs,
+    )
+
+    return pandas.DataFrame(values, index=index, columns=list(accounts.values()))
+
+
+def write_sqlite3(
+    new_df: pandas.DataFrame,
+    conn: sqlite3.Connection,
+    table_name: str,
+    remove_missing: bool = False,
+) -> int:
+    """
+    Writes the values of the wide frame `new_df` of `table_name`, a value written again
+    replaces the one before, returns the number of values changed. The accounts NaN or
+    not in `new_df` are kept as stored, unless `remove_missing`, by which the accounts
+    of its columns NaN in a statement are removed.
+    """
+    create_tables(conn)
+    accounts = [
+        column for column in new_df.columns if column not in util.STATEMENT_META_COLs
+    ]
+    account_ids = numpy.array(
+        list(get_account_ids(conn, table_name, accounts).values()), dtype="int64"
+    )
+    values = new_df[accounts].apply(pandas.to_numeric).to_numpy(dtype="float64")
+    ts = (
+        pandas.DatetimeIndex(new_df.index.get_level_values(util.TIME_COL_NAME))
+        .strftime(TS_FORMAT)
+        .to_numpy()
+    )
+    codes = new_df.index.get_level_values(util.SECURITY_ID_NAME).to_numpy()
+
+    # Only the values given
+    row_ids, column_ids = numpy.nonzero(~numpy.isnan(values))
+    long_df = pandas.DataFrame(
+        {
+            "account_id": account_ids[column_ids],
+            util.TIME_COL_NAME: ts[row_ids],
+            util.SECURITY_ID_NAME: codes[row_ids],
+            "value": values[row_ids, column_ids],
+        }
+    )
+    merged = long_df.merge(
+        _read_stored(
+            conn,
+            table_name,
+            pandas.DataFrame({util.TIME_COL_NAME: ts, util.SECURITY_ID_NAME: codes}),
+        ),
+        on=KEY_COLs,
+        how="outer",
+        suffixes=("", "_stored"),
+        indicator=True,
+    )
+    changed_df = merged.loc[
+        (merged["_merge"] == "left_only")
+        | ((merged["_merge"] == "both") & (merged["value"] != merged["value_stored"])),
+        KEY_COLs + ["value"],
+    ]
+    removed_df = merged.loc[
+        (merged["_merge"] == "right_only")
+        & merged["account_id"].isin(account_ids if remove_missing else []),
+        KEY_COLs,
+    ]
+
+    conn.executemany(
+        f"""
+        DELETE FROM `{VALUE_TB_NAME}`
+        WHERE `account_id` = ? AND `ts` = ? AND `code` = ?;""",
+        _to_rows(removed_df),
+    )
+    conn.executemany(
+        f"INSERT OR REPLACE INTO `{VALUE_TB_NAME}` VALUES (?, ?, ?, ?);",
+        _to_rows(changed_df),
+    )
+    # The changes are also the revisions known from now on, a removed value is NULL
+    known_ts = str(datetime.datetime.now())
+    conn.executemany(
+        f"INSERT OR REPLACE INTO `{REVISION_TB_NAME}` VALUES (?, ?, ?, ?, ?);",
+        [
+            (account_id, ts, code, known_ts, value)
+            for account_id, ts, code, value in _to_rows(changed_df)
+        ]
+        + [
+            (account_id, ts, code, known_ts, None)
+            for account_id, ts, code in _to_rows(removed_df)
+        ],
+    )
+    conn.commit()
+
+    return len(changed_df) + len(removed_df)
+
+
+def _read_stored(
+    conn: sqlite3.Connection, table_name: str, statements: pandas.DataFrame
+) -> pandas.DataFrame:
+    """The values stored of the `statements` (ts, code)"""
+    sql, params = util.bind_params(
+        f"""
+        SELECT `account_id`, `ts`, `code`, `value` FROM `{VALUE_TB_NAME}`
+        WHERE 1
+            AND `account_id` IN (:account_ids)
+            AND `ts` IN (:ts)
+        ;""",
+        conn,
+        {
+            "account_ids": list(read_accounts(conn, table_name).values()),
+            "ts": sorted(set(statements[util.TIME_COL_NAME])),
+        },
+    )
+    return pandas.read_sql(sql, con=conn, params=params).merge(
+        statements.drop_duplicates(), on=util.TIMED_INDEX_COLs
+    )
+
+
+def _to_rows(df: pandas.DataFrame) -> list[tuple]:
+    # sqlite3 binds the Python scalars only, not those of numpy
+    return list(zip(*(df[column].tolist() for column in df.columns)))
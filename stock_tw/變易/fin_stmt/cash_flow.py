@@ -1,6 +1,6 @@
 import datetime
 import sqlite3
-from typing import Union
+from typing import Optional, Union
 
 import MySQLdb
 import pandas
@@ -10,33 +10,41 @@ from stock_tw import util
 
 CASH_TB_NAME = "cash_flow"
 CASH_TB_COLs: list[str] = util.CONF["現金流量表頭"]
+CASH_TB_DTYPEs: dict[str, Optional[str]] = util.get_statement_dtypes(CASH_TB_COLs)
 
 
 def read_sql(
     conn: Union[sqlite3.Connection, MySQLdb.Connection],
     start_time: datetime.datetime = None,
     sql_stmt: str = None,
+    columns: Optional[list[str]] = None,
+    codes: Optional[list[str]] = None,
 ) -> pandas.DataFrame:
+    """
+    The statements since `start_time`, only the accounts of `columns` and the
+    companies of `codes` if given
+    """
     _start_time = start_time or (
         datetime.datetime.now() - relativedelta(years=1, months=4)
     )
-    _fields = ", ".join(map(lambda field: f"`{field}`", CASH_TB_COLs))
+    _columns = util.select_statement_columns(CASH_TB_NAME, CASH_TB_DTYPEs, columns)
+    _fields = ", ".join(
+        map(lambda field: f"`{field}`", util.TIMED_INDEX_COLs + _columns)
+    )
 
     sql_stmt = sql_stmt or f"""
         SELECT {_fields}
         FROM `{CASH_TB_NAME}`
         WHERE 1
-            AND `{util.TIME_COL_NAME}` >= '{_start_time}'
+            AND `{util.TIME_COL_NAME}` >= :start_time
+            {util.codes_clause(codes)}
         ;"""
 
-    df = pandas.read_sql(
-        sql_stmt,
-        con=conn,
-        index_col=util.TIMED_INDEX_COLs,
-        parse_dates=[util.TIME_COL_NAME],
+    df = util.read_sql(
+        sql_stmt, conn, params={"start_time": str(_start_time), "codes": codes}
     )
 
-    return df
+    return util.astype_statement(df, CASH_TB_DTYPEs)
 
 
 def write_sqlite3(new_df: pandas.DataFrame, conn: sqlite3.Connection) -> int:
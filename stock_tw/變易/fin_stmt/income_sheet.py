@@ -1,53 +1,135 @@
 import datetime
 import sqlite3
-from typing import Union
+from typing import Optional, Union
 
 import MySQLdb
+import numpy
 import pandas
 from dateutil.relativedelta import relativedelta
 
 from stock_tw import util
+from stock_tw.變易.fin_stmt import cumulate_income_sheet
 
 INCOME_TB_NAME = "income_sheet"
 INCOME_TB_COLs: list[str] = util.CONF["損益表頭"]
+# 營業利益（損失） is listed twice in the header, once in the registry
+INCOME_TB_DTYPEs: dict[str, Optional[str]] = util.get_statement_dtypes(INCOME_TB_COLs)
+# The accounts which have a year to date in `cumulate_income_sheet`, those of `derive`
+DERIVABLE_COLs = [
+    column
+    for column in INCOME_TB_DTYPEs
+    if f"{cumulate_income_sheet.CUMULATE_PREFIX}{column}"
+    in cumulate_income_sheet.CUMULATE_INCOME_TB_DTYPEs
+]
 
 
 def read_sql(
     conn: Union[sqlite3.Connection, MySQLdb.Connection],
     start_time: datetime.datetime = None,
     sql_stmt: str = None,
+    columns: Optional[list[str]] = None,
+    codes: Optional[list[str]] = None,
 ) -> pandas.DataFrame:
+    """
+    The statements since `start_time`, only the accounts of `columns` and the
+    companies of `codes` if given
+    """
     _start_time = start_time or (
         datetime.datetime.now() - relativedelta(years=1, months=4)
     )
-    _fields = ", ".join(map(lambda field: f"`{field}`", INCOME_TB_COLs))
+    _columns = util.select_statement_columns(INCOME_TB_NAME, INCOME_TB_DTYPEs, columns)
+    _fields = ", ".join(
+        map(lambda field: f"`{field}`", util.TIMED_INDEX_COLs + _columns)
+    )
 
     sql_stmt = sql_stmt or f"""
         SELECT {_fields}
         FROM `{INCOME_TB_NAME}`
         WHERE 1
-            AND `{util.TIME_COL_NAME}` >= '{_start_time}'
+            AND `{util.TIME_COL_NAME}` >= :start_time
+            {util.codes_clause(codes)}
         ;"""
 
-    df = pandas.read_sql(
-        sql_stmt,
-        con=conn,
-        index_col=util.TIMED_INDEX_COLs,
-        parse_dates=[util.TIME_COL_NAME],
+    df = util.read_sql(
+        sql_stmt, conn, params={"start_time": str(_start_time), "codes": codes}
+    )
+
+    return util.astype_statement(df, INCOME_TB_DTYPEs)
+
+
+def derive(
+    cumulate_df: pandas.DataFrame, columns: Optional[list[str]] = None
+) -> pandas.DataFrame:
+    """
+    The statements of the single quarters of the year to date `cumulate_df` of
+    `cumulate_income_sheet`, the year to date less that of the quarter before, which
+    for Q1 is the year to date itself. A quarter whose quarter before is missing is
+    not derived, nor is an account without a year to date.
+    """
+    columns = util.select_statement_columns(INCOME_TB_NAME, INCOME_TB_DTYPEs, columns)
+    cumulate_columns = {
+        column: f"{cumulate_income_sheet.CUMULATE_PREFIX}{column}"
+        for column in columns
+        if f"{cumulate_income_sheet.CUMULATE_PREFIX}{column}" in cumulate_df.columns
+    }
+    meta_columns = [
+        column
+        for column in util.STATEMENT_META_COLs
+        if column in columns and column in cumulate_df.columns
+    ]
+
+    # The quarters of a company and year one after another
+    df = cumulate_df.sort_index(level=[util.SECURITY_ID_NAME, util.TIME_COL_NAME])
+    codes = df.index.get_level_values(util.SECURITY_ID_NAME).to_numpy()
+    years, quarters = util.IFRSDateIter.ifrs_dts2quarters(
+        pandas.DatetimeIndex(df.index.get_level_values(util.TIME_COL_NAME))
+    )
+    values = df[list(cumulate_columns.values())].to_numpy(dtype="float64")
+
+    has_previous = numpy.zeros(len(df), dtype=bool)
+    has_previous[1:] = (
+        (codes[1:] == codes[:-1])
+        & (years[1:] == years[:-1])
+        & (quarters[1:] == quarters[:-1] + 1)
+    )
+    previous_values = numpy.full_like(values, numpy.nan)
+    previous_values[1:] = values[:-1]
+    values = numpy.where(
+        (quarters == 1)[:, None],
+        values,
+        numpy.where(has_previous[:, None], values - previous_values, numpy.nan),
+    )
+
+    derived_df = pandas.DataFrame(
+        values, index=df.index, columns=list(cumulate_columns)
+    )
+    derived_df = derived_df.reindex(
+        columns=[column for column in columns if column not in util.STATEMENT_META_COLs]
     )
+    derived_df = derived_df[derived_df.notnull().any(axis=1)]
+    for column in meta_columns:
+        derived_df[column] = df.loc[derived_df.index, column]
 
-    return df
+    return derived_df[
+        [column for column in columns if column in derived_df]
+    ].sort_index()
 
 
 def write_sqlite3(new_df: pandas.DataFrame, conn: sqlite3.Connection) -> int:
+    """
+    Writes the statements by (ts, code), a statement written again updates the accounts
+    given by `new_df` and keeps the others, e.g. the crawled ones which are not derived
+    """
     is_table_existed = util.is_table_existed_in_sqlite3(INCOME_TB_NAME, con=conn)
     if is_table_existed:
         existing_df = read_sql(conn, start_time=datetime.datetime(1990, 1, 1))
+        existing_df = existing_df[~existing_df.index.duplicated(keep="last")]
     else:
         existing_df = pandas.DataFrame()
 
-    df = pandas.concat([existing_df, new_df])
-    df.drop_duplicates(inplace=True, keep="last")
+    new_df = new_df[~new_df.index.duplicated(keep="last")]
+    columns = list(dict.fromkeys([*existing_df.columns, *new_df.columns]))
+    df = new_df.combine_first(existing_df).reindex(columns=columns)
     df.sort_index(ascending=True, inplace=True)
     df.to_sql(INCOME_TB_NAME, con=conn, if_exists="replace")
 
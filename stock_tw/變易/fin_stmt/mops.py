@@ -0,0 +1,295 @@
+"""
+The statements the companies file to MOPS, crawled from its IFRS statement page
+`t164sb01`, which holds the balance sheet, the comprehensive income statement and the
+cash flow statement of a company and quarter in one download.
+
+The income statement of Q2 and Q3 lists the quarter and the year to date side by side,
+which are the rows of `income_sheet` and `cumulate_income_sheet`, that of Q1 lists the
+quarter only, which is also the year to date, and that of Q4 lists the year only, whose
+quarter is the year less the year to date of Q3.
+
+The companies are crawled by a bounded pool of threads, their requests spaced by
+`interval` seconds. Every company is checkpointed in the SQLite3 table
+`fin_stmt_checkpoint` together with its statements, so a rerun of the quarter asks only
+for the companies which have not filed yet. The statements are written into both the
+wide tables and the narrow `account_store`.
+"""
+
+import collections
+import concurrent.futures
+import datetime
+import io
+import logging
+import sqlite3
+import traceback
+from typing import Optional
+
+import pandas
+
+from stock_tw import instrument, util
+from stock_tw.變易.fin_stmt import (
+    account_store,
+    balance_sheet,
+    cash_flow,
+    cumulate_income_sheet,
+    income_sheet,
+)
+
+CHECKPOINT_TB_NAME = "fin_stmt_checkpoint"
+STATEMENT_PATH = "/server-java/t164sb01"
+# Consolidated statements, or the individual ones of companies without subsidiaries
+REPORT_IDs = ["C", "A"]
+
+STATUS_FILED = "filed"
+STATUS_UNFILED = "unfiled"
+STATUS_FAILED = "failed"
+
+# table name -> (column registry, writer)
+TABLEs = {
+    balance_sheet.BALANCE_TB_NAME: (
+        balance_sheet.BALANCE_TB_DTYPEs,
+        balance_sheet.write_sqlite3,
+    ),
+    income_sheet.INCOME_TB_NAME: (
+        income_sheet.INCOME_TB_DTYPEs,
+        income_sheet.write_sqlite3,
+    ),
+    cumulate_income_sheet.CUMULATE_INCOME_TB_NAME: (
+        cumulate_income_sheet.CUMULATE_INCOME_TB_DTYPEs,
+        cumulate_income_sheet.write_sqlite3,
+    ),
+    cash_flow.CASH_TB_NAME: (cash_flow.CASH_TB_DTYPEs, cash_flow.write_sqlite3),
+}
+
+
+def fetch(code: str, year: int, quarter: int) -> str:
+    """The statement page of the company, raise `YiException` if it has not filed"""
+    for report_id in REPORT_IDs:
+        url = (
+            f"{util.get_exchange_url('MOPS')}{STATEMENT_PATH}?"
+            f"step=1&CO_ID={code}&SYEAR={year}&SSEASON={quarter}&REPORT_ID={report_id}"
+        )
+        response = util.fetch(url, source="mops_fin_stmt", html=True)
+        if "會計項目" in response.text:
+            return response.text
+
+    raise util.YiException(
+        f"The statements of `{code}` {year}Q{quarter} are not filed."
+    )
+
+
+def parse(
+    text: str, code: str, ifrs_ts: datetime.datetime
+) -> dict[str, pandas.DataFrame]:
+    """One row by table name, Q4 without `income_sheet`, see `derive_q4`"""
+    _, quarter = util.IFRSDateIter.ifrs_dt2quarter(ifrs_ts)
+    with instrument.stage("parse", source="mops_fin_stmt") as record:
+        tables = pandas.read_html(io.StringIO(text), match="會計項目", thousands=None)
+        if len(tables) < 3:
+            raise TypeError(f"Miss statements of `{code}`, {len(tables)} tables found.")
+        balance, income, cash = (_parse_table(table) for table in tables[:3])
+
+        # The value columns of the income statement, by quarter
+        if quarter in (2, 3) and income.shape[1] < 3:
+            raise TypeError(
+                f"Miss the year to date of `{code}` in the income statement."
+            )
+        cumulate_column = 2 if quarter in (2, 3) else 0
+        values = {
+            balance_sheet.BALANCE_TB_NAME: balance.iloc[:, 0],
+            cumulate_income_sheet.CUMULATE_INCOME_TB_NAME: (
+                income.iloc[:, cumulate_column].add_prefix(
+                    cumulate_income_sheet.CUMULATE_PREFIX
+                )
+            ),
+            cash_flow.CASH_TB_NAME: cash.iloc[:, 0],
+        }
+        if quarter != 4:
+            values[income_sheet.INCOME_TB_NAME] = income.iloc[:, 0]
+
+        rows = {
+            table_name: _to_row(series, table_name, code, ifrs_ts)
+            for table_name, series in values.items()
+        }
+        record.rows = len(rows)
+
+    return rows
+
+
+def derive_q4(
+    cumulate_df: pandas.DataFrame, q3_cumulate_df: pandas.DataFrame
+) -> pandas.DataFrame:
+    """`income_sheet` rows of Q4, the year less the year to date of Q3, by code"""
+    missing_codes = cumulate_df.index.get_level_values(
+        util.SECURITY_ID_NAME
+    ).difference(q3_cumulate_df.index.get_level_values(util.SECURITY_ID_NAME))
+    if len(missing_codes):
+        logging.warning(f"Skip Q4 of {list(missing_codes)}, without Q3 year to date")
+
+    df = income_sheet.derive(pandas.concat([q3_cumulate_df, cumulate_df]))
+    ts = df.index.get_level_values(util.TIME_COL_NAME)
+    return df[ts == cumulate_df.index.get_level_values(util.TIME_COL_NAME)[0]]
+
+
+def create_checkpoint(conn: sqlite3.Connection):
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS `{CHECKPOINT_TB_NAME}` (
+            `ts` TEXT NOT NULL,
+            `code` TEXT NOT NULL,
+            `status` TEXT NOT NULL,
+            `attempts` INTEGER NOT NULL,
+            `message` TEXT,
+            `updated_ts` TEXT NOT NULL,
+            PRIMARY KEY (`ts`, `code`)
+        );""")
+    conn.commit()
+
+
+def read_checkpoint(
+    conn: sqlite3.Connection, ifrs_ts: datetime.datetime, status: str = None
+) -> pandas.DataFrame:
+    create_checkpoint(conn)
+    where = f"AND `status` = '{status}'" if status else ""
+    return pandas.read_sql(
+        f"SELECT * FROM `{CHECKPOINT_TB_NAME}` WHERE `ts` = '{ifrs_ts}' {where};",
+        con=conn,
+        index_col=[util.SECURITY_ID_NAME],
+        parse_dates=[util.TIME_COL_NAME, "updated_ts"],
+    )
+
+
+def crawl(
+    conn: sqlite3.Connection,
+    ifrs_ts: datetime.datetime,
+    codes: list[str],
+    workers: int = 4,
+    interval: float = 1.0,
+    batch_size: int = 100,
+) -> dict[str, int]:
+    """
+    Crawls the statements of the companies not filed yet and writes them into SQLite3,
+    every `batch_size` companies, returns the counts of the statuses.
+    """
+    filed_codes = set(read_checkpoint(conn, ifrs_ts, STATUS_FILED).index)
+    pending_codes = [code for code in codes if code not in filed_codes]
+    year, quarter = util.IFRSDateIter.ifrs_dt2quarter(ifrs_ts)
+    logging.info(
+        f"Crawl {year}Q{quarter} of {len(pending_codes)} companies,"
+        f" {len(filed_codes)} filed before"
+    )
+
+    throttle = util.Throttle(interval)
+
+    def crawl_one(code: str) -> dict[str, pandas.DataFrame]:
+        throttle.wait()
+        return parse(fetch(code, year, quarter), code, ifrs_ts)
+
+    counts = collections.Counter()
+    batch = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(crawl_one, code): code for code in pending_codes}
+        for future in concurrent.futures.as_completed(futures):
+            code, rows, message = futures[future], None, None
+            try:
+                rows = future.result()
+                status = STATUS_FILED
+            except util.YiException as e:
+                status, message = STATUS_UNFILED, str(e)
+            except Exception:
+                logging.error(traceback.format_exc())
+                status, message = STATUS_FAILED, traceback.format_exc(limit=1)
+            counts[status] += 1
+            batch.append((code, status, message, rows))
+
+            if len(batch) >= batch_size:
+                _write(conn, ifrs_ts, batch)
+                batch = []
+                logging.info(f"Crawled {sum(counts.values())} companies {dict(counts)}")
+    _write(conn, ifrs_ts, batch)
+
+    return dict(counts)
+
+
+def _write(
+    conn: sqlite3.Connection,
+    ifrs_ts: datetime.datetime,
+    batch: list[tuple[str, str, Optional[str], Optional[dict]]],
+):
+    """Writes the statements and then checkpoints the companies of the batch"""
+    filed_rows = [rows for _, _, _, rows in batch if rows]
+    if filed_rows:
+        frames = {
+            table_name: pandas.concat([rows[table_name] for rows in filed_rows])
+            for table_name in filed_rows[0]
+        }
+        _, quarter = util.IFRSDateIter.ifrs_dt2quarter(ifrs_ts)
+        if quarter == 4:
+            q3_ts = util.IFRSDateIter(ifrs_dt=ifrs_ts).previous_ifrs_dt()
+            q3_cumulate_df = cumulate_income_sheet.read_sql(
+                conn,
+                sql_stmt=f"""
+                    SELECT * FROM `{cumulate_income_sheet.CUMULATE_INCOME_TB_NAME}`
+                    WHERE `{util.TIME_COL_NAME}` = '{q3_ts}';""",
+            )
+            frames[income_sheet.INCOME_TB_NAME] = derive_q4(
+                frames[cumulate_income_sheet.CUMULATE_INCOME_TB_NAME], q3_cumulate_df
+            )
+
+        for table_name, df in frames.items():
+            _, write_sqlite3 = TABLEs[table_name]
+            count = write_sqlite3(df, conn)
+            logging.info(f"Write table `{table_name}` {count} rows")
+            count = account_store.write_sqlite3(df, conn, table_name)
+            logging.info(f"Write `{table_name}` {count} values into the account store")
+
+    now = str(datetime.datetime.now())
+    conn.executemany(
+        f"""
+        INSERT INTO `{CHECKPOINT_TB_NAME}` VALUES (?, ?, ?, 1, ?, ?)
+        ON CONFLICT (`ts`, `code`) DO UPDATE SET
+            `status` = excluded.`status`,
+            `attempts` = `attempts` + 1,
+            `message` = excluded.`message`,
+            `updated_ts` = excluded.`updated_ts`;""",
+        [
+            (str(ifrs_ts), code, status, message, now)
+            for code, status, message, _ in batch
+        ],
+    )
+    conn.commit()
+
+
+def _parse_table(table: pandas.DataFrame) -> pandas.DataFrame:
+    """The values of a statement table by account, a column per period"""
+    table = table.astype(str)
+    # The title cell holds the Chinese and the English titles, keep the former
+    accounts = table.iloc[:, 1].str.extract(r"^([^A-Za-z]*)", expand=False)
+    accounts = accounts.str.strip(" 　")
+    values = table.iloc[:, 2:].apply(
+        lambda scalar: pandas.to_numeric(
+            scalar.str.replace(",", "").str.replace(r"^\((.*)\)$", r"-\1", regex=True),
+            errors="coerce",
+        )
+    )
+    values.index = accounts
+    values = values[(values.index != "") & values.notnull().any(axis=1)]
+    # An account listed twice, e.g. under two sections, keeps the first
+    return values[~values.index.duplicated()]
+
+
+def _to_row(
+    series: pandas.Series, table_name: str, code: str, ifrs_ts: datetime.datetime
+) -> pandas.DataFrame:
+    dtypes, _ = TABLEs[table_name]
+    # As `read_sql` reads them back from SQLite3
+    now = str(datetime.datetime.now())
+    df = series.reindex(_accounts(dtypes)).to_frame().T
+    df[util.TIME_COL_NAME] = pandas.Timestamp(ifrs_ts)
+    df[util.SECURITY_ID_NAME] = code
+    df["created_ts"] = now
+    df["updated_ts"] = now
+    return df.set_index(util.TIMED_INDEX_COLs)
+
+
+def _accounts(dtypes: dict[str, Optional[str]]) -> list[str]:
+    return [column for column in dtypes if column not in util.STATEMENT_META_COLs]
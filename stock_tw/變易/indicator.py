@@ -0,0 +1,298 @@
+"""
+Technical indicators over `daily_price`, maintained incrementally.
+
+Instead of recomputing from the whole price history, a rolling state is kept per
+security: the last `_WINDOW` closes/highs/lows/volumes plus the recursive EMA, RSI and
+ATR averages. Each trading day advances the state once, so a day costs O(securities).
+
+The latest day is kept apart from the folded state as `pending`, because the same day is
+fetched several times while the exchanges are still publishing. A rerun of that day is
+recomputed from the state of the previous day, and the pending day is only folded in
+once a later day arrives. The state is persisted as `daily_indicator.npz` under
+`STORAGE_ROOT` so that a restart does not replay the price history.
+"""
+
+import datetime
+import os
+import os.path
+import sqlite3
+from typing import Union
+
+import MySQLdb
+import numpy
+import pandas
+from dateutil.relativedelta import relativedelta
+
+from stock_tw import util
+
+INDICATOR_TB_NAME = "daily_indicator"
+
+MA_WINDOWs = [5, 20, 60]
+EMA_SPANs = [12, 26]
+RSI_PERIOD = 14
+ATR_PERIOD = 14
+VOLUME_WINDOW = 20
+HIGH_LOW_WINDOWs = [20, 60]
+
+INDICATOR_TB_COLs = (
+    [f"MA{n}" for n in MA_WINDOWs]
+    + [f"EMA{n}" for n in EMA_SPANs]
+    + [f"RSI{RSI_PERIOD}", f"ATR{ATR_PERIOD}", f"量Z{VOLUME_WINDOW}"]
+    + [f"{n}日{kind}" for n in HIGH_LOW_WINDOWs for kind in ("高", "低")]
+)
+
+# Number of days kept in the rolling buffers
+_WINDOW = max(MA_WINDOWs + HIGH_LOW_WINDOWs + [VOLUME_WINDOW])
+_PARAMS = [_WINDOW, RSI_PERIOD, ATR_PERIOD, VOLUME_WINDOW] + EMA_SPANs
+_BUFFER_KEYS = ["closes", "highs", "lows", "volumes"]
+_PENDING_KEYS = ["pending_close", "pending_high", "pending_low", "pending_volume"]
+
+
+def new_state() -> dict[str, numpy.ndarray]:
+    return {
+        "params": numpy.array(_PARAMS),
+        "codes": numpy.array([], dtype=str),
+        "count": numpy.zeros(0, dtype=numpy.int64),
+        "prev_close": numpy.zeros(0),
+        "avg_gain": numpy.zeros(0),
+        "avg_loss": numpy.zeros(0),
+        "atr": numpy.zeros(0),
+        "ema": numpy.zeros((0, len(EMA_SPANs))),
+        **{key: numpy.zeros((0, _WINDOW)) for key in _BUFFER_KEYS},
+        "pending_ts": numpy.array(numpy.datetime64("NaT", "D")),
+        **{key: numpy.zeros(0) for key in _PENDING_KEYS},
+    }
+
+
+def get_state_path() -> str:
+    return os.path.join(os.getenv("STORAGE_ROOT"), f"{INDICATOR_TB_NAME}.npz")
+
+
+def load_state(path: str = None) -> dict[str, numpy.ndarray]:
+    path = path or get_state_path()
+    if not os.path.exists(path):
+        return new_state()
+
+    with numpy.load(path) as npz:
+        state = {key: npz[key] for key in npz.files}
+
+    if list(state["params"]) != _PARAMS:
+        raise util.YiException(
+            f"The indicator state `{path}` was built with other windows, rebuild it"
+            " with `replay`."
+        )
+    return state
+
+
+def save_state(state: dict[str, numpy.ndarray], path: str = None):
+    path = path or get_state_path()
+    # Write aside and rename, a crash must not leave a truncated state behind
+    tmp_path = f"{path[:-len('.npz')]}.tmp.npz"
+    numpy.savez(tmp_path, **state)
+    os.replace(tmp_path, path)
+
+
+def update(state: dict[str, numpy.ndarray], df: pandas.DataFrame) -> pandas.DataFrame:
+    """Advance `state` by one day of `price.extract` output and return its indicators"""
+    ts_values = df.index.get_level_values(util.TIME_COL_NAME).unique()
+    if len(ts_values) != 1:
+        raise ValueError("The indicators are updated one trading day at a time.")
+    ts = numpy.datetime64(ts_values[0], "D")
+
+    pending_ts = state["pending_ts"][()]
+    if not numpy.isnat(pending_ts):
+        if ts < pending_ts:
+            raise util.YiException(
+                f"The date `{ts}` is older than the indicator state `{pending_ts}`,"
+                " rebuild the state with `replay`."
+            )
+        if ts > pending_ts:
+            _fold_pending(state)
+
+    codes = df.index.get_level_values(util.SECURITY_ID_NAME).astype(str)
+    _align(state, codes)
+    positions = pandas.Index(state["codes"]).get_indexer(codes)
+
+    day = {}
+    for key, column in zip(_PENDING_KEYS, ["收盤價", "最高價", "最低價", "成交股數"]):
+        values = numpy.full(len(state["codes"]), numpy.nan)
+        values[positions] = df[column].to_numpy(dtype=float)
+        if ts == pending_ts:
+            # A rerun may miss a market that an earlier run of the same day had
+            values = numpy.where(numpy.isnan(values), state[key], values)
+        day[key] = values
+
+    base = {key: state[key] for key in _state_keys()}
+    after = _advance(base, *day.values())
+    indicators = _calculate(base, after, *day.values())
+    state.update(day)
+    state["pending_ts"] = numpy.array(ts)
+
+    indicators[util.TIME_COL_NAME] = pandas.Timestamp(ts)
+    indicators[util.SECURITY_ID_NAME] = state["codes"]
+    indicators = indicators[~numpy.isnan(day["pending_close"])]
+    return indicators.set_index(util.TIMED_INDEX_COLs)[INDICATOR_TB_COLs]
+
+
+def replay(
+    state: dict[str, numpy.ndarray], prices: pandas.DataFrame
+) -> pandas.DataFrame:
+    """Feed the price history day by day, used to build the state from scratch"""
+    frames = [
+        update(state, day)
+        for _, day in prices.groupby(level=util.TIME_COL_NAME, sort=True)
+    ]
+    return pandas.concat(frames) if frames else pandas.DataFrame()
+
+
+def read_sql(
+    conn: Union[sqlite3.Connection, MySQLdb.Connection],
+    start_time: datetime.datetime = None,
+) -> pandas.DataFrame:
+    _start_time = start_time or (datetime.datetime.now() - relativedelta(days=10))
+
+    df = pandas.read_sql(
+        (
+            f"SELECT * FROM `{INDICATOR_TB_NAME}` WHERE `{util.TIME_COL_NAME}` >="
+            f" '{_start_time}';"
+        ),
+        con=conn,
+        index_col=util.TIMED_INDEX_COLs,
+        parse_dates=[util.TIME_COL_NAME],
+    )
+
+    return df
+
+
+def _state_keys() -> list[str]:
+    return ["count", "prev_close", "avg_gain", "avg_loss", "atr", "ema"] + _BUFFER_KEYS
+
+
+def _fold_pending(state: dict[str, numpy.ndarray]):
+    base = {key: state[key] for key in _state_keys()}
+    state.update(_advance(base, *(state[key] for key in _PENDING_KEYS)))
+    for key in _PENDING_KEYS:
+        state[key] = numpy.full(len(state["codes"]), numpy.nan)
+    state["pending_ts"] = numpy.array(numpy.datetime64("NaT", "D"))
+
+
+def _align(state: dict[str, numpy.ndarray], codes: pandas.Index):
+    new_codes = codes.difference(pandas.Index(state["codes"]))
+    if new_codes.empty:
+        return
+
+    n = len(new_codes)
+    state["codes"] = numpy.concatenate([state["codes"], new_codes.to_numpy(dtype=str)])
+    state["count"] = numpy.concatenate(
+        [state["count"], numpy.zeros(n, dtype=numpy.int64)]
+    )
+    for key in ["prev_close", "avg_gain", "avg_loss", "atr"]:
+        state[key] = numpy.concatenate([state[key], numpy.zeros(n)])
+    state["ema"] = numpy.concatenate([state["ema"], numpy.zeros((n, len(EMA_SPANs)))])
+    for key in _BUFFER_KEYS:
+        state[key] = numpy.concatenate(
+            [state[key], numpy.full((n, _WINDOW), numpy.nan)]
+        )
+    for key in _PENDING_KEYS:
+        state[key] = numpy.concatenate([state[key], numpy.full(n, numpy.nan)])
+
+
+def _advance(
+    base: dict[str, numpy.ndarray],
+    close: numpy.ndarray,
+    high: numpy.ndarray,
+    low: numpy.ndarray,
+    volume: numpy.ndarray,
+) -> dict[str, numpy.ndarray]:
+    """Return the state after one day, securities without a close are left untouched"""
+    traded = ~numpy.isnan(close)
+    high = numpy.where(numpy.isnan(high), close, high)
+    low = numpy.where(numpy.isnan(low), close, low)
+    count = base["count"]
+    prev_close = base["prev_close"]
+    has_prev = traded & (count > 0)
+
+    # Wilder's smoothing, a simple average until the period is filled
+    change = numpy.where(has_prev, close - prev_close, 0.0)
+    steps = numpy.clip(numpy.minimum(count, RSI_PERIOD), 1, None)
+    avg_gain = (
+        base["avg_gain"] + (numpy.clip(change, 0, None) - base["avg_gain"]) / steps
+    )
+    avg_loss = (
+        base["avg_loss"] + (numpy.clip(-change, 0, None) - base["avg_loss"]) / steps
+    )
+
+    true_range = numpy.where(
+        has_prev,
+        numpy.maximum.reduce(
+            [high - low, numpy.abs(high - prev_close), numpy.abs(low - prev_close)]
+        ),
+        high - low,
+    )
+    steps = numpy.minimum(count + 1, ATR_PERIOD)
+    atr = base["atr"] + (true_range - base["atr"]) / steps
+
+    alpha = 2 / (numpy.array(EMA_SPANs) + 1)
+    ema = numpy.where(
+        (count == 0)[:, None],
+        close[:, None],
+        base["ema"] + alpha * (close[:, None] - base["ema"]),
+    )
+
+    after = {
+        "count": count + traded,
+        "prev_close": numpy.where(traded, close, prev_close),
+        "avg_gain": numpy.where(has_prev, avg_gain, base["avg_gain"]),
+        "avg_loss": numpy.where(has_prev, avg_loss, base["avg_loss"]),
+        "atr": numpy.where(traded, atr, base["atr"]),
+        "ema": numpy.where(traded[:, None], ema, base["ema"]),
+    }
+    for key, values in zip(_BUFFER_KEYS, [close, high, low, volume]):
+        buffer = base[key].copy()
+        buffer[traded, :-1] = buffer[traded, 1:]
+        buffer[traded, -1] = values[traded]
+        after[key] = buffer
+
+    return after
+
+
+def _calculate(
+    base: dict[str, numpy.ndarray],
+    after: dict[str, numpy.ndarray],
+    close: numpy.ndarray,
+    high: numpy.ndarray,
+    low: numpy.ndarray,
+    volume: numpy.ndarray,
+) -> pandas.DataFrame:
+    count = after["count"]
+    columns = {}
+
+    for n in MA_WINDOWs:
+        columns[f"MA{n}"] = _when(count >= n, after["closes"][:, -n:].mean(axis=1))
+    for i, n in enumerate(EMA_SPANs):
+        columns[f"EMA{n}"] = _when(count >= n, after["ema"][:, i])
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        rs = after["avg_gain"] / after["avg_loss"]
+        rsi = numpy.where(after["avg_loss"] == 0, 100.0, 100 - 100 / (1 + rs))
+    columns[f"RSI{RSI_PERIOD}"] = _when(count > RSI_PERIOD, rsi)
+    columns[f"ATR{ATR_PERIOD}"] = _when(count >= ATR_PERIOD, after["atr"])
+
+    # Today's volume against the previous window
+    volumes = base["volumes"][:, -VOLUME_WINDOW:]
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        std = volumes.std(axis=1, ddof=1)
+        z_score = (volume - volumes.mean(axis=1)) / numpy.where(
+            std == 0, numpy.nan, std
+        )
+    columns[f"量Z{VOLUME_WINDOW}"] = _when(base["count"] >= VOLUME_WINDOW, z_score)
+
+    for n in HIGH_LOW_WINDOWs:
+        columns[f"{n}日高"] = _when(count >= n, after["highs"][:, -n:].max(axis=1))
+        columns[f"{n}日低"] = _when(count >= n, after["lows"][:, -n:].min(axis=1))
+
+    return pandas.DataFrame(columns)
+
+
+def _when(condition: numpy.ndarray, values: numpy.ndarray) -> numpy.ndarray:
+    return numpy.where(condition, values, numpy.nan)
@@ -0,0 +1,341 @@
+"""
+Lazy Polars implementations of the analyses of `dataset`, chosen by their `engine`
+argument, e.g. `dataset.analyze_profit(engine="polars")`. They take the frames of
+`dataset` and return the frames and the column names of the pandas ones, while the
+query plans run on all cores, the aggregates streamed, without the intermediate copies
+of the chained merges. Requires polars and pyarrow.
+"""
+
+import datetime
+from typing import Optional
+
+import pandas
+import polars
+from dateutil.relativedelta import relativedelta
+
+from stock_tw import util
+from stock_tw.變易 import profit
+
+CODE = polars.col(util.SECURITY_ID_NAME)
+TS = polars.col(util.TIME_COL_NAME)
+
+
+def analyze_prices(prices: pandas.DataFrame, ts: datetime.datetime) -> pandas.DataFrame:
+    """The `dataset.daily_price` of the day `ts`, with the daily averages of `prices`"""
+    lf = _scan(prices)
+    averages = lf.group_by(util.SECURITY_ID_NAME).agg(
+        (polars.col("成交股數").mean() / 1000).cast(polars.Int64).alias("日均成交張數"),
+        polars.col("成交筆數").mean().cast(polars.Int64).alias("日均成交筆數"),
+        polars.col("成交金額").mean().cast(polars.Int64).alias("日均成交金額"),
+    )
+    df = (
+        lf.filter(TS == ts)
+        .select(polars.exclude(util.TIME_COL_NAME), TS)
+        .join(averages, on=util.SECURITY_ID_NAME, how="left", maintain_order="left")
+        .collect(engine="streaming")
+    )
+    return _to_pandas(df, [util.SECURITY_ID_NAME])
+
+
+def analyze_peras(peras: pandas.DataFrame, ts: datetime.datetime) -> pandas.DataFrame:
+    """
+    The `dataset.anal_per` of the day `ts`, with the count of the consecutive years of
+    dividends up to the last year, of the codes which paid any since 民國 90
+    """
+    lf = _scan(peras)
+    last_year = datetime.datetime.now().year - 1912
+    years = (
+        lf.filter((polars.col("股利年度") > 90) & (polars.col("殖利率(%)") > 0))
+        .select(CODE, polars.col("股利年度"))
+        .unique()
+    )
+    # The years from the last one down, as long as each is the one before
+    counts = years.group_by(util.SECURITY_ID_NAME).agg(
+        (
+            polars.col("股利年度").sort(descending=True)
+            == last_year - polars.int_range(polars.len())
+        )
+        .cast(polars.Int64)
+        .cum_min()
+        .sum()
+        .alias("股利連續N年")
+    )
+
+    day = lf.filter(TS == ts).drop(util.TIME_COL_NAME)
+    counted = day.join(
+        counts, on=util.SECURITY_ID_NAME, how="left", maintain_order="left"
+    ).with_columns(polars.col("股利連續N年").fill_null(0))
+    # Codes without a row of the day are appended, as the pandas one sets them by label
+    appended = counts.join(day, on=util.SECURITY_ID_NAME, how="anti").sort(
+        util.SECURITY_ID_NAME, descending=True
+    )
+    counted, appended = polars.collect_all([counted, appended])
+    if appended.height:
+        # and the counts turn to floats by the rows of NaN
+        counted = counted.with_columns(polars.col("股利連續N年").cast(polars.Float64))
+    df = polars.concat([counted, appended], how="diagonal_relaxed")
+    return _to_pandas(df, [util.SECURITY_ID_NAME])
+
+
+def analyze_revenue(
+    revenues: pandas.DataFrame, ts: datetime.datetime, columns: list[str]
+) -> pandas.DataFrame:
+    """The `dataset.anal_revenue` of the month `ts`, `columns` of its revenues"""
+    lf = _scan(revenues)
+
+    def month_revenue(months: int, name: str) -> polars.LazyFrame:
+        return lf.filter(TS == ts - relativedelta(months=months)).select(
+            CODE, polars.col("當月營收").alias(name)
+        )
+
+    df = (
+        lf.filter(TS == ts)
+        .select(CODE, *columns)
+        .join(
+            month_revenue(1, "R(1)"),
+            on=util.SECURITY_ID_NAME,
+            how="left",
+            maintain_order="left",
+        )
+        .join(
+            month_revenue(2, "R(2)"),
+            on=util.SECURITY_ID_NAME,
+            how="left",
+            maintain_order="left",
+        )
+        .join(
+            month_revenue(12, "R(y)"),
+            on=util.SECURITY_ID_NAME,
+            how="left",
+            maintain_order="left",
+        )
+        .with_columns(
+            (
+                (polars.col("當月營收") - polars.col("R(y)")) / polars.col("R(y)") * 100
+            ).alias("YoY"),
+            (
+                (polars.col("當月營收") - polars.col("R(1)")) / polars.col("R(1)") * 100
+            ).alias("MoM"),
+            (
+                (polars.col("當月營收") > polars.col("R(1)"))
+                & (polars.col("R(1)") > polars.col("R(2)"))
+            )
+            .fill_null(False)
+            .alias("IsM3"),
+        )
+        .collect()
+    )
+    return _to_pandas(df, [util.SECURITY_ID_NAME])
+
+
+def calculate_his_fin_stmt(
+    balance_sheet_metatime: pandas.DataFrame,
+    balance_sheets: pandas.DataFrame,
+    income_sheets: pandas.DataFrame,
+    revenues: pandas.DataFrame,
+) -> pandas.DataFrame:
+    """The `dataset.his_profits` as `profit.calculate`"""
+    month = TS.dt.offset_by("-1mo")
+    year = month.dt.year()
+    ifrs_ts = (
+        polars.when(month.dt.quarter() == 1)
+        .then(polars.datetime(year, 5, 15))
+        .when(month.dt.quarter() == 2)
+        .then(polars.datetime(year, 8, 14))
+        .when(month.dt.quarter() == 3)
+        .then(polars.datetime(year, 11, 14))
+        .otherwise(polars.datetime(year + 1, 3, 31))
+        .dt.cast_time_unit("us")
+    )
+    revenue = polars.col("當月營收")
+    # A quarter with a month of NaN sums to NaN, as the sum of the pandas one
+    cust = (
+        _scan(revenues[["當月營收"]])
+        .with_columns(ifrs_ts.alias(util.TIME_COL_NAME))
+        .group_by(util.TIMED_INDEX_COLs)
+        .agg(
+            polars.when(revenue.count() == polars.len())
+            .then(revenue.sum())
+            .alias("(C)營收合計"),
+            polars.len().cast(polars.Int64).alias("(C)合計月數"),
+        )
+        .with_columns(
+            (polars.col("(C)營收合計") / polars.col("(C)合計月數")).alias(
+                "(C)平均月營收"
+            )
+        )
+    )
+
+    assets, equity = polars.col("資產總計"), polars.col("權益總額")
+    income, sales = polars.col("本期淨利（淨損）"), polars.col("營業收入合計")
+    df = (
+        _scan(balance_sheet_metatime[["created_ts"]])
+        .join(
+            _scan(balance_sheets[profit.BALANCE_SHEET_COLs]),
+            on=util.TIMED_INDEX_COLs,
+            maintain_order="left",
+        )
+        .join(
+            _scan(income_sheets[profit.INCOME_SHEET_COLs]),
+            on=util.TIMED_INDEX_COLs,
+            maintain_order="left",
+        )
+        .with_columns(
+            (income / assets * 100).alias("ROA"),
+            (income / equity * 100).alias("ROE"),
+            ((assets - equity) / assets * 100).alias("DBR"),
+            (polars.col("營業毛利（毛損）") / sales * 100).alias("GPM"),
+            (income / sales * 100).alias("NIM"),
+        )
+        .join(cust, on=util.TIMED_INDEX_COLs, maintain_order="left")
+        .select(
+            *util.TIMED_INDEX_COLs,
+            *profit.BALANCE_SHEET_COLs,
+            "created_ts",
+            *profit.INCOME_SHEET_COLs,
+            *profit.RATIO_COLs,
+            *profit.CUST_PROFIT_COLs,
+        )
+        .collect()
+    )
+    return _to_pandas(df, util.TIMED_INDEX_COLs)
+
+
+def analyze_profit(
+    anal_per: pandas.DataFrame,
+    his_profits: pandas.DataFrame,
+    daily_price: pandas.DataFrame,
+    ifrs_ts: datetime.datetime,
+) -> pandas.DataFrame:
+    """
+    The `dataset.anal_profit` of the quarter `ifrs_ts`, from the profitability of the
+    quarter and the 4 before it
+    """
+    ifrs_iter = util.IFRSDateIter(ifrs_dt=ifrs_ts)
+    quarters = [ifrs_iter.current_ifrs_dt()] + [
+        ifrs_iter.previous_ifrs_dt() for _ in range(4)
+    ]
+    his = _scan(his_profits)
+
+    def quarter(q: int) -> polars.LazyFrame:
+        df = his.filter(TS == quarters[q]).drop(util.TIME_COL_NAME)
+        if q == 0:
+            return df
+        return df.select(
+            CODE, polars.exclude(util.SECURITY_ID_NAME).name.suffix(f"_q{q}")
+        )
+
+    # The outer merge of pandas sorts the codes
+    lf = (
+        _scan(anal_per)
+        .join(quarter(0), on=util.SECURITY_ID_NAME, how="full", coalesce=True)
+        .sort(util.SECURITY_ID_NAME)
+    )
+    for q in range(1, 5):
+        lf = lf.join(
+            quarter(q), on=util.SECURITY_ID_NAME, how="left", maintain_order="left"
+        )
+    lf = lf.rename(
+        {
+            "基本每股盈餘合計": "E(0)",
+            "基本每股盈餘合計_q1": "E(1)",
+            "基本每股盈餘合計_q2": "E(2)",
+            "基本每股盈餘合計_q3": "E(3)",
+            "基本每股盈餘合計_q4": "E(4)",
+            "營業外收入及支出合計": "外(0)",
+            "營業外收入及支出合計_q1": "外(1)",
+            "營業外收入及支出合計_q2": "外(2)",
+            "營業外收入及支出合計_q3": "外(3)",
+            "營業外收入及支出合計_q4": "外(4)",
+            "GPM": "GPM(0)",
+            "NIM": "NIM(0)",
+            "ROA": "ROA(0)",
+            "ROE": "ROE(0)",
+            "DBR": "DBR(0)",
+        }
+    )
+
+    def row(column: str) -> list[polars.Expr]:
+        """The values of the quarter and the 3 before it, NaN skipped as by pandas"""
+        names = (
+            ["E(0)", "E(1)", "E(2)", "E(3)"]
+            if column == "E"
+            else [f"{column}(0)", f"{column}_q1", f"{column}_q2", f"{column}_q3"]
+        )
+        return [polars.col(name).fill_nan(None) for name in names]
+
+    def change(column: str, previous: str) -> polars.Expr:
+        return (polars.col(column) - polars.col(previous)) / polars.col(previous) * 100
+
+    income = polars.col("本期淨利（淨損）")
+    lf = (
+        _scan(daily_price[["收盤價", "漲跌幅(%)"]])
+        .join(lf, on=util.SECURITY_ID_NAME, how="right", maintain_order="right")
+        .with_columns(
+            polars.sum_horizontal(row("E")).alias("E(Sum)"),
+            polars.mean_horizontal(row("E")).alias("E(Avg)"),
+            polars.concat_list(row("E")).list.std().alias("E(Std)"),
+            polars.sum_horizontal(row("E")).alias("EPS"),
+            (income / polars.col("普通股股本") * 10).alias("(C)EPS"),
+        )
+        .with_columns(
+            (polars.col("收盤價") / (polars.col("(C)EPS") * 4)).alias("(C)PER"),
+            (polars.col("外(0)") / income * 100).alias("外(0)"),
+            (polars.col("外(1)") / polars.col("本期淨利（淨損）_q1") * 100).alias(
+                "外(1)"
+            ),
+            (polars.col("外(2)") / polars.col("本期淨利（淨損）_q2") * 100).alias(
+                "外(2)"
+            ),
+            (polars.col("外(3)") / polars.col("本期淨利（淨損）_q3") * 100).alias(
+                "外(3)"
+            ),
+            polars.sum_horizontal(row("NIM")).alias("NIM"),
+            polars.sum_horizontal(row("GPM")).alias("GPM"),
+            polars.sum_horizontal(row("ROA")).alias("ROA"),
+            polars.sum_horizontal(row("ROE")).alias("ROE"),
+            polars.mean_horizontal(row("DBR")).alias("DBR"),
+            (polars.col("E(0)") - polars.col("E(1)")).alias("EPS(0)+"),
+            (polars.col("GPM(0)") - polars.col("GPM_q1")).alias("GPM+"),
+            (polars.col("NIM(0)") - polars.col("NIM_q1")).alias("NIM+"),
+            (polars.col("ROA(0)") - polars.col("ROA_q1")).alias("ROA+"),
+            (polars.col("ROE(0)") - polars.col("ROE_q1")).alias("ROE+"),
+            (polars.col("DBR(0)") - polars.col("DBR_q1")).alias("DBR+"),
+            change("普通股股本", "普通股股本_q1").alias("股本(%)+"),
+            change("資產總計", "資產總計_q1").alias("資產(%)+"),
+            change("權益總額", "權益總額_q1").alias("權益(%)+"),
+            change("本期淨利（淨損）", "本期淨利（淨損）_q4").alias("YoYQ"),
+            change("本期淨利（淨損）", "本期淨利（淨損）_q1").alias("QoQ"),
+            (
+                (income > polars.col("本期淨利（淨損）_q1"))
+                & (
+                    polars.col("本期淨利（淨損）_q1")
+                    > polars.col("本期淨利（淨損）_q2")
+                )
+            )
+            .fill_null(False)
+            .alias("IsQ3"),
+            (
+                (polars.col("E(0)") - polars.col("E(4)")) / polars.col("E(0)") * 100
+            ).alias("YoE"),
+            change("E(0)", "E(1)").alias("QoE"),
+            (
+                (polars.col("E(0)") > polars.col("E(1)"))
+                & (polars.col("E(1)") > polars.col("E(2)"))
+            )
+            .fill_null(False)
+            .alias("IsE3"),
+        )
+    )
+    return _to_pandas(lf.collect(), [util.SECURITY_ID_NAME])
+
+
+def _scan(df: pandas.DataFrame) -> polars.LazyFrame:
+    """`df` with its index as columns"""
+    return polars.from_pandas(df, include_index=True).lazy()
+
+
+def _to_pandas(
+    df: polars.DataFrame, index_col: Optional[list[str]]
+) -> pandas.DataFrame:
+    return df.to_pandas().set_index(index_col)
@@ -2,32 +2,24 @@ import calendar
 import datetime
 import logging
 import sqlite3
-from typing import Optional, Union
+from typing import Any, Optional, Union
 
 import MySQLdb
 import numpy
 import pandas
-import requests
 
-from .. import util
+from .. import instrument, util
 
 PERA_TB_NAME = "pera"
 PERA_TB_COLs = ["殖利率(%)", "股利年度", "本益比", "股價淨值比", "每股股利(註)"]
 
 
 def extract(ts: datetime.datetime) -> pandas.DataFrame:
-    if ts.date() > datetime.date.today():
-        raise util.YiException(f"The date `{ts}` must be in the past.")
-
-    if (weekday := calendar.weekday(ts.year, ts.month, ts.day)) in (5, 6):
-        weekdays = {5: "Saturday", 6: "Sunday"}
-        raise util.YiException(f"The date `{ts}` is {weekdays[weekday]}.")
-
     # TWSE
-    twse_df = _crawl_pera_from_twse(ts)
+    twse_df = extract_market(ts, "twse")
     # TPEX
     try:
-        tpex_df = _crawl_pera_from_tpex(ts)
+        tpex_df = extract_market(ts, "tpex")
     except util.YiException as e:
         logging.warning(str(e))
         tpex_df = pandas.DataFrame()
@@ -36,35 +28,78 @@ def extract(ts: datetime.datetime) -> pandas.DataFrame:
     return df[PERA_TB_COLs]
 
 
+def extract_market(ts: datetime.datetime, market: str) -> pandas.DataFrame:
+    """The PER analyses of one market, "twse" or "tpex" """
+    return parse_market(fetch_market(ts, market), ts, market)
+
+
+def fetch_market(ts: datetime.datetime, market: str) -> dict:
+    """The payload of the PER analyses of one market, parsed by `parse_market`"""
+    if ts.date() > datetime.date.today():
+        raise util.YiException(f"The date `{ts}` must be in the past.")
+
+    if (weekday := calendar.weekday(ts.year, ts.month, ts.day)) in (5, 6):
+        weekdays = {5: "Saturday", 6: "Sunday"}
+        raise util.YiException(f"The date `{ts}` is {weekdays[weekday]}.")
+
+    fetchers = {"twse": _fetch_pera_from_twse, "tpex": _fetch_pera_from_tpex}
+    return fetchers[market](ts)
+
+
+def parse_market(data: dict, ts: datetime.datetime, market: str) -> pandas.DataFrame:
+    parsers = {"twse": _parse_pera_from_twse, "tpex": _parse_pera_from_tpex}
+    with instrument.stage("parse", source=f"{market}_pera") as record:
+        df = parsers[market](data, ts)
+        record.rows = len(df)
+
+    return df[PERA_TB_COLs]
+
+
 def read_sql(
     conn: Union[sqlite3.Connection, MySQLdb.Connection],
     sql: Optional[str] = None,
+    codes: Optional[list[str]] = None,
+    params: Optional[dict[str, Any]] = None,
+    start_time: Optional[datetime.datetime] = None,
 ) -> pandas.DataFrame:
-    sql = sql or f"SELECT * FROM `{PERA_TB_NAME}`;"
-    df = pandas.read_sql(
+    """
+    The PER analyses since `start_time` of `codes` if given, or by `sql` with the
+    `:name` of `params`. A row is the analysis of a year, dated its December 31, as
+    the days of a year replace each other.
+    """
+    _start_time = start_time or datetime.datetime(1990, 1, 1)
+    sql = sql or f"""
+        SELECT * FROM `{PERA_TB_NAME}`
+        WHERE 1
+            AND `{util.TIME_COL_NAME}` >= :start_time
+            {util.codes_clause(codes)}
+        ;"""
+    df = util.read_sql(
         sql,
-        con=conn,
-        index_col=util.TIMED_INDEX_COLs,
-        parse_dates=[util.TIME_COL_NAME],
+        conn,
+        params={"codes": codes, "start_time": str(_start_time), **(params or {})},
     )
 
     return df
 
 
-def _crawl_pera_from_twse(ts: datetime.datetime) -> pandas.DataFrame:
+def _fetch_pera_from_twse(ts: datetime.datetime) -> dict:
     # Download page
     url = (
-        "https://www.twse.com.tw/rwd/zh/afterTrading/BWIBBU_d?"
+        f"{util.get_exchange_url('TWSE')}/rwd/zh/afterTrading/BWIBBU_d?"
         f"date={ts.year}{ts.month:02d}{ts.day:02d}&selectType=ALL&response=json"
     )
-    response = requests.get(url)
+    response = util.fetch(url, source="twse_pera")
 
     # Return empty DataFrame
-    response.raise_for_status()
-    data = response.json()
+    data = response.json() if response.text else {}
     if len(data.get("data", [])) == 0:
         raise util.YiException(f"The PER-analysis table could not be found on `{url}`.")
 
+    return data
+
+
+def _parse_pera_from_twse(data: dict, ts: datetime.datetime) -> pandas.DataFrame:
     df = pandas.DataFrame(
         data["data"],
         columns=data["fields"],
@@ -83,12 +118,14 @@ def _crawl_pera_from_twse(ts: datetime.datetime) -> pandas.DataFrame:
 
     # Convert all the scalar to number
     # error='coerce', will set NaN for all the scalars which are invalid parsed
-    df = df.apply(lambda scalar: pandas.to_numeric(scalar, errors="coerce"))
+    with instrument.stage("coerce", source="twse_pera") as record:
+        df = df.apply(lambda scalar: pandas.to_numeric(scalar, errors="coerce"))
+        record.rows = len(df)
 
     # Cutout the columns consist of empty value
     df = df[df.columns[df.isnull().all() == False]]
 
-    df["每股股利(註)"] = numpy.NaN
+    df["每股股利(註)"] = numpy.nan
     if "股利年度" not in df.columns:
         df["股利年度"] = ts.year - 1911
 
@@ -99,20 +136,23 @@ def _crawl_pera_from_twse(ts: datetime.datetime) -> pandas.DataFrame:
     return df[PERA_TB_COLs]
 
 
-def _crawl_pera_from_tpex(ts: datetime.datetime) -> pandas.DataFrame:
+def _fetch_pera_from_tpex(ts: datetime.datetime) -> dict:
     # Download page
     url = (
-        "https://www.tpex.org.tw/web/stock/aftertrading/peratio_analysis/pera_result.php?"
+        f"{util.get_exchange_url('TPEX')}/web/stock/aftertrading/peratio_analysis/pera_result.php?"
         f"l=zh-tw&d={ts.year - 1911}/{ts.month:02d}/{ts.day:02d}&c="
     )
-    response = requests.get(url)
+    response = util.fetch(url, source="tpex_pera")
 
     # Raise ValueError if empty data
-    response.raise_for_status()
-    data = response.json()
+    data = response.json() if response.text else {}
     if len(data.get("aaData", [])) == 0:
         raise util.YiException(f"The PER-analysis table could not be found on `{url}`.")
 
+    return data
+
+
+def _parse_pera_from_tpex(data: dict, ts: datetime.datetime) -> pandas.DataFrame:
     df = pandas.DataFrame(
         data["aaData"],
         columns=[
@@ -139,7 +179,9 @@ def _crawl_pera_from_tpex(ts: datetime.datetime) -> pandas.DataFrame:
 
     # Convert all the scalar to number
     # error='coerce', will set NaN for all the scalars which are invalid parsed
-    df = df.apply(lambda scalar: pandas.to_numeric(scalar, errors="coerce"))
+    with instrument.stage("coerce", source="tpex_pera") as record:
+        df = df.apply(lambda scalar: pandas.to_numeric(scalar, errors="coerce"))
+        record.rows = len(df)
 
     # Cutout the columns consist of empty value
     df = df[df.columns[df.isnull().all() == False]]
@@ -3,15 +3,14 @@ import datetime
 import io
 import logging
 import sqlite3
-from typing import Union
+from typing import Optional, Union
 
 import MySQLdb
 import numpy
 import pandas
-import requests
 from dateutil.relativedelta import relativedelta
 
-from stock_tw import util
+from stock_tw import instrument, util
 
 PRICE_TB_NAME = "daily_price"
 PRICE_TB_COLs = [
@@ -33,18 +32,11 @@ PRICE_TB_COLs = [
 
 
 def extract(ts: datetime.datetime) -> pandas.DataFrame:
-    if ts.date() > datetime.date.today():
-        raise ValueError(f"The date `{ts}` must be in the past.")
-
-    if weekday := calendar.weekday(ts.year, ts.month, ts.day) in (5, 6):
-        weekdays = {5: "Saturday", 6: "Sunday"}
-        raise ValueError(f"The date `{ts}` is {weekdays[weekday]}.")
-
     # TWSE
-    twse_df = _crawl_daily_price_from_twse(ts)[PRICE_TB_COLs]
+    twse_df = extract_market(ts, "twse")
     # TPEX
     try:
-        tpex_df = _crawl_daily_price_from_tpex(ts)[PRICE_TB_COLs]
+        tpex_df = extract_market(ts, "tpex")
     except util.YiException as e:
         logging.warning(str(e))
         tpex_df = pandas.DataFrame()
@@ -53,20 +45,54 @@ def extract(ts: datetime.datetime) -> pandas.DataFrame:
     return df
 
 
+def extract_market(ts: datetime.datetime, market: str) -> pandas.DataFrame:
+    """The prices of one market, "twse" or "tpex" """
+    return parse_market(fetch_market(ts, market), ts, market)
+
+
+def fetch_market(ts: datetime.datetime, market: str) -> Union[str, dict]:
+    """The payload of the prices of one market, parsed by `parse_market`"""
+    if ts.date() > datetime.date.today():
+        raise ValueError(f"The date `{ts}` must be in the past.")
+
+    if (weekday := calendar.weekday(ts.year, ts.month, ts.day)) in (5, 6):
+        weekdays = {5: "Saturday", 6: "Sunday"}
+        raise ValueError(f"The date `{ts}` is {weekdays[weekday]}.")
+
+    fetchers = {
+        "twse": _fetch_daily_price_from_twse,
+        "tpex": _fetch_daily_price_from_tpex,
+    }
+    return fetchers[market](ts)
+
+
+def parse_market(
+    payload: Union[str, dict], ts: datetime.datetime, market: str
+) -> pandas.DataFrame:
+    parsers = {
+        "twse": _parse_daily_price_from_twse,
+        "tpex": _parse_daily_price_from_tpex,
+    }
+    with instrument.stage("parse", source=f"{market}_price") as record:
+        df = parsers[market](payload, ts)
+        record.rows = len(df)
+
+    return df[PRICE_TB_COLs]
+
+
 def read_sql(
     conn: Union[sqlite3.Connection, MySQLdb.Connection],
     start_time: datetime.datetime = None,
+    codes: Optional[list[str]] = None,
 ) -> pandas.DataFrame:
     _start_time = start_time or (datetime.datetime.now() - relativedelta(days=10))
 
-    df = pandas.read_sql(
-        (
-            f"SELECT * FROM `{PRICE_TB_NAME}` WHERE `{util.TIME_COL_NAME}` >="
-            f" '{_start_time}';"
-        ),
-        con=conn,
-        index_col=util.TIMED_INDEX_COLs,
-        parse_dates=[util.TIME_COL_NAME],
+    df = util.read_sql(
+        f"""
+        SELECT * FROM `{PRICE_TB_NAME}`
+        WHERE `{util.TIME_COL_NAME}` >= :start_time {util.codes_clause(codes)};""",
+        conn,
+        params={"start_time": str(_start_time), "codes": codes},
     )
 
     return df
@@ -89,21 +115,24 @@ def write_sqlite3(
     return len(merged_df) - len(existing_df)
 
 
-def _crawl_daily_price_from_twse(ts: datetime.datetime) -> pandas.DataFrame:
+def _fetch_daily_price_from_twse(ts: datetime.datetime) -> str:
     # Download page
     url = (
-        "https://www.twse.com.tw/exchangeReport/MI_INDEX?"
+        f"{util.get_exchange_url('TWSE')}/exchangeReport/MI_INDEX?"
         f"response=csv&date={ts.year}{ts.month:02d}{ts.day:02d}&type=ALLBUT0999"
     )
-    response = requests.get(url)
+    response = util.fetch(url, source="twse_price")
 
     # Raise ValueError if empty data
-    response.raise_for_status()
     if response.text == "":
         raise util.YiException(f"The daily price table could not be found on `{url}`.")
 
+    return response.text
+
+
+def _parse_daily_price_from_twse(text: str, ts: datetime.datetime) -> pandas.DataFrame:
     # Replace the character '=' with an empty string in the response body
-    content = response.text.replace("=", "")
+    content = text.replace("=", "")
 
     # Filter the rows with at least 12 columns
     lines = content.split("\n")
@@ -132,7 +161,9 @@ def _crawl_daily_price_from_twse(ts: datetime.datetime) -> pandas.DataFrame:
 
     # Convert all the scalar to number
     # error='coerce', will set NaN for all the scalars which are invalid parsed
-    df = df.apply(lambda scalar: pandas.to_numeric(scalar, errors="coerce"))
+    with instrument.stage("coerce", source="twse_price") as record:
+        df = df.apply(lambda scalar: pandas.to_numeric(scalar, errors="coerce"))
+        record.rows = len(df)
 
     # Cutout the columns consist of empty value
     df = df[df.columns[df.isnull().all() == False]]
@@ -141,27 +172,28 @@ def _crawl_daily_price_from_twse(ts: datetime.datetime) -> pandas.DataFrame:
 
     # check columns
     if set(PRICE_TB_COLs) - set(df.columns):
-        raise TypeError(
-            f"Miss columns {set(PRICE_TB_COLs) - set(df.columns)} from `{url}`."
-        )
+        raise TypeError(f"Miss expected columns {set(PRICE_TB_COLs) - set(df.columns)}")
 
     return df
 
 
-def _crawl_daily_price_from_tpex(ts: datetime.datetime) -> pandas.DataFrame:
+def _fetch_daily_price_from_tpex(ts: datetime.datetime) -> dict:
     # Download page
     url = (
-        "https://www.tpex.org.tw/web/stock/aftertrading/otc_quotes_no1430/stk_wn1430_result.php?"
+        f"{util.get_exchange_url('TPEX')}/web/stock/aftertrading/otc_quotes_no1430/stk_wn1430_result.php?"
         f"l=zh-tw&d={ts.year - 1911}/{ts.month:02d}/{ts.day:02d}&se=EW"
     )
-    response = requests.get(url)
+    response = util.fetch(url, source="tpex_price")
 
     # Raise ValueError if empty data
-    response.raise_for_status()
-    data = response.json()
+    data = response.json() if response.text else {}
     if len(data.get("aaData", [])) == 0:
         raise util.YiException(f"The daily price table could not be found on `{url}`.")
 
+    return data
+
+
+def _parse_daily_price_from_tpex(data: dict, ts: datetime.datetime) -> pandas.DataFrame:
     df = pandas.DataFrame(
         data["aaData"],
         columns=[
@@ -213,13 +245,15 @@ def _crawl_daily_price_from_tpex(ts: datetime.datetime) -> pandas.DataFrame:
 
     # Convert all the scalar to number
     # error='coerce', will set NaN for all the scalars which are invalid parsed
-    df = df.apply(lambda scalar: pandas.to_numeric(scalar, errors="coerce"))
+    with instrument.stage("coerce", source="tpex_price") as record:
+        df = df.apply(lambda scalar: pandas.to_numeric(scalar, errors="coerce"))
+        record.rows = len(df)
 
     # Cutout the columns consist of empty value
     # df = df[df.columns[df.isnull().all() == False]]
 
     df["漲跌幅(%)"] = df["漲跌價差"] / df["收盤價"] * 100
-    df["本益比"] = numpy.NaN
+    df["本益比"] = numpy.nan
 
     # check columns
     if set(PRICE_TB_COLs) - set(df.columns):
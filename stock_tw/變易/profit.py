@@ -0,0 +1,311 @@
+"""
+The profitability of the companies by quarter, ROA, ROE, DBR, GPM and NIM of the
+statements together with the revenues summed by quarter, the `dataset.his_profits`.
+
+It is materialized in the SQLite3 table `his_profit` by `refresh`, which recomputes only
+the (ts, code) touched since the watermarks of its sources, kept in the table
+`his_profit_watermark`: the `updated_ts` of the statements in SQLite3, the `created_ts`
+of `balance_sheet_metatime` and the `updated_ts` of `monthly_revenue` in MySQL. The
+times are of seconds, a row may come later in the second of a watermark, so the rows at
+a watermark are read again and their (ts, code) recomputed, which is idempotent.
+"""
+
+import collections
+import datetime
+import logging
+import sqlite3
+from typing import Optional
+
+import pandas
+import sqlalchemy
+from dateutil.relativedelta import relativedelta
+
+from stock_tw import util
+from stock_tw.變易 import revenue
+from stock_tw.變易.fin_stmt import balance_sheet, income_sheet
+
+HIS_PROFIT_TB_NAME = "his_profit"
+WATERMARK_TB_NAME = "his_profit_watermark"
+METATIME_TB_NAME = f"{balance_sheet.BALANCE_TB_NAME}_metatime"
+
+# The accounts of the statements kept in `his_profit`
+BALANCE_SHEET_COLs = ["普通股股本", "資產總計", "權益總額"]
+INCOME_SHEET_COLs = [
+    "基本每股盈餘合計",
+    "營業外收入及支出合計",
+    "營業毛利（毛損）",
+    "營業毛利（毛損）淨額",
+    "本期淨利（淨損）",
+    "營業收入合計",
+    "繼續營業單位稅前淨利（淨損）",
+    "繼續營業單位本期淨利（淨損）",
+    "母公司業主（淨利／損）",
+    "繼續營業單位淨利（淨損）",
+    "停業單位淨利（淨損）",
+]
+RATIO_COLs = ["ROA", "ROE", "DBR", "GPM", "NIM"]
+# The revenues of the quarter, to compare with "營業收入合計"
+CUST_PROFIT_COLs = ["(C)營收合計", "(C)平均月營收", "(C)合計月數"]
+HIS_PROFIT_TB_DTYPEs = {
+    **{column: "REAL" for column in BALANCE_SHEET_COLs},
+    "created_ts": "TEXT",
+    **{column: "REAL" for column in INCOME_SHEET_COLs + RATIO_COLs},
+    "(C)營收合計": "REAL",
+    "(C)平均月營收": "REAL",
+    "(C)合計月數": "INTEGER",
+}
+
+# The first watermark of a source, older than any of its rows
+INITIAL_WATERMARK = "1900-01-01 00:00:00"
+
+
+def calculate(
+    balance_sheet_metatime: pandas.DataFrame,
+    balance_sheets: pandas.DataFrame,
+    income_sheets: pandas.DataFrame,
+    revenues: pandas.DataFrame,
+) -> pandas.DataFrame:
+    """The quarters which are in all of the statements, the metatime and the revenues"""
+    # 損益表["營業毛利（毛損）", "本期淨利（淨損）", "營業收入合計"]
+    # 加入資產負債表["普通股股本", "資產總計", "權益總額"]
+    tmp = balance_sheet_metatime.merge(
+        balance_sheets[BALANCE_SHEET_COLs], on=util.TIMED_INDEX_COLs
+    )[BALANCE_SHEET_COLs + ["created_ts"]]
+    tmp = tmp.merge(income_sheets[INCOME_SHEET_COLs], on=util.TIMED_INDEX_COLs)
+    tmp["ROA"] = tmp["本期淨利（淨損）"] / tmp["資產總計"] * 100
+    tmp["ROE"] = tmp["本期淨利（淨損）"] / tmp["權益總額"] * 100
+    tmp["DBR"] = (tmp["資產總計"] - tmp["權益總額"]) / tmp["資產總計"] * 100
+    tmp["GPM"] = tmp["營業毛利（毛損）"] / tmp["營業收入合計"] * 100
+    tmp["NIM"] = tmp["本期淨利（淨損）"] / tmp["營業收入合計"] * 100
+
+    # 加入月營收，以季合計，作為與損益表["營業收入合計"] 做對照
+    ifrs_dated_revenues = collections.defaultdict(list)
+    for (ts, code), _revenue in revenues["當月營收"].items():
+        dt = ts - relativedelta(months=1)  # '2023-06-10' represent '2023-05's revenue
+        ifrs_date = util.IFRSDateIter.dt_in_ifrs_dt(dt)
+        ifrs_dated_revenues[(ifrs_date, code)].append(_revenue)
+    values = (
+        (
+            ts,
+            code,
+            sum(_revenues),
+            sum(_revenues) / len(_revenues),
+            len(_revenues),
+        )
+        for (ts, code), _revenues in ifrs_dated_revenues.items()
+    )
+    cust_tmp = pandas.DataFrame(
+        values, columns=util.TIMED_INDEX_COLs + CUST_PROFIT_COLs
+    )
+    cust_tmp.set_index(util.TIMED_INDEX_COLs, inplace=True)
+
+    # 合併 cust_tmp["(C)營收合計", "(C)平均月營收","(C)合計月數"]
+    return tmp.merge(cust_tmp, on=util.TIMED_INDEX_COLs)
+
+
+def create_tables(conn: sqlite3.Connection):
+    _columns = ",\n".join(
+        f"`{column}` {dtype}" for column, dtype in HIS_PROFIT_TB_DTYPEs.items()
+    )
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS `{HIS_PROFIT_TB_NAME}` (
+            `ts` TEXT NOT NULL,
+            `code` TEXT NOT NULL,
+            {_columns},
+            PRIMARY KEY (`ts`, `code`)
+        ) WITHOUT ROWID;""")
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS `{WATERMARK_TB_NAME}` (
+            `source` TEXT NOT NULL PRIMARY KEY,
+            `watermark` TEXT NOT NULL,
+            `updated_ts` TEXT NOT NULL
+        );""")
+    conn.commit()
+
+
+def read_sql(
+    conn: sqlite3.Connection,
+    start_time: datetime.datetime = None,
+    codes: Optional[list[str]] = None,
+) -> pandas.DataFrame:
+    _start_time = start_time or (datetime.datetime.now() - relativedelta(years=6))
+    _fields = ", ".join(
+        f"`{field}`" for field in util.TIMED_INDEX_COLs + list(HIS_PROFIT_TB_DTYPEs)
+    )
+    sql_stmt = f"""
+        SELECT {_fields}
+        FROM `{HIS_PROFIT_TB_NAME}`
+        WHERE 1
+            AND `{util.TIME_COL_NAME}` >= :start_time
+            {util.codes_clause(codes)}
+        ;"""
+
+    return util.read_sql(
+        sql_stmt,
+        conn,
+        parse_dates=[util.TIME_COL_NAME, "created_ts"],
+        params={"start_time": str(_start_time), "codes": codes},
+    )
+
+
+def read_watermarks(conn: sqlite3.Connection) -> dict[str, str]:
+    """The watermark by source, which `his_profit` is computed up to"""
+    create_tables(conn)
+    rows = conn.execute(f"SELECT `source`, `watermark` FROM `{WATERMARK_TB_NAME}`;")
+    return dict(rows)
+
+
+def refresh(conn: sqlite3.Connection, connection: sqlalchemy.Connection) -> int:
+    """
+    Recomputes the (ts, code) of `his_profit` touched by the rows of the sources at or
+    after their watermarks, then advances the watermarks, returns the count of the
+    touched (ts, code). The first refresh computes every quarter.
+    """
+    watermarks = read_watermarks(conn)
+    keys, new_watermarks = read_touched(conn, connection, watermarks)
+    if len(keys):
+        df = _calculate_keys(conn, connection, keys)
+        _write(conn, keys, df)
+        logging.info(
+            f"Recompute `{HIS_PROFIT_TB_NAME}` {len(keys)} quarters, {len(df)} rows"
+        )
+
+    now = str(datetime.datetime.now())
+    conn.executemany(
+        f"INSERT OR REPLACE INTO `{WATERMARK_TB_NAME}` VALUES (?, ?, ?);",
+        [
+            (source, watermark, now)
+            for source, watermark in new_watermarks.items()
+            if watermark != watermarks.get(source)
+        ],
+    )
+    conn.commit()
+    return len(keys)
+
+
+def read_touched(
+    conn: sqlite3.Connection,
+    connection: sqlalchemy.Connection,
+    watermarks: dict[str, str],
+) -> tuple[pandas.MultiIndex, dict[str, str]]:
+    """The (ts, code) touched since `watermarks`, and the watermarks of the sources"""
+    touched = []
+    new_watermarks = {}
+
+    def read_source(source: str, sql_stmt: str, db) -> pandas.DataFrame:
+        watermark = watermarks.get(source, INITIAL_WATERMARK)
+        df = util.read_sql(sql_stmt, db, params={"watermark": watermark})
+        new_watermarks[source] = max(
+            [watermark] + [str(ts) for ts in df["source_ts"].dropna()]
+        )
+        return df
+
+    # The statements, whose `updated_ts` is written by `mops`
+    for table_name in [balance_sheet.BALANCE_TB_NAME, income_sheet.INCOME_TB_NAME]:
+        if not util.is_table_existed_in_sqlite3(table_name, con=conn):
+            continue
+        df = read_source(
+            table_name,
+            f"""
+            SELECT `ts`, `code`, `updated_ts` AS `source_ts`
+            FROM `{table_name}`
+            WHERE `updated_ts` >= :watermark;""",
+            conn,
+        )
+        touched.append(df.index)
+
+    # The companies stamped in MySQL, see `ingest.load_balance_sheet_metatime`
+    df = read_source(
+        METATIME_TB_NAME,
+        f"""
+        SELECT `ts`, `code`, `created_ts` AS `source_ts`
+        FROM `{METATIME_TB_NAME}`
+        WHERE `created_ts` >= :watermark;""",
+        connection,
+    )
+    touched.append(df.index)
+
+    # The revenues, by the quarter of their month
+    df = read_source(
+        revenue.REVENUE_TB_NAME,
+        f"""
+        SELECT `ts`, `code`, `updated_ts` AS `source_ts`
+        FROM `{revenue.REVENUE_TB_NAME}`
+        WHERE `updated_ts` >= :watermark;""",
+        connection,
+    )
+    months = df.index.get_level_values(util.TIME_COL_NAME)
+    ifrs_dts = {
+        ts: util.IFRSDateIter.dt_in_ifrs_dt(ts - relativedelta(months=1))
+        for ts in months.unique()
+    }
+    touched.append(
+        pandas.MultiIndex.from_arrays(
+            [
+                pandas.DatetimeIndex(months.map(ifrs_dts)),
+                df.index.get_level_values(util.SECURITY_ID_NAME),
+            ],
+            names=util.TIMED_INDEX_COLs,
+        )
+    )
+
+    keys = touched[0]
+    for index in touched[1:]:
+        keys = keys.union(index)
+    return keys.unique(), new_watermarks
+
+
+def _calculate_keys(
+    conn: sqlite3.Connection,
+    connection: sqlalchemy.Connection,
+    keys: pandas.MultiIndex,
+) -> pandas.DataFrame:
+    """`calculate` of the (ts, code) of `keys` only"""
+    codes = sorted(keys.get_level_values(util.SECURITY_ID_NAME).unique())
+    start_time = keys.get_level_values(util.TIME_COL_NAME).min()
+
+    balance_sheet_metatime = util.read_sql(
+        f"""
+        SELECT `code`, `ts`, `created_ts`
+        FROM `{METATIME_TB_NAME}`
+        WHERE `{util.TIME_COL_NAME}` >= :start_time {util.codes_clause(codes)};""",
+        connection,
+        params={"start_time": str(start_time), "codes": codes},
+    )
+    balance_sheets = balance_sheet.read_sql(
+        conn, start_time=start_time, columns=BALANCE_SHEET_COLs, codes=codes
+    )
+    income_sheets = income_sheet.read_sql(
+        conn, start_time=start_time, columns=INCOME_SHEET_COLs, codes=codes
+    )
+    # The months of the first quarter, which begins 6 months before its Q4 deadline
+    revenues = revenue.read_sql(
+        connection, start_time=start_time - relativedelta(months=6), codes=codes
+    )
+
+    df = calculate(balance_sheet_metatime, balance_sheets, income_sheets, revenues)
+    # A (ts, code) kept twice in the wide statements is written once
+    df = df[~df.index.duplicated(keep="last")]
+    return df[df.index.isin(keys)]
+
+
+def _write(conn: sqlite3.Connection, keys: pandas.MultiIndex, df: pandas.DataFrame):
+    """Replaces the rows of `keys` by those of `df`, a key without a row is removed"""
+    conn.executemany(
+        f"DELETE FROM `{HIS_PROFIT_TB_NAME}` WHERE `ts` = ? AND `code` = ?;",
+        [(str(ts), code) for ts, code in keys],
+    )
+
+    df = df[list(HIS_PROFIT_TB_DTYPEs)].astype(object)
+    df["created_ts"] = df["created_ts"].map(
+        lambda ts: None if pandas.isna(ts) else str(ts)
+    )
+    df = df.where(df.notnull(), None)
+    placeholders = ", ".join(["?"] * (len(HIS_PROFIT_TB_DTYPEs) + 2))
+    conn.executemany(
+        f"INSERT INTO `{HIS_PROFIT_TB_NAME}` VALUES ({placeholders});",
+        [
+            (str(ts), code, *values)
+            for (ts, code), values in zip(df.index, df.itertuples(index=False))
+        ],
+    )
@@ -0,0 +1,125 @@
+"""
+Cross-sectional ranks, percentiles and z-scores of (ts, code) panels.
+
+For every date, and optionally within every industry `group` of `security_list`, each
+metric gets three columns: `<metric>(R)` the rank (1 is the smallest value), `<metric>(P)`
+the percentile rank in (0, 1] and `<metric>(Z)` the z-score. All of them come from the
+same grouping of the panel, so a panel of all quarters is ranked without a loop:
+
+    ranks = rank.cross_section(dataset.his_profits, ["ROE", "GPM"])
+    top_decile = ranks[ranks["ROE(P)"] > 0.9]
+
+The results are stored in SQLite per date, so composite scores of several factors are
+read back and combined with `composite` instead of being re-ranked.
+"""
+
+import datetime
+import sqlite3
+from typing import Union
+
+import MySQLdb
+import pandas
+
+from stock_tw import util
+
+RANK_TB_PREFIX = "rank"
+GROUP_COL_NAME = "group"
+
+
+def cross_section(
+    panel: pandas.DataFrame,
+    metrics: list[str] = None,
+    groups: pandas.Series = None,
+) -> pandas.DataFrame:
+    """
+    Ranks `metrics` (default all numeric columns) of `panel` per date. `groups` maps a
+    code to its classification, e.g. `dataset.securities["group"]`, securities without
+    a group are ranked together.
+    """
+    metrics = metrics or list(panel.select_dtypes("number").columns)
+    values = panel[metrics]
+
+    keys = [values.index.get_level_values(util.TIME_COL_NAME)]
+    if groups is not None:
+        codes = values.index.get_level_values(util.SECURITY_ID_NAME)
+        keys.append(groups.reindex(codes).fillna("").to_numpy())
+    grouped = values.groupby(keys, sort=False)
+
+    ranks = grouped.rank(method="average")
+    percentiles = grouped.rank(method="average", pct=True)
+    means = grouped.transform("mean")
+    stds = grouped.transform("std")
+    z_scores = (values - means) / stds.where(stds != 0)
+
+    columns = {}
+    for metric in metrics:
+        columns[f"{metric}(R)"] = ranks[metric]
+        columns[f"{metric}(P)"] = percentiles[metric]
+        columns[f"{metric}(Z)"] = z_scores[metric]
+    df = pandas.DataFrame(columns, index=values.index)
+    if groups is not None:
+        df[GROUP_COL_NAME] = keys[1]
+
+    return df
+
+
+def composite(
+    ranks: pandas.DataFrame, weights: dict[str, float], kind: str = "P"
+) -> pandas.Series:
+    """
+    Weighted sum of the `kind` ("R", "P" or "Z") columns of `weights`' metrics, a
+    negative weight prefers small values, e.g. `{"ROE": 1, "本益比": -1}`.
+    """
+    columns = [f"{metric}({kind})" for metric in weights]
+    missing_columns = set(columns) - set(ranks.columns)
+    if missing_columns:
+        raise util.YiException(f"Miss rank columns {missing_columns}.")
+
+    score = sum(
+        ranks[column] * weight for column, weight in zip(columns, weights.values())
+    )
+    return score.rename("composite")
+
+
+def read_sql(
+    name: str,
+    conn: Union[sqlite3.Connection, MySQLdb.Connection],
+    start_time: datetime.datetime = None,
+    columns: list[str] = None,
+) -> pandas.DataFrame:
+    _start_time = start_time or datetime.datetime(1990, 1, 1)
+    if columns is None:
+        _fields = "*"
+    else:
+        _fields = ", ".join(f"`{field}`" for field in util.TIMED_INDEX_COLs + columns)
+
+    sql_stmt = f"""
+        SELECT {_fields}
+        FROM `{RANK_TB_PREFIX}_{name}`
+        WHERE 1
+            AND `{util.TIME_COL_NAME}` >= '{_start_time}'
+        ;"""
+
+    df = pandas.read_sql(
+        sql_stmt,
+        con=conn,
+        index_col=util.TIMED_INDEX_COLs,
+        parse_dates=[util.TIME_COL_NAME],
+    )
+
+    return df
+
+
+def write_sqlite3(df: pandas.DataFrame, name: str, conn: sqlite3.Connection) -> int:
+    """Replaces the stored ranks of the dates in `df`"""
+    table_name = f"{RANK_TB_PREFIX}_{name}"
+    if util.is_table_existed_in_sqlite3(table_name, con=conn):
+        dates = df.index.get_level_values(util.TIME_COL_NAME).unique()
+        conn.executemany(
+            f"DELETE FROM `{table_name}` WHERE `{util.TIME_COL_NAME}` = ?;",
+            [(str(ts),) for ts in dates],
+        )
+    df.sort_index().to_sql(table_name, con=conn, if_exists="append")
+    conn.commit()
+
+    return len(df)
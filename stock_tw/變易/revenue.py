@@ -0,0 +1,170 @@
+"""
+The monthly revenues the companies report to MOPS by the 10th of the next month, from
+its summary pages `t21sc03` of the listed (TWSE) and the OTC (TPEX) companies. A month
+is dated on the 10th of the next one, e.g. '2023-06-10' stands for the revenue of
+2023-05.
+
+The companies which reported a month are kept in the SQLite3 table
+`monthly_revenue_reported`, and the month is complete, so no longer polled, once every
+listed stock has reported. A poll upserts the rows which are new or corrected since the
+last one.
+"""
+
+import concurrent.futures
+import datetime
+import io
+import logging
+import sqlite3
+from typing import Optional, Union
+
+import MySQLdb
+import pandas
+from dateutil.relativedelta import relativedelta
+
+from stock_tw import instrument, util
+
+REVENUE_TB_NAME = "monthly_revenue"
+REVENUE_TB_COLs = ["當月營收", "當月累計營收", "去年累計營收"]
+REPORTED_TB_NAME = "monthly_revenue_reported"
+
+# market -> the path of its summary page on MOPS
+MARKET_PATHs = {"twse": "sii", "tpex": "otc"}
+
+
+def extract(ts: datetime.datetime) -> pandas.DataFrame:
+    """The revenues of both markets, fetched at the same time"""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(MARKET_PATHs)) as pool:
+        futures = {
+            market: pool.submit(extract_market, ts, market) for market in MARKET_PATHs
+        }
+
+    frames = []
+    for market, future in futures.items():
+        try:
+            frames.append(future.result())
+        except util.YiException as e:
+            logging.warning(str(e))
+    if not frames:
+        raise util.YiException(f"The revenues of `{ts}` are not published.")
+
+    return pandas.concat(frames)
+
+
+def extract_market(ts: datetime.datetime, market: str) -> pandas.DataFrame:
+    """The revenues of one market, "twse" or "tpex" """
+    return parse_market(fetch_market(ts, market), ts, market)
+
+
+def fetch_market(ts: datetime.datetime, market: str) -> str:
+    month = ts - relativedelta(months=1)
+    if month.date() >= datetime.date.today().replace(day=1):
+        raise util.YiException(f"The revenues of `{ts}` must be of a past month.")
+
+    url = (
+        f"{util.get_exchange_url('MOPS')}/nas/t21/{MARKET_PATHs[market]}/"
+        f"t21sc03_{month.year - 1911}_{month.month}_0.html"
+    )
+    response = util.fetch(url, source=f"{market}_revenue", html=True)
+    # The pages are in Big5 without a charset in the header
+    if "charset" not in response.headers.get("Content-Type", ""):
+        response.encoding = "cp950"
+    if "公司代號" not in response.text:
+        raise util.YiException(f"The revenue table could not be found on `{url}`.")
+
+    return response.text
+
+
+def parse_market(text: str, ts: datetime.datetime, market: str) -> pandas.DataFrame:
+    with instrument.stage("parse", source=f"{market}_revenue") as record:
+        # A table per industry, each with the two header rows
+        tables = pandas.read_html(io.StringIO(text), match="公司代號", thousands=None)
+        tables = [table for table in tables if table.shape[1] >= 10]
+        for table in tables:
+            table.columns = table.columns.get_level_values(-1)
+        df = pandas.concat(tables, ignore_index=True)
+
+        # Only the rows of companies, not the subtotals, by whole columns
+        codes = df["公司代號"].astype(str).str.strip()
+        df = df[codes.str.fullmatch(r"[0-9A-Z]{4,6}")]
+        df = pandas.DataFrame(
+            {
+                column: (
+                    pandas.to_numeric(
+                        df[column].astype(str).str.replace(",", ""), errors="coerce"
+                    ).to_numpy()
+                )
+                for column in REVENUE_TB_COLs
+            },
+            index=pandas.MultiIndex.from_arrays(
+                [
+                    pandas.DatetimeIndex([util.time2monthly_date(ts)] * len(df)),
+                    codes[df.index].to_numpy(),
+                ],
+                names=util.TIMED_INDEX_COLs,
+            ),
+        )
+        df = df[~df.index.duplicated(keep="last")]
+        record.rows = len(df)
+
+    return df[REVENUE_TB_COLs]
+
+
+def read_sql(
+    conn: Union[sqlite3.Connection, MySQLdb.Connection],
+    start_time: datetime.datetime = None,
+    sql_stmt: str = None,
+    codes: Optional[list[str]] = None,
+) -> pandas.DataFrame:
+    _start_time = start_time or (datetime.datetime.now() - relativedelta(years=2))
+    _fields = ", ".join(
+        f"`{field}`"
+        for field in util.TIMED_INDEX_COLs + ["updated_ts"] + REVENUE_TB_COLs
+    )
+
+    sql_stmt = sql_stmt or f"""
+        SELECT {_fields}
+        FROM `{REVENUE_TB_NAME}`
+        WHERE 1
+            AND `{util.TIME_COL_NAME}` >= :start_time
+            {util.codes_clause(codes)}
+        ;"""
+
+    df = util.read_sql(
+        sql_stmt,
+        conn,
+        parse_dates=[util.TIME_COL_NAME, "updated_ts"],
+        params={"start_time": str(_start_time), "codes": codes},
+    )
+
+    return df
+
+
+def create_reported(conn: sqlite3.Connection):
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS `{REPORTED_TB_NAME}` (
+            `ts` TEXT NOT NULL,
+            `code` TEXT NOT NULL,
+            `reported_ts` TEXT NOT NULL,
+            PRIMARY KEY (`ts`, `code`)
+        );""")
+    conn.commit()
+
+
+def read_reported(conn: sqlite3.Connection, ts: datetime.datetime) -> set[str]:
+    """The codes of the companies which reported the revenue of `ts`"""
+    create_reported(conn)
+    rows = conn.execute(
+        f"SELECT `code` FROM `{REPORTED_TB_NAME}` WHERE `ts` = ?;",
+        (str(util.time2monthly_date(ts)),),
+    )
+    return {code for (code,) in rows}
+
+
+def write_reported(conn: sqlite3.Connection, ts: datetime.datetime, codes: list[str]):
+    create_reported(conn)
+    now = str(datetime.datetime.now())
+    conn.executemany(
+        f"INSERT OR IGNORE INTO `{REPORTED_TB_NAME}` VALUES (?, ?, ?);",
+        [(str(util.time2monthly_date(ts)), code, now) for code in codes],
+    )
+    conn.commit()
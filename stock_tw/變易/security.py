@@ -1,7 +1,10 @@
+import dataclasses
+import logging
 import sqlite3
 from typing import Optional, Union
 
 import MySQLdb
+import numpy
 import pandas
 
 from stock_tw import util
@@ -18,6 +21,57 @@ SECURITY_TB_COLs = [
 ]
 
 
+@dataclasses.dataclass
+class Universe:
+    """The securities of `security_list` which pass every filter given"""
+
+    codes: Optional[list[str]] = None
+    names: Optional[list[str]] = None
+    types: Optional[list[str]] = None
+    markets: Optional[list[str]] = None
+    groups: Optional[list[str]] = None
+
+
+def get_universe(universe: Union[str, list[str], Universe]) -> Universe:
+    """A `Universe` of the codes of a list, or of a name of `股票池` in `CONF`"""
+    if isinstance(universe, Universe):
+        return universe
+    if isinstance(universe, str):
+        universes = util.CONF.get("股票池") or {}
+        if universe not in universes:
+            raise util.YiException(f"Unknown universe `{universe}`.")
+        return Universe(**universes[universe])
+    return Universe(codes=list(universe))
+
+
+def select_codes(
+    securities: pandas.DataFrame, universe: Union[str, list[str], Universe]
+) -> list[str]:
+    """The codes of the `universe` among `securities`, read by `read_sql`"""
+    universe = get_universe(universe)
+    filters = {
+        "name": universe.names,
+        "type": universe.types,
+        "market": universe.markets,
+        "group": universe.groups,
+    }
+    if all(values is None for values in filters.values()):
+        # Codes only, also those delisted since
+        return list(securities.index if universe.codes is None else universe.codes)
+
+    mask = numpy.ones(len(securities), dtype=bool)
+    for column, values in filters.items():
+        if values is not None:
+            mask &= securities[column].isin(values).to_numpy()
+    if universe.codes is not None:
+        mask &= securities.index.isin(universe.codes)
+    if universe.names is not None:
+        if missing_names := set(universe.names) - set(securities["name"]):
+            logging.warning(f"Skip unknown names {sorted(missing_names)}")
+
+    return list(securities.index[mask])
+
+
 def read_sql(
     conn: Union[sqlite3.Connection, MySQLdb.Connection],
     security_types: Optional[list[str]] = None,
@@ -0,0 +1,482 @@
+"""
+An embedded DuckDB of the tables `dataset` analyzes, where its heavy analyses are
+expressed as SQL and run by the multi-threaded vectorized engine of DuckDB, in place of
+single-threaded pandas or of MySQL queries which can not use an index.
+
+    python bin/mirror_duckdb.py -sdate 2018-01-01 -parquet usr/data/parquet
+    duck = warehouse.connect()
+    his_profits = warehouse.calculate_his_fin_stmt(duck)
+
+The tables are mirrored from MySQL and SQLite3 into `$STORAGE_ROOT/stock-tw.duckdb` by
+`mirror`, or read as views of the Parquet files of `export_parquet` by `attach_parquet`.
+The analyses return the frames and the column names of their namesakes of `dataset`.
+Requires duckdb.
+"""
+
+import datetime
+import logging
+import os
+import os.path
+import sqlite3
+from typing import Iterator, Optional
+
+import duckdb
+import pandas
+import sqlalchemy
+from dateutil.relativedelta import relativedelta
+
+from stock_tw import util
+from stock_tw.變易 import pera, price, profit, revenue
+from stock_tw.變易.fin_stmt import (
+    balance_sheet,
+    cash_flow,
+    cumulate_income_sheet,
+    income_sheet,
+)
+
+DUCKDB_FILE_NAME = "stock-tw.duckdb"
+
+# The tables in MySQL, mirrored a year at a time
+MYSQL_TB_NAMEs = [
+    price.PRICE_TB_NAME,
+    pera.PERA_TB_NAME,
+    revenue.REVENUE_TB_NAME,
+    profit.METATIME_TB_NAME,
+]
+# The statements in SQLite3, by their readers
+SQLITE3_READERs = {
+    balance_sheet.BALANCE_TB_NAME: balance_sheet.read_sql,
+    income_sheet.INCOME_TB_NAME: income_sheet.read_sql,
+    cumulate_income_sheet.CUMULATE_INCOME_TB_NAME: cumulate_income_sheet.read_sql,
+    cash_flow.CASH_TB_NAME: cash_flow.read_sql,
+}
+TB_NAMEs = MYSQL_TB_NAMEs + list(SQLITE3_READERs)
+
+# The profitability by quarter as `profit.calculate`, a ratio of 0 / 0 is NULL as the
+# NaN which pandas skips
+_HIS_PROFIT_SQL = """
+    WITH revenue AS (
+        SELECT
+            CAST(
+                CASE quarter(month)
+                    WHEN 1 THEN make_date(year(month), 5, 15)
+                    WHEN 2 THEN make_date(year(month), 8, 14)
+                    WHEN 3 THEN make_date(year(month), 11, 14)
+                    ELSE make_date(year(month) + 1, 3, 31)
+                END AS TIMESTAMP
+            ) AS ts,
+            code,
+            "當月營收"
+        FROM (
+            SELECT ts - INTERVAL 1 MONTH AS month, code, "當月營收"
+            FROM monthly_revenue
+            WHERE ts >= $revenue_start_time {codes}
+        )
+    ),
+    cust AS (
+        SELECT
+            ts,
+            code,
+            IF(count("當月營收") = count(*), sum("當月營收"), NULL) AS "(C)營收合計",
+            "(C)營收合計" / count(*) AS "(C)平均月營收",
+            count(*) AS "(C)合計月數"
+        FROM revenue
+        GROUP BY ts, code
+    )
+    SELECT
+        m.ts,
+        m.code,
+        {balance_columns},
+        m.created_ts,
+        {income_columns},
+        nullif(i."本期淨利（淨損）" / b."資產總計" * 100, 'NaN'::DOUBLE) AS ROA,
+        nullif(i."本期淨利（淨損）" / b."權益總額" * 100, 'NaN'::DOUBLE) AS ROE,
+        nullif(
+            (b."資產總計" - b."權益總額") / b."資產總計" * 100, 'NaN'::DOUBLE
+        ) AS DBR,
+        nullif(
+            i."營業毛利（毛損）" / i."營業收入合計" * 100, 'NaN'::DOUBLE
+        ) AS GPM,
+        nullif(
+            i."本期淨利（淨損）" / i."營業收入合計" * 100, 'NaN'::DOUBLE
+        ) AS NIM,
+        c."(C)營收合計",
+        c."(C)平均月營收",
+        c."(C)合計月數"
+    FROM balance_sheet_metatime AS m
+    JOIN balance_sheet AS b ON b.ts = m.ts AND b.code = m.code
+    JOIN income_sheet AS i ON i.ts = m.ts AND i.code = m.code
+    JOIN cust AS c ON c.ts = m.ts AND c.code = m.code
+    WHERE m.ts >= $start_time {codes_m}
+"""
+
+
+def connect(path: str = None, read_only: bool = False) -> duckdb.DuckDBPyConnection:
+    """The DuckDB of `path`, `$STORAGE_ROOT/stock-tw.duckdb` by default"""
+    path = path or os.path.join(os.getenv("STORAGE_ROOT"), DUCKDB_FILE_NAME)
+    return duckdb.connect(path, read_only=read_only)
+
+
+def mirror(
+    duck: duckdb.DuckDBPyConnection,
+    connection: sqlalchemy.Connection,
+    conn: sqlite3.Connection,
+    start_time: datetime.datetime,
+    table_names: list[str] = None,
+) -> dict[str, int]:
+    """Copies the rows since `start_time` of the tables into `duck`, rows by table"""
+    counts = {}
+    for table_name in table_names or TB_NAMEs:
+        if table_name in SQLITE3_READERs:
+            if not util.is_table_existed_in_sqlite3(table_name, con=conn):
+                logging.warning(f"Skip table `{table_name}`, not existed")
+                continue
+            frames = [SQLITE3_READERs[table_name](conn, start_time=start_time)]
+        else:
+            frames = _read_yearly(connection, table_name, start_time)
+
+        counts[table_name] = 0
+        for df in frames:
+            _write(duck, table_name, df, replace=counts[table_name] == 0)
+            counts[table_name] += len(df)
+        logging.info(f"Mirror table `{table_name}` {counts[table_name]} rows")
+    return counts
+
+
+def export_parquet(duck: duckdb.DuckDBPyConnection, directory: str) -> list[str]:
+    """Writes the tables of `duck` into `directory`, a Parquet file per table"""
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for (table_name,) in duck.execute("SHOW TABLES;").fetchall():
+        path = os.path.join(directory, f"{table_name}.parquet")
+        duck.execute(f"COPY \"{table_name}\" TO '{path}' (FORMAT parquet);")
+        paths.append(path)
+    return paths
+
+
+def attach_parquet(duck: duckdb.DuckDBPyConnection, directory: str) -> list[str]:
+    """Creates a view of every table which has a Parquet file in `directory`"""
+    table_names = []
+    for table_name in TB_NAMEs:
+        path = os.path.join(directory, f"{table_name}.parquet")
+        if not os.path.exists(path):
+            continue
+        duck.execute(
+            f'CREATE OR REPLACE VIEW "{table_name}" AS'
+            f" SELECT * FROM read_parquet('{path}');"
+        )
+        table_names.append(table_name)
+    return table_names
+
+
+def read_peras(
+    duck: duckdb.DuckDBPyConnection,
+    start_time: datetime.datetime,
+    codes: Optional[list[str]] = None,
+) -> pandas.DataFrame:
+    """The PER analyses since `start_time`, as `pera.read_sql`, a row per year"""
+    return _query(
+        duck,
+        f"""
+        SELECT * FROM pera
+        WHERE ts >= $start_time {_codes_clause(codes)}
+        ORDER BY ts, code;""",
+        {"start_time": start_time, "codes": codes},
+        index_col=util.TIMED_INDEX_COLs,
+    )
+
+
+def calculate_his_fin_stmt(
+    duck: duckdb.DuckDBPyConnection,
+    start_time: datetime.datetime = None,
+    codes: Optional[list[str]] = None,
+) -> pandas.DataFrame:
+    """The `dataset.his_profits` of the quarters since `start_time`"""
+    start_time = start_time or datetime.datetime.today() - relativedelta(years=6)
+    return _query(
+        duck,
+        _his_profit_sql(codes) + " ORDER BY m.ts, m.code;",
+        {
+            "start_time": start_time,
+            "revenue_start_time": start_time - relativedelta(months=6),
+            "codes": codes,
+        },
+        index_col=util.TIMED_INDEX_COLs,
+    )
+
+
+def analyze_prices(
+    duck: duckdb.DuckDBPyConnection,
+    ts: datetime.datetime = None,
+    start_time: datetime.datetime = None,
+    codes: Optional[list[str]] = None,
+) -> pandas.DataFrame:
+    """
+    The `dataset.daily_price` of the day `ts`, the last one by default, with the daily
+    averages of the days since `start_time`
+    """
+    start_time = start_time or datetime.datetime.today() - relativedelta(months=6)
+    ts_clause = "$ts" if ts else "(SELECT max(ts) FROM daily_price)"
+    return _query(
+        duck,
+        f"""
+        WITH average AS (
+            SELECT
+                code,
+                CAST(trunc(avg("成交股數") / 1000) AS BIGINT) AS "日均成交張數",
+                CAST(trunc(avg("成交筆數")) AS BIGINT) AS "日均成交筆數",
+                CAST(trunc(avg("成交金額")) AS BIGINT) AS "日均成交金額"
+            FROM daily_price
+            WHERE ts >= $start_time {_codes_clause(codes)}
+            GROUP BY code
+        )
+        SELECT
+            p.* EXCLUDE (ts),
+            p.ts AS ts,
+            a."日均成交張數",
+            a."日均成交筆數",
+            a."日均成交金額"
+        FROM daily_price AS p
+        JOIN average AS a ON a.code = p.code
+        WHERE p.ts = {ts_clause}
+        ORDER BY p.code;""",
+        {"ts": ts, "start_time": start_time, "codes": codes},
+        index_col=[util.SECURITY_ID_NAME],
+    )
+
+
+def analyze_revenue(
+    duck: duckdb.DuckDBPyConnection,
+    ts: datetime.datetime = None,
+    codes: Optional[list[str]] = None,
+) -> pandas.DataFrame:
+    """The `dataset.anal_revenue` of the month `ts`, the last one by default"""
+    ts_clause = "$ts" if ts else "(SELECT max(ts) FROM monthly_revenue)"
+    return _query(
+        duck,
+        f"""
+        WITH m0 AS (
+            SELECT * FROM monthly_revenue
+            WHERE ts = {ts_clause} {_codes_clause(codes)}
+        )
+        SELECT
+            m0.code,
+            m0.updated_ts,
+            m0."當月營收",
+            m0."當月累計營收",
+            m0."去年累計營收",
+            m1."當月營收" AS "R(1)",
+            m2."當月營收" AS "R(2)",
+            my."當月營收" AS "R(y)",
+            (m0."當月營收" - "R(y)") / "R(y)" * 100 AS YoY,
+            (m0."當月營收" - "R(1)") / "R(1)" * 100 AS MoM,
+            coalesce(m0."當月營收" > "R(1)" AND "R(1)" > "R(2)", false) AS IsM3
+        FROM m0
+        LEFT JOIN monthly_revenue AS m1
+            ON m1.code = m0.code AND m1.ts = m0.ts - INTERVAL 1 MONTH
+        LEFT JOIN monthly_revenue AS m2
+            ON m2.code = m0.code AND m2.ts = m0.ts - INTERVAL 2 MONTH
+        LEFT JOIN monthly_revenue AS my
+            ON my.code = m0.code AND my.ts = m0.ts - INTERVAL 1 YEAR
+        ORDER BY m0.code;""",
+        {"ts": ts, "codes": codes},
+        index_col=[util.SECURITY_ID_NAME],
+    )
+
+
+def analyze_profit(
+    duck: duckdb.DuckDBPyConnection,
+    anal_per: pandas.DataFrame,
+    daily_price: pandas.DataFrame,
+    ifrs_ts: datetime.datetime = None,
+    codes: Optional[list[str]] = None,
+) -> pandas.DataFrame:
+    """
+    The `dataset.anal_profit` of the quarter `ifrs_ts`, the last one by default, from
+    the `dataset.anal_per` and `dataset.daily_price` frames and the profitability of
+    the quarter and the 4 before it
+    """
+    if ifrs_ts is None:
+        (ifrs_ts,) = duck.execute("SELECT max(ts) FROM balance_sheet;").fetchone()
+    ifrs_iter = util.IFRSDateIter(ifrs_dt=ifrs_ts)
+    quarters = [ifrs_iter.current_ifrs_dt()] + [
+        ifrs_iter.previous_ifrs_dt() for _ in range(4)
+    ]
+
+    def quarter_columns(q: int) -> str:
+        """The profitability of the `q`th quarter before, named as `dataset`"""
+        names = {"基本每股盈餘合計": f"E({q})", "營業外收入及支出合計": f"外({q})"}
+        return ", ".join(
+            f'q{q}."{column}" AS "{names.get(column, f"{column}_q{q}")}"'
+            for column in profit.HIS_PROFIT_TB_DTYPEs
+        )
+
+    def row_list(column: str) -> str:
+        """The values of `column` of the quarter and the 3 before it, as a list"""
+        if column == "E":
+            return '["E(0)", "E(1)", "E(2)", "E(3)"]'
+        return f'["{column}(0)", "{column}_q1", "{column}_q2", "{column}_q3"]'
+
+    joins = "\n".join(
+        f"""
+        LEFT JOIN his AS q{q} ON q{q}.code = base.code AND q{q}.ts = $q{q}"""
+        for q in range(1, 5)
+    )
+    sql_stmt = f"""
+        WITH his AS ({_his_profit_sql(codes)} AND m.ts IN ({", ".join(
+            f"$q{q}" for q in range(5)
+        )})),
+        q0 AS (SELECT * EXCLUDE (ts) FROM his WHERE ts = $q0),
+        base AS (
+            SELECT
+                coalesce(p.code, q0.code) AS code,
+                p.* EXCLUDE (code),
+                q0.* EXCLUDE (code)
+            FROM anal_per AS p
+            FULL JOIN q0 ON q0.code = p.code
+        ),
+        joined AS (
+            SELECT
+                d."收盤價",
+                d."漲跌幅(%)",
+                base.* RENAME (
+                    "基本每股盈餘合計" AS "E(0)",
+                    "營業外收入及支出合計" AS "外(0)",
+                    GPM AS "GPM(0)",
+                    NIM AS "NIM(0)",
+                    ROA AS "ROA(0)",
+                    ROE AS "ROE(0)",
+                    DBR AS "DBR(0)"
+                ),
+                {quarter_columns(1)},
+                {quarter_columns(2)},
+                {quarter_columns(3)},
+                {quarter_columns(4)}
+            FROM base {joins}
+            LEFT JOIN daily_price AS d ON d.code = base.code
+        )
+        SELECT
+            * REPLACE (
+                "外(0)" / "本期淨利（淨損）" * 100 AS "外(0)",
+                "外(1)" / "本期淨利（淨損）_q1" * 100 AS "外(1)",
+                "外(2)" / "本期淨利（淨損）_q2" * 100 AS "外(2)",
+                "外(3)" / "本期淨利（淨損）_q3" * 100 AS "外(3)"
+            ),
+            coalesce(list_sum({row_list("E")}), 0) AS "E(Sum)",
+            list_avg({row_list("E")}) AS "E(Avg)",
+            list_stddev_samp({row_list("E")}) AS "E(Std)",
+            "E(Sum)" AS EPS,
+            "本期淨利（淨損）" / "普通股股本" * 10 AS "(C)EPS",
+            "收盤價" / ("(C)EPS" * 4) AS "(C)PER",
+            coalesce(list_sum({row_list("NIM")}), 0) AS NIM,
+            coalesce(list_sum({row_list("GPM")}), 0) AS GPM,
+            coalesce(list_sum({row_list("ROA")}), 0) AS ROA,
+            coalesce(list_sum({row_list("ROE")}), 0) AS ROE,
+            list_avg({row_list("DBR")}) AS DBR,
+            "E(0)" - "E(1)" AS "EPS(0)+",
+            "GPM(0)" - "GPM_q1" AS "GPM+",
+            "NIM(0)" - "NIM_q1" AS "NIM+",
+            "ROA(0)" - "ROA_q1" AS "ROA+",
+            "ROE(0)" - "ROE_q1" AS "ROE+",
+            "DBR(0)" - "DBR_q1" AS "DBR+",
+            ("普通股股本" - "普通股股本_q1") / "普通股股本_q1" * 100 AS "股本(%)+",
+            ("資產總計" - "資產總計_q1") / "資產總計_q1" * 100 AS "資產(%)+",
+            ("權益總額" - "權益總額_q1") / "權益總額_q1" * 100 AS "權益(%)+",
+            ("本期淨利（淨損）" - "本期淨利（淨損）_q4")
+                / "本期淨利（淨損）_q4" * 100 AS YoYQ,
+            ("本期淨利（淨損）" - "本期淨利（淨損）_q1")
+                / "本期淨利（淨損）_q1" * 100 AS QoQ,
+            coalesce(
+                "本期淨利（淨損）" > "本期淨利（淨損）_q1"
+                AND "本期淨利（淨損）_q1" > "本期淨利（淨損）_q2",
+                false
+            ) AS IsQ3,
+            ("E(0)" - "E(4)") / "E(0)" * 100 AS YoE,
+            ("E(0)" - "E(1)") / "E(1)" * 100 AS QoE,
+            coalesce("E(0)" > "E(1)" AND "E(1)" > "E(2)", false) AS IsE3
+        FROM joined
+        ORDER BY code;"""
+
+    duck.register("anal_per", anal_per.reset_index())
+    duck.register("daily_price", daily_price[["收盤價", "漲跌幅(%)"]].reset_index())
+    try:
+        return _query(
+            duck,
+            sql_stmt,
+            {
+                "start_time": quarters[-1],
+                "revenue_start_time": quarters[-1] - relativedelta(months=6),
+                "codes": codes,
+                **{f"q{q}": ts for q, ts in enumerate(quarters)},
+            },
+            index_col=[util.SECURITY_ID_NAME],
+        )
+    finally:
+        duck.unregister("anal_per")
+        duck.unregister("daily_price")
+
+
+def _his_profit_sql(codes: Optional[list[str]]) -> str:
+    return _HIS_PROFIT_SQL.format(
+        balance_columns=", ".join(
+            f'b."{column}"' for column in profit.BALANCE_SHEET_COLs
+        ),
+        income_columns=", ".join(
+            f'i."{column}"' for column in profit.INCOME_SHEET_COLs
+        ),
+        codes=_codes_clause(codes),
+        codes_m=_codes_clause(codes, "m.code"),
+    )
+
+
+def _codes_clause(codes: Optional[list[str]], column: str = "code") -> str:
+    """The condition of `codes` on `column`, bound by the parameter `$codes`"""
+    return "" if codes is None else f"AND list_contains($codes, {column})"
+
+
+def _query(
+    duck: duckdb.DuckDBPyConnection,
+    sql_stmt: str,
+    params: dict,
+    index_col: list[str],
+) -> pandas.DataFrame:
+    # DuckDB refuses the parameters which the statement does not use
+    params = {key: value for key, value in params.items() if f"${key}" in sql_stmt}
+    df = duck.execute(sql_stmt, params).df()
+    return df.set_index(index_col)
+
+
+def _read_yearly(
+    connection: sqlalchemy.Connection, table_name: str, start_time: datetime.datetime
+) -> Iterator[pandas.DataFrame]:
+    """The rows of `table_name` since `start_time`, a frame per year"""
+    stime = start_time
+    while stime <= datetime.datetime.now():
+        etime = datetime.datetime(stime.year + 1, 1, 1)
+        yield util.read_sql(
+            f"""
+            SELECT * FROM `{table_name}`
+            WHERE `{util.TIME_COL_NAME}` >= :start_time
+                AND `{util.TIME_COL_NAME}` < :end_time;""",
+            connection,
+            params={"start_time": str(stime), "end_time": str(etime)},
+        )
+        stime = etime
+
+
+def _write(
+    duck: duckdb.DuckDBPyConnection,
+    table_name: str,
+    df: pandas.DataFrame,
+    replace: bool,
+):
+    duck.register("_mirrored", df.reset_index())
+    try:
+        if replace:
+            duck.execute(
+                f'CREATE OR REPLACE TABLE "{table_name}" AS SELECT * FROM _mirrored;'
+            )
+        else:
+            duck.execute(f'INSERT INTO "{table_name}" BY NAME SELECT * FROM _mirrored;')
+    finally:
+        duck.unregister("_mirrored")